@@ -0,0 +1,151 @@
+import asyncio
+import threading
+
+from connections import StreamConnection, tune_socket
+from protocol import MSG_HELLO, ProtocolError, read_frame_async
+
+DEFAULT_BACKLOG = 128
+
+
+class AsyncPeerServer:
+    """
+    asyncio based peer server.
+
+    Runs its own event loop in a background thread: one coroutine per
+    connected peer instead of one OS thread, and a non-blocking accept
+    instead of a timeout poll. `on_hello(connection)` is called once per
+    connection with a StreamConnection that other threads can send on (in a
+    worker thread, it may talk to the STUN server), `on_frame(peer_username,
+    frame)` for every received frame and `on_close(connection)` at the end.
+    Frames whose type is in `blocking_frames` (disk or database work) are
+    handled in the default executor instead of on the loop, still one at a
+    time per connection.
+    """
+
+    def __init__(self, port, on_hello, on_frame, on_close=None, backlog=DEFAULT_BACKLOG, host="0.0.0.0",
+                 blocking_frames=()):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.on_hello = on_hello
+        self.on_frame = on_frame
+        self.on_close = on_close
+        self.blocking_frames = frozenset(blocking_frames)
+
+        self._loop = None
+        self._thread = None
+        self._stop_event = None
+        self._started = threading.Event()
+        self._handlers = set()
+        self.error = None
+
+    # -------- lifecycle --------
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="aio-server", daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if self.error:
+            raise self.error
+        return self
+
+    def stop(self, timeout=5):
+        if self._loop and self._stop_event and not self._loop.is_closed():
+            try:
+                self._loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def handler_count(self):
+        """Connected peers currently served by a handler coroutine."""
+        return len(self._handlers)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve())
+        except Exception as e:
+            self.error = e
+            print(f"❌ [SERVER INIT ERROR] Failed to start server: {e}")
+        finally:
+            self._started.set()
+            self._loop.close()
+            print("🛑 [SERVER] Server stopped")
+
+    async def _serve(self):
+        self._stop_event = asyncio.Event()
+        server = await asyncio.start_server(
+            self._handle_peer,
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+        )
+        print(f"🟢 [SERVER] Listening on port {self.port} (asyncio, backlog={self.backlog}) ...")
+        self._started.set()
+
+        async with server:
+            await self._stop_event.wait()
+            server.close()
+            for task in list(self._handlers):
+                task.cancel()
+            if self._handlers:
+                await asyncio.gather(*self._handlers, return_exceptions=True)
+            await server.wait_closed()
+
+    # -------- connections --------
+    async def _handle_peer(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        addr = writer.get_extra_info("peername")
+        peer_username = None
+        connection = None
+        try:
+            print(f"🔗 [SERVER] Connected by {addr}")
+            tune_socket(writer.get_extra_info("socket"))
+            hello = await read_frame_async(reader)
+            if hello is None or hello.type != MSG_HELLO:
+                return
+            peer_username = hello.payload.decode().strip()
+            connection = StreamConnection(writer, self._loop, peer_username)
+            await asyncio.to_thread(self.on_hello, connection)
+
+            while True:
+                frame = await read_frame_async(reader)
+                if frame is None:
+                    print(f"⚪ [INFO] {peer_username} disconnected")
+                    break
+                frame = connection.receive(frame)
+                if frame is None:
+                    continue
+                if frame.type in self.blocking_frames:
+                    await self._loop.run_in_executor(None, self.on_frame, peer_username, frame)
+                else:
+                    self.on_frame(peer_username, frame)
+
+        except asyncio.CancelledError:
+            pass
+        except ConnectionResetError:
+            print(f"⚪ [INFO] {peer_username} connection reset")
+        except ProtocolError as e:
+            print(f"⚠️ [PROTOCOL ERROR] {peer_username}: {e}")
+        except Exception as e:
+            print(f"⚠️ [SERVER ERROR] {e}")
+        finally:
+            self._handlers.discard(task)
+            if connection is not None:
+                connection.closed = True
+                if self.on_close:
+                    self.on_close(connection)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
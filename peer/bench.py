@@ -0,0 +1,416 @@
+"""
+Loopback throughput / latency benchmark for the peer networking code.
+
+Starts N peer processes on localhost, each running the real peer server
+(`start_listening` -> `start_server`/`handle_peer` or the asyncio server)
+and sending through `send_chat_message`, with a stand-in directory server
+instead of the STUN server. Peer i sends to peer i+1 (a ring).
+
+    python bench.py run --peers 4 --duration 10 --size 256 --rate 500 --output run.json
+    python bench.py compare before.json after.json
+
+Reports msgs/sec, p50/p90/p99 one-way latency and CPU / RSS per peer as JSON.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BASE_PORT = 47500
+DRAIN_TIMEOUT = 10
+
+
+# ===============================
+# STAND-IN DIRECTORY SERVER
+# ===============================
+class DirectoryStandIn:
+    """In-memory stand-in for the STUN server endpoints the peers call."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.peers = {}
+        self.saved_messages = 0
+        self._lock = threading.Lock()
+        directory = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path == "/peerinfo":
+                    peer = directory.peers.get(params.get("username"))
+                    self._reply(200, peer) if peer else self._reply(404, {"error": "Peer not found"})
+                elif url.path == "/peers":
+                    self._reply(200, {"peers": [{"username": u} for u in directory.peers]})
+                elif url.path == "/message/get/":
+                    self._reply(200, {"messages": [], "has_more": False, "oldest_id": None, "newest_id": None})
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                path = urlparse(self.path).path
+                if path == "/register":
+                    directory.peers[body["username"]] = {k: body[k] for k in ("username", "ip", "port")}
+                    self._reply(201, {"message": "Peer registered successfully"})
+                elif path == "/message/bulk_create/":
+                    with directory._lock:
+                        directory.saved_messages += len(body["messages"])
+                    self._reply(201, {"status": "ok", "count": len(body["messages"])})
+                elif path == "/message/create/":
+                    with directory._lock:
+                        directory.saved_messages += 1
+                    self._reply(201, {"status": "ok"})
+                elif path == "/friend/start/":
+                    self._reply(200, {"message": "friendship started successfully"})
+                else:
+                    self._reply(404, {"error": "not found"})
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ===============================
+# WORKER (one peer process)
+# ===============================
+def _rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+_events = None
+
+
+def _emit(kind, data=None):
+    # A pipe of its own: the peer code prints to stdout from other threads.
+    _events.write(json.dumps({"kind": kind, **(data or {})}) + "\n")
+    _events.flush()
+
+
+def worker(args):
+    global _events
+    _events = os.fdopen(args.events_fd, "w", encoding="utf-8")
+
+    # Imported here: com_server and local_store read their settings from the
+    # environment the coordinator prepared.
+    import main
+    from com_server import invalidate_peer, register, resolve_peer, save_messages
+    from connections import ConnectionManager
+    from file_transfer import FileTransfers
+    from groups import GroupFanout
+    from local_store import LocalStore
+    from outbox import Outbox
+    from utils import create_messagebox
+    from write_behind import WriteBehindQueue
+
+    names = [f"peer{i}" for i in range(args.peers)]
+    name = names[args.index]
+    port = args.base_port + args.index
+    register(name, "127.0.0.1", port)
+
+    # Same state the CLI login sets up.
+    main.username = name
+    main.my_user = {"username": name, "ip": "127.0.0.1", "port": port}
+    main.user_friends = [n for n in names if n != name]
+    main.user_groups = []
+    main.logged_in = True
+    main.local_store = LocalStore(name)
+    main.message_box, main.new_message_flags = create_messagebox(main.user_friends, main.local_store)
+    main.active_chat_flags = main.new_message_flags.copy()
+    main.message_writer = WriteBehindQueue(save_messages)
+    main.connections = ConnectionManager(
+        name,
+        on_frame=main.dispatch_frame,
+        buffer_size=main.BUFFER_SIZE,
+        resolve=resolve_peer,
+        invalidate=invalidate_peer
+    )
+    main.outbox = Outbox(main.local_store, main.connections, resolve_peer)
+    main.transfers = FileTransfers(main.local_store, main.connections, resolve_peer)
+    main.group_fanout = GroupFanout(main.connections)
+    main.SERVER_MODE = args.server_mode
+
+    latencies = []
+    received = [0]
+    deliver = main.on_peer_message
+
+    def on_peer_message(peer_username, msg_text, msg_id=None):
+        now = time.monotonic_ns()
+        stamp, _, _ = msg_text.partition(":")
+        if stamp.isdigit():
+            latencies.append((now - int(stamp)) // 1000)
+        received[0] += 1
+        deliver(peer_username, msg_text, msg_id)
+
+    main.on_peer_message = on_peer_message
+    main.start_listening(port)
+    _emit("ready")
+
+    target_name = names[(args.index + 1) % args.peers]
+    for line in sys.stdin:
+        command = line.strip()
+        if command == "go":
+            target = resolve_peer(target_name)
+            cpu_start, wall_start = _cpu_seconds(), time.monotonic()
+            sent = 0
+            padding = "x" * args.size
+            interval = 1.0 / args.rate if args.rate else 0
+            deadline = wall_start + args.duration
+            next_send = wall_start
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if interval:
+                    if now < next_send:
+                        time.sleep(next_send - now)
+                    next_send += interval
+                prefix = f"{time.monotonic_ns()}:{sent}:"
+                main.send_chat_message(target, prefix + padding[:max(0, args.size - len(prefix))])
+                sent += 1
+            send_seconds = time.monotonic() - wall_start
+
+            drain_deadline = time.monotonic() + DRAIN_TIMEOUT
+            while main.outbox.pending_count() and time.monotonic() < drain_deadline:
+                time.sleep(0.01)
+            _emit("sent", {"sent": sent, "send_seconds": send_seconds,
+                           "unacked": main.outbox.pending_count()})
+
+        elif command == "report":
+            _emit("report", {
+                "index": args.index,
+                "sent": sent,
+                "received": received[0],
+                "latencies_us": latencies,
+                "cpu_seconds": _cpu_seconds() - cpu_start,
+                "wall_seconds": time.monotonic() - wall_start,
+                "rss_kb": _rss_kb(),
+                "max_rss_kb": _max_rss_kb(),
+            })
+            break
+
+    main.stop_listening()
+    main.outbox.close()
+    main.message_writer.close()
+    os._exit(0)
+
+
+def _max_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# ===============================
+# COORDINATOR
+# ===============================
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+class Worker:
+    def __init__(self, index, args, directory_url, home):
+        env = dict(os.environ, STUN_SERVER_URL=directory_url, P2P_CHAT_HOME=home, PYTHONUNBUFFERED="1")
+        read_fd, write_fd = os.pipe()
+        command = [
+            sys.executable, os.path.abspath(__file__), "worker",
+            "--index", str(index), "--peers", str(args.peers), "--base-port", str(args.base_port),
+            "--size", str(args.size), "--rate", str(args.rate), "--duration", str(args.duration),
+            "--server-mode", args.server_mode, "--events-fd", str(write_fd),
+        ]
+        self.index = index
+        self.process = subprocess.Popen(
+            command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env, pass_fds=(write_fd,),
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, encoding="utf-8",
+        )
+        os.close(write_fd)
+        self.events = {}
+        self._cond = threading.Condition()
+        threading.Thread(target=self._read, args=(read_fd,), daemon=True).start()
+
+    def _read(self, fd):
+        with os.fdopen(fd, encoding="utf-8") as events:
+            for line in events:
+                event = json.loads(line)
+                with self._cond:
+                    self.events[event.pop("kind")] = event
+                    self._cond.notify_all()
+        with self._cond:
+            self.events.setdefault("exit", {})
+            self._cond.notify_all()
+
+    def wait(self, kind, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: kind in self.events or "exit" in self.events, timeout)
+            if kind not in self.events:
+                raise RuntimeError(f"peer{self.index} did not report '{kind}'")
+            return self.events[kind]
+
+    def command(self, text):
+        self.process.stdin.write(text + "\n")
+        self.process.stdin.flush()
+
+
+def run(args):
+    home = tempfile.mkdtemp(prefix="p2p-bench-")
+    directory = DirectoryStandIn().start()
+    workers = []
+    try:
+        workers = [Worker(i, args, directory.url, home) for i in range(args.peers)]
+        for w in workers:
+            w.wait("ready", 30)
+        for w in workers:
+            w.command("go")
+        sent = [w.wait("sent", args.duration + DRAIN_TIMEOUT + 30) for w in workers]
+        time.sleep(0.5)
+        for w in workers:
+            w.command("report")
+        reports = [w.wait("report", 30) for w in workers]
+    finally:
+        for w in workers:
+            try:
+                w.process.wait(10)
+            except subprocess.TimeoutExpired:
+                w.process.kill()
+        directory.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+    latencies = [us for r in reports for us in r.pop("latencies_us")]
+    send_seconds = max(s["send_seconds"] for s in sent)
+    total_received = sum(r["received"] for r in reports)
+    peers = []
+    for report, sent_info in zip(reports, sent):
+        report["unacked"] = sent_info["unacked"]
+        report["cpu_percent"] = round(100 * report["cpu_seconds"] / report["wall_seconds"], 1)
+        peers.append(report)
+
+    def ms(p):
+        value = percentile(latencies, p)
+        return None if value is None else value / 1000
+
+    return {
+        "config": {
+            "peers": args.peers, "duration": args.duration, "size": args.size,
+            "rate": args.rate, "server_mode": args.server_mode,
+        },
+        "environment": {
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "total": {
+            "sent": sum(r["sent"] for r in reports),
+            "received": total_received,
+            "unacked": sum(r["unacked"] for r in reports),
+            "persisted": directory.saved_messages,
+            "msgs_per_sec": round(total_received / send_seconds, 1) if send_seconds else None,
+            "latency_ms": {"p50": ms(50), "p90": ms(90), "p99": ms(99), "max": ms(100)},
+        },
+        "peers": peers,
+    }
+
+
+def compare(before, after):
+    """Print the change of the headline numbers between two result files."""
+    rows = [
+        ("msgs/sec", lambda r: r["total"]["msgs_per_sec"], True),
+        ("p50 ms", lambda r: r["total"]["latency_ms"]["p50"], False),
+        ("p99 ms", lambda r: r["total"]["latency_ms"]["p99"], False),
+        ("cpu % (avg)", lambda r: sum(p["cpu_percent"] for p in r["peers"]) / len(r["peers"]), False),
+        ("rss kb (max)", lambda r: max(p["rss_kb"] or 0 for p in r["peers"]), False),
+    ]
+    if before["config"] != after["config"]:
+        print(f"⚠️ Different configs: {before['config']} vs {after['config']}")
+    for label, get, higher_is_better in rows:
+        a, b = get(before), get(after)
+        if not a or b is None:
+            print(f"{label:14} {a} -> {b}")
+            continue
+        change = (b - a) / a * 100
+        better = change > 0 if higher_is_better else change < 0
+        print(f"{label:14} {a:>10.2f} -> {b:>10.2f}  {change:+6.1f}% {'✅' if better else '❌'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("run", "worker"):
+        p = sub.add_parser(name)
+        p.add_argument("--peers", type=int, default=4)
+        p.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+        p.add_argument("--size", type=int, default=256, help="message size in bytes")
+        p.add_argument("--rate", type=float, default=0, help="messages/sec per peer, 0 = as fast as possible")
+        p.add_argument("--server-mode", choices=("asyncio", "threaded"), default="asyncio")
+        p.add_argument("--base-port", type=int, default=BASE_PORT)
+        if name == "run":
+            p.add_argument("--output", help="write the JSON report here instead of stdout")
+        else:
+            p.add_argument("--index", type=int, required=True)
+            p.add_argument("--events-fd", type=int, required=True)
+
+    p = sub.add_parser("compare")
+    p.add_argument("before")
+    p.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "worker":
+        worker(args)
+    elif args.command == "compare":
+        with open(args.before) as f1, open(args.after) as f2:
+            compare(json.load(f1), json.load(f2))
+    else:
+        if args.peers < 2:
+            parser.error("--peers must be at least 2")
+        result = run(args)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2)
+            total = result["total"]
+            print(f"📈 {total['msgs_per_sec']} msgs/sec, p50 {total['latency_ms']['p50']} ms, "
+                  f"p99 {total['latency_ms']['p99']} ms -> {args.output}")
+        else:
+            print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
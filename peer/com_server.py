@@ -1,167 +1,707 @@
-import requests
-
-STUN_SERVER_URL = "http://192.168.1.104:8000"
-TIMEOUT = 3
-
-def save_message(sender, receiver, content):
-
-    url = f"{STUN_SERVER_URL}/message/create/"
-
-    payload = {
-        "sender": sender,
-        "receiver": receiver,
-        "content": content
-    }
-
-    try:
-        r = requests.post(url, json=payload, timeout=3)
-
-        if r.status_code == 201:
-            return True
-        else:
-            print("[DB] Save failed:", r.text)
-            return False
-
-    except Exception as e:
-        print("[DB ERROR]", e)
-        return False
-
-
-def register(username, ip, port):
-    payload = {
-        "username": username,
-        "ip": ip,
-        "port": port
-    }
-
-    try:
-        r = requests.post(
-            f"{STUN_SERVER_URL}/register",
-            json=payload,
-            timeout=TIMEOUT
-        )
-
-        if r.status_code in (200, 201):
-            print("[STUN] Registered successfully")
-            return True
-        else:
-            print("[STUN] Registration failed:", r.text)
-            return False
-
-    except requests.exceptions.RequestException as e:
-        print("[STUN ERROR] Cannot reach STUN server")
-        return False
-
-def get_peer_info(username):
-    try:
-        r = requests.get(
-            f"{STUN_SERVER_URL}/peerinfo",
-            params={"username": username},
-            timeout=TIMEOUT
-        )
-
-        if r.status_code == 200:
-            data = r.json()
-            print(f"[STUN] Peer found: {data}")
-            return data
-
-        else:
-            print("[STUN] Peer not found")
-            return None, None
-
-    except requests.exceptions.RequestException:
-        print("[STUN ERROR] Cannot reach STUN server")
-        return None, None
-
-
-def get_peers():
-    try:
-        r = requests.get(
-            f"{STUN_SERVER_URL}/peers",
-            timeout=TIMEOUT
-        )
-
-        if r.status_code == 200:
-            peers = r.json()
-            usernames = peers['peers']
-            return usernames
-
-        else:
-            print("[STUN] Failed to fetch peers")
-            return []
-
-    except requests.exceptions.RequestException:
-        print("[STUN ERROR] Cannot reach STUN server")
-        return []
-
-def get_friends(username):
-    try:
-        r = requests.get(
-            f"{STUN_SERVER_URL}/friend/get/",
-            params={"username": username},
-            timeout=TIMEOUT
-        )
-
-        
-
-        if r.status_code == 200:
-            data = r.json()
-            data = data['friends']
-            friends = []
-            for friend in data:
-                friends.append(friend["username"])
-            return friends
-
-        else:
-            print("[STUN] Failed to fetch friends")
-            return []
-
-    except requests.exceptions.RequestException:
-        print("[STUN ERROR] Cannot reach STUN server")
-        return []
-
-def friendship(username1, username2):
-    payload = {
-        "user1": username1,
-        "user2": username2,
-    }
-
-    try:
-        r = requests.post(
-            f"{STUN_SERVER_URL}/friend/start/",
-            json=payload,
-            timeout=TIMEOUT
-        )
-
-        if r.status_code in (200, 201):
-            print("[STUN] friendship started successfully")
-            return True
-        else:
-            print("[STUN] friendship failed:", r.text)
-            return False
-
-    except requests.exceptions.RequestException as e:
-        print("[STUN ERROR] Cannot reach STUN server")
-        return False
-    
-def fetch_messages(username1, username2):
-    try:
-        r = requests.get(
-            f"{STUN_SERVER_URL}/message/get/",
-            params={"peer1": username1, "peer2": username2},
-            timeout=TIMEOUT
-        )
-
-        if r.status_code == 200:
-            data = r.json()
-            data = data['messages']
-            return data
-
-        else:
-            print("[STUN] Failed to fetch messages")
-            return []
-
-    except requests.exceptions.RequestException:
-        print("[STUN ERROR] Cannot reach STUN server")
-        return []
-
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+STUN_SERVER_URL = os.environ.get("STUN_SERVER_URL", "http://192.168.1.104:8000")
+TIMEOUT = 3
+CONNECT_TIMEOUT = 2
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 2.0
+POOL_SIZE = 10
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+PEER_CACHE_TTL = 300
+PEER_NEGATIVE_TTL = 30
+EXPORT_CHUNK = 64 * 1024
+PUSH_WAIT = 25
+RETRYABLE_STATUSES = (408, 429)  # 4xx answers that may succeed when sent again
+
+_NOT_FOUND = object()
+
+DIRECTORY_LATENCY = metrics.histogram(
+    "peer_directory_request_seconds", "STUN server call latency per endpoint, retries included"
+)
+DIRECTORY_ERRORS = metrics.counter(
+    "peer_directory_errors_total", "STUN server calls that failed, by endpoint and reason"
+)
+DIRECTORY_RETRIES = metrics.counter("peer_directory_retries_total", "STUN server call retries, by endpoint")
+
+
+class PeerAddressCache:
+    """
+    TTL cache of username -> peer info, with negative entries for unknown
+    usernames (kept for a shorter `negative_ttl`).
+    """
+
+    def __init__(self, ttl=PEER_CACHE_TTL, negative_ttl=PEER_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """Cached peer info, _NOT_FOUND for a cached miss, or None if unknown."""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[username]
+            self.misses += 1
+            return None
+
+    def put(self, username, info):
+        ttl = self.ttl if info is not _NOT_FOUND else self.negative_ttl
+        with self._lock:
+            self._entries[username] = (time.monotonic() + ttl, info)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+class StunClient:
+    """
+    Client for the STUN server REST API.
+
+    All calls share one requests.Session, so the TCP connection to the server
+    is kept alive and reused instead of being opened for every request.
+    Idempotent calls are retried on connection errors / 5xx responses with
+    exponential backoff and full jitter.
+    """
+
+    def __init__(self, base_url=STUN_SERVER_URL, timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+                 retries=MAX_RETRIES, backoff=BACKOFF_BASE, backoff_max=BACKOFF_MAX, pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.peer_cache = PeerAddressCache()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _sleep_backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt))))
+
+    def _request(self, method, path, idempotent=True, **kwargs):
+        with DIRECTORY_LATENCY.time(endpoint=path):
+            r = self._request_with_retries(method, path, idempotent, **kwargs)
+        if r.status_code >= 500:
+            DIRECTORY_ERRORS.inc(endpoint=path, reason=str(r.status_code))
+        return r
+
+    def _request_with_retries(self, method, path, idempotent, **kwargs):
+        url = f"{self.base_url}{path}"
+        attempts = self.retries + 1 if idempotent else 1
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            if attempt:
+                DIRECTORY_RETRIES.inc(endpoint=path)
+            try:
+                r = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if last_attempt:
+                    DIRECTORY_ERRORS.inc(endpoint=path, reason=type(e).__name__)
+                    raise
+                self._sleep_backoff(attempt)
+                continue
+
+            if r.status_code >= 500 and not last_attempt:
+                # Hand the connection back to the pool before retrying.
+                r.close()
+                self._sleep_backoff(attempt)
+                continue
+            return r
+
+    def _get(self, path, **kwargs):
+        return self._request("GET", path, idempotent=True, **kwargs)
+
+    def _post(self, path, idempotent=False, **kwargs):
+        return self._request("POST", path, idempotent=idempotent, **kwargs)
+
+    # -------- peers --------
+    def register(self, username, ip, port):
+        payload = {
+            "username": username,
+            "ip": ip,
+            "port": port
+        }
+
+        try:
+            # update_or_create on the server, safe to retry
+            r = self._post("/register", idempotent=True, json=payload)
+
+            if r.status_code in (200, 201):
+                print("[STUN] Registered successfully")
+                return True
+            else:
+                print("[STUN] Registration failed:", r.text)
+                return False
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return False
+
+    def _lookup_peer(self, username):
+        """Peer info, _NOT_FOUND if the server doesn't know it, None on errors."""
+        try:
+            r = self._get("/peerinfo", params={"username": username})
+
+            if r.status_code == 200:
+                return r.json()
+            elif r.status_code == 404:
+                return _NOT_FOUND
+            else:
+                return None
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return None
+
+    def get_peer_info(self, username):
+        data = self._lookup_peer(username)
+        if data is _NOT_FOUND or data is None:
+            print("[STUN] Peer not found")
+            return None
+
+        print(f"[STUN] Peer found: {data}")
+        self.peer_cache.put(username, data)
+        return data
+
+    def resolve_peer(self, username):
+        """
+        Cached address lookup. Unknown usernames are cached as misses too;
+        server errors are not cached.
+        """
+        data = self.peer_cache.get(username)
+        if data is None:
+            data = self._lookup_peer(username)
+            if data is None:
+                return None
+            self.peer_cache.put(username, data)
+
+        if data is _NOT_FOUND:
+            print("[STUN] Peer not found")
+            return None
+        return data
+
+    def invalidate_peer(self, username):
+        self.peer_cache.invalidate(username)
+
+    def get_peers(self):
+        try:
+            r = self._get("/peers")
+
+            if r.status_code == 200:
+                return r.json()["peers"]
+
+            else:
+                print("[STUN] Failed to fetch peers")
+                return []
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return []
+
+    def search_peers(self, prefix="", online=None, after=None, limit=PAGE_SIZE):
+        """
+        One directory page: {"peers": [{"username", "online", "last_seen"}],
+        "next"}. Pass `next` back as `after` for the following page.
+        """
+        params = {"limit": limit}
+        if prefix:
+            params["q"] = prefix
+        if online is not None:
+            params["online"] = int(bool(online))
+        if after:
+            params["after"] = after
+
+        try:
+            r = self._get("/directory/", params=params)
+
+            if r.status_code == 200:
+                return r.json()
+
+            else:
+                print("[STUN] Failed to search peers")
+                return None
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return None
+
+    def bootstrap(self, username, cursors=None, group_cursors=None):
+        """
+        Own peer info, friends and groups, with unread counts and latest
+        message ids, in one request. Returns None if the username is unknown.
+        """
+        payload = {
+            "username": username,
+            "cursors": cursors or {},
+            "group_cursors": group_cursors or {}
+        }
+
+        try:
+            # read only on the server, safe to retry
+            r = self._post("/session/bootstrap", idempotent=True, json=payload)
+
+            if r.status_code == 200:
+                return r.json()
+
+            elif r.status_code == 404:
+                return None
+
+            else:
+                print("[STUN] Bootstrap failed:", r.text)
+                return None
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return None
+
+    # -------- friends --------
+    def get_friends(self, username):
+        try:
+            r = self._get("/friend/get/", params={"username": username})
+
+            if r.status_code == 200:
+                return [friend["username"] for friend in r.json()["friends"]]
+
+            else:
+                print("[STUN] Failed to fetch friends")
+                return []
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return []
+
+    def friendship(self, username1, username2):
+        payload = {
+            "user1": username1,
+            "user2": username2,
+        }
+
+        try:
+            r = self._post("/friend/start/", json=payload)
+
+            if r.status_code in (200, 201):
+                print("[STUN] friendship started successfully")
+                return True
+            else:
+                print("[STUN] friendship failed:", r.text)
+                return False
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return False
+
+    # -------- groups --------
+    def _group_response(self, r, ok_statuses, action):
+        if r.status_code in ok_statuses:
+            members = r.json()["members"]
+            # Member addresses come for free, warm the address cache.
+            for member in members:
+                self.peer_cache.put(member["username"], member)
+            return members
+        print(f"[STUN] {action} failed:", r.text)
+        return None
+
+    def create_group(self, name, owner, members):
+        """Member list (with addresses) of the new group, or None."""
+        payload = {
+            "name": name,
+            "owner": owner,
+            "members": members
+        }
+
+        try:
+            r = self._post("/group/create/", json=payload)
+            return self._group_response(r, (201,), "Group creation")
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return None
+
+    def add_group_members(self, group, usernames):
+        payload = {
+            "group": group,
+            "usernames": usernames
+        }
+
+        try:
+            # memberships are only added once, safe to retry
+            r = self._post("/group/add/", idempotent=True, json=payload)
+            return self._group_response(r, (200,), "Adding members")
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return None
+
+    def get_group_members(self, group):
+        try:
+            r = self._get("/group/members/", params={"group": group})
+            return self._group_response(r, (200,), "Fetching group members")
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return None
+
+    # -------- messages --------
+    def save_message(self, sender, receiver, content):
+        payload = {
+            "sender": sender,
+            "receiver": receiver,
+            "content": content
+        }
+
+        try:
+            r = self._post("/message/create/", json=payload)
+
+            if r.status_code == 201:
+                return True
+            else:
+                print("[DB] Save failed:", r.text)
+                return False
+
+        except requests.exceptions.RequestException as e:
+            print("[DB ERROR]", e)
+            return False
+
+    def save_messages(self, messages):
+        """
+        Persist a batch of {"sender", "receiver" or "group", "content"} dicts in one request.
+
+        True once the server took the batch (items it rejected are reported
+        and dropped), None if it refused the whole batch (4xx: sending it
+        again can't help), False on network errors / 5xx, worth a retry.
+        """
+        try:
+            r = self._post("/message/bulk_create/", json={"messages": messages})
+
+            if r.status_code == 201:
+                for error in r.json().get("errors", []):
+                    print(f"[DB] Message not saved ({error['error']}):", messages[error["index"]]["content"])
+                return True
+            elif r.status_code < 500 and r.status_code not in RETRYABLE_STATUSES:
+                print("[DB] Bulk save rejected:", r.text)
+                return None
+            else:
+                print("[DB] Bulk save failed:", r.text)
+                return False
+
+        except requests.exceptions.RequestException as e:
+            print("[DB ERROR]", e)
+            return False
+
+    def fetch_message_page(self, username1, username2, before=None, after=None, limit=PAGE_SIZE):
+        """
+        One page of history: {"messages", "has_more", "oldest_id", "newest_id"}.
+
+        Without a cursor this is the most recent page.
+        """
+        return self._fetch_page({"peer1": username1, "peer2": username2}, before, after, limit)
+
+    def fetch_group_page(self, group, before=None, after=None, limit=PAGE_SIZE):
+        return self._fetch_page({"group": group}, before, after, limit)
+
+    def _fetch_page(self, params, before, after, limit):
+        params = dict(params, limit=limit)
+        if before is not None:
+            params["before"] = before
+        if after is not None:
+            params["after"] = after
+
+        try:
+            r = self._get("/message/get/", params=params)
+
+            if r.status_code == 200:
+                return r.json()
+
+            else:
+                print("[STUN] Failed to fetch messages")
+                return None
+
+        except requests.exceptions.RequestException:
+            print("[STUN ERROR] Cannot reach STUN server")
+            return None
+
+    def fetch_messages(self, username1, username2, after=None):
+        """All messages newer than `after` (the whole history if None), page by page."""
+        return self._fetch_all({"peer1": username1, "peer2": username2}, after)
+
+    def fetch_group_messages(self, group, after=None):
+        return self._fetch_all({"group": group}, after)
+
+    def export_messages(self, username, path, peer=None, group=None):
+        """
+        Stream the NDJSON history export straight into `path` (one
+        conversation with `peer` / `group`, else all of them). Returns the
+        number of messages, or None on failure.
+        """
+        params = {"username": username}
+        if peer:
+            params["peer"] = peer
+        if group:
+            params["group"] = group
+        partial = path + ".part"
+
+        try:
+            with self._get("/message/export/", params=params, stream=True) as r:
+                if r.status_code != 200:
+                    print("[STUN] Export failed:", r.text)
+                    return None
+                count = 0
+                with open(partial, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=EXPORT_CHUNK):
+                        f.write(chunk)
+                        count += chunk.count(b"\n")
+            os.replace(partial, path)
+            return count
+
+        except (requests.exceptions.RequestException, OSError) as e:
+            print("[STUN ERROR] Export failed:", e)
+            if os.path.exists(partial):
+                os.remove(partial)
+            return None
+
+    # -------- push --------
+    def poll_events(self, username, cursor=None, wait=PUSH_WAIT):
+        """
+        One /events/ long-poll: {"events", "cursor", "reset"} as soon as
+        something happened for `username`, or after `wait` seconds. None on
+        errors; not retried here, the push listener backs off itself.
+        """
+        params = {"username": username, "timeout": wait}
+        if cursor:
+            params["cursor"] = cursor
+        try:
+            # Bypasses _request: its latency histogram would only show the waits.
+            r = self.session.get(
+                f"{self.base_url}/events/", params=params, timeout=(self.timeout[0], wait + self.timeout[1])
+            )
+        except requests.exceptions.RequestException as e:
+            DIRECTORY_ERRORS.inc(endpoint="/events/", reason=type(e).__name__)
+            return None
+        if r.status_code != 200:
+            DIRECTORY_ERRORS.inc(endpoint="/events/", reason=str(r.status_code))
+            return None
+        return r.json()
+
+    def _fetch_all(self, params, after):
+        messages = []
+        cursor = after or 0
+        while True:
+            page = self._fetch_page(params, None, cursor, MAX_PAGE_SIZE)
+            if not page:
+                return messages
+            messages.extend(page["messages"])
+            if not page["has_more"] or not page["messages"]:
+                return messages
+            cursor = page["newest_id"]
+
+
+class AsyncStunClient:
+    """
+    asyncio wrapper around StunClient.
+
+    Calls run on a small thread pool sharing the pooled session, so several
+    lookups can be awaited concurrently, e.g.
+    `await asyncio.gather(client.get_peer_info("a"), client.get_peer_info("b"))`.
+    """
+
+    def __init__(self, client=None, max_workers=POOL_SIZE):
+        self.client = client or StunClient()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stun")
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def register(self, username, ip, port):
+        return await self._call(self.client.register, username, ip, port)
+
+    async def get_peer_info(self, username):
+        return await self._call(self.client.get_peer_info, username)
+
+    async def resolve_peer(self, username):
+        return await self._call(self.client.resolve_peer, username)
+
+    async def get_peers(self):
+        return await self._call(self.client.get_peers)
+
+    async def search_peers(self, prefix="", online=None, after=None, limit=PAGE_SIZE):
+        return await self._call(self.client.search_peers, prefix, online, after, limit)
+
+    async def bootstrap(self, username, cursors=None, group_cursors=None):
+        return await self._call(self.client.bootstrap, username, cursors, group_cursors)
+
+    async def get_friends(self, username):
+        return await self._call(self.client.get_friends, username)
+
+    async def friendship(self, username1, username2):
+        return await self._call(self.client.friendship, username1, username2)
+
+    async def save_message(self, sender, receiver, content):
+        return await self._call(self.client.save_message, sender, receiver, content)
+
+    async def save_messages(self, messages):
+        return await self._call(self.client.save_messages, messages)
+
+    async def fetch_message_page(self, username1, username2, before=None, after=None, limit=PAGE_SIZE):
+        return await self._call(self.client.fetch_message_page, username1, username2, before, after, limit)
+
+    async def fetch_messages(self, username1, username2, after=None):
+        return await self._call(self.client.fetch_messages, username1, username2, after)
+
+    async def fetch_group_page(self, group, before=None, after=None, limit=PAGE_SIZE):
+        return await self._call(self.client.fetch_group_page, group, before, after, limit)
+
+    async def fetch_group_messages(self, group, after=None):
+        return await self._call(self.client.fetch_group_messages, group, after)
+
+    async def get_group_members(self, group):
+        return await self._call(self.client.get_group_members, group)
+
+    async def get_peer_infos(self, usernames):
+        results = await asyncio.gather(*(self.get_peer_info(u) for u in usernames))
+        return dict(zip(usernames, results))
+
+
+# ===============================
+# MODULE LEVEL API
+# ===============================
+stun_client = StunClient()
+
+
+def configure(base_url=STUN_SERVER_URL, **kwargs):
+    global stun_client
+    stun_client.close()
+    stun_client = StunClient(base_url, **kwargs)
+    return stun_client
+
+
+def server_host():
+    """Host name of the configured STUN server (for its UDP services)."""
+    return urlparse(stun_client.base_url).hostname
+
+
+def register(username, ip, port):
+    return stun_client.register(username, ip, port)
+
+
+def get_peer_info(username):
+    return stun_client.get_peer_info(username)
+
+
+def resolve_peer(username):
+    return stun_client.resolve_peer(username)
+
+
+def invalidate_peer(username):
+    stun_client.invalidate_peer(username)
+
+
+def peer_cache_stats():
+    return stun_client.peer_cache.stats()
+
+
+def get_peers():
+    return stun_client.get_peers()
+
+
+def search_peers(prefix="", online=None, after=None, limit=PAGE_SIZE):
+    return stun_client.search_peers(prefix, online, after, limit)
+
+
+def bootstrap(username, cursors=None, group_cursors=None):
+    return stun_client.bootstrap(username, cursors, group_cursors)
+
+
+def get_friends(username):
+    return stun_client.get_friends(username)
+
+
+def friendship(username1, username2):
+    return stun_client.friendship(username1, username2)
+
+
+def save_message(sender, receiver, content):
+    return stun_client.save_message(sender, receiver, content)
+
+
+def save_messages(messages):
+    return stun_client.save_messages(messages)
+
+
+def fetch_message_page(username1, username2, before=None, after=None, limit=PAGE_SIZE):
+    return stun_client.fetch_message_page(username1, username2, before, after, limit)
+
+
+def fetch_messages(username1, username2, after=None):
+    return stun_client.fetch_messages(username1, username2, after)
+
+
+def create_group(name, owner, members):
+    return stun_client.create_group(name, owner, members)
+
+
+def add_group_members(group, usernames):
+    return stun_client.add_group_members(group, usernames)
+
+
+def get_group_members(group):
+    return stun_client.get_group_members(group)
+
+
+def fetch_group_page(group, before=None, after=None, limit=PAGE_SIZE):
+    return stun_client.fetch_group_page(group, before, after, limit)
+
+
+def fetch_group_messages(group, after=None):
+    return stun_client.fetch_group_messages(group, after)
+
+
+def export_messages(username, path, peer=None, group=None):
+    return stun_client.export_messages(username, path, peer, group)
+
+
+def poll_events(username, cursor=None, wait=PUSH_WAIT):
+    return stun_client.poll_events(username, cursor, wait)
@@ -0,0 +1,98 @@
+import json
+import threading
+import zlib
+
+from protocol import MAX_PAYLOAD_SIZE, Frame, ProtocolError, encode_frame
+
+# Frame header flag: the payload is a zlib stream segment.
+FLAG_COMPRESSED = 0x01
+
+COMPRESSION = "zlib"
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD = 64  # payloads shorter than this go out uncompressed
+
+# Shared preset dictionary. Both sides must use the exact same bytes, so it
+# is negotiated by id and a change needs a new DICTIONARY_ID.
+DICTIONARY_ID = 1
+ZDICT = (
+    b"https://www. .com thanks thank you please sorry okay ok yes no maybe "
+    b"what when where why how who are you doing today tomorrow tonight "
+    b"morning evening meeting call later soon now just really sure great "
+    b"good nice cool awesome love see you let me know I think I will "
+    b"I'm you're we're it's that's don't can't won't didn't "
+    b"hello hi hey bye good night have a good day how are you "
+    b"the and for with this that have from your about would could should "
+)
+
+# Marker that ends every Z_SYNC_FLUSH segment; stripped on the wire.
+_SYNC_TAIL = b"\x00\x00\xff\xff"
+
+
+def offer():
+    """Capabilities a dialer announces right after its HELLO."""
+    return json.dumps({"compression": [COMPRESSION], "dictionary": DICTIONARY_ID}).encode()
+
+
+def negotiate(payload):
+    """Pick what both sides support from a peer's offer; returns (answer, enabled)."""
+    try:
+        caps = json.loads(payload.decode())
+    except (UnicodeDecodeError, ValueError):
+        raise ProtocolError("malformed capabilities frame")
+    enabled = COMPRESSION in caps.get("compression", ()) and caps.get("dictionary") == DICTIONARY_ID
+    answer = {"compression": COMPRESSION if enabled else None, "dictionary": DICTIONARY_ID}
+    return json.dumps(answer).encode(), enabled
+
+
+def accepted(payload):
+    """True if a responder's answer enables compression."""
+    try:
+        caps = json.loads(payload.decode())
+    except (UnicodeDecodeError, ValueError):
+        raise ProtocolError("malformed capabilities frame")
+    return caps.get("compression") == COMPRESSION and caps.get("dictionary") == DICTIONARY_ID
+
+
+class FrameCodec:
+    """
+    Per-connection streaming compression, one zlib stream per direction.
+
+    Compressed frames share the stream history, so repeated words and
+    phrases across messages cost a few bits each. Frames must be encoded
+    and decoded in the order they go over the wire; callers hold their
+    send lock (or run on the connection's loop) around `encode`.
+    """
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self._compressor = zlib.compressobj(level, zdict=ZDICT)
+        self._decompressor = zlib.decompressobj(zdict=ZDICT)
+        self._decode_lock = threading.Lock()
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def encode(self, msg_type, payload=b"", flags=0):
+        if len(payload) < self.threshold:
+            return encode_frame(msg_type, payload, flags)
+        data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_SYNC_TAIL):
+            data = data[:-len(_SYNC_TAIL)]
+        self.raw_bytes += len(payload)
+        self.wire_bytes += len(data)
+        return encode_frame(msg_type, data, flags | FLAG_COMPRESSED)
+
+    def decode(self, frame):
+        if not frame.flags & FLAG_COMPRESSED:
+            return frame
+        with self._decode_lock:
+            try:
+                payload = self._decompressor.decompress(frame.payload + _SYNC_TAIL, MAX_PAYLOAD_SIZE)
+            except zlib.error as e:
+                raise ProtocolError(f"corrupt compressed frame: {e}")
+            if self._decompressor.unconsumed_tail:
+                raise ProtocolError("compressed frame too large")
+        return Frame(frame.type, frame.flags & ~FLAG_COMPRESSED, payload)
+
+    @property
+    def ratio(self):
+        return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
@@ -0,0 +1,399 @@
+import asyncio
+import random
+import socket
+import threading
+import time
+
+import compression
+import metrics
+from protocol import FRAME_NAMES, HEADER_SIZE, MSG_CAPS, MSG_FILE_CHUNK, MSG_HELLO, FrameReader, ProtocolError, encode_frame
+
+CONNECT_TIMEOUT = 3
+CONNECT_ATTEMPTS = 3
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 2.0
+SEND_TIMEOUT = 5
+FILE_SEND_TIMEOUT = 60
+
+FRAMES_SENT = metrics.counter("peer_frames_sent_total", "Frames sent to peers, by type")
+FRAMES_RECEIVED = metrics.counter("peer_frames_received_total", "Frames received from peers, by type")
+BYTES_SENT = metrics.counter("peer_bytes_sent_total", "Bytes written to peer connections (after compression)")
+BYTES_RECEIVED = metrics.counter("peer_bytes_received_total", "Bytes read from peer connections (before decompression)")
+DIALS = metrics.counter("peer_dials_total", "Outbound connection attempts, by result")
+
+
+def tune_socket(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class PeerConnection:
+    """
+    A duplex connection to one peer, usable for sending from any thread.
+
+    The dialer follows its HELLO with a MSG_CAPS offer; the responder answers
+    once and both sides then compress frames (see compression.py). Older
+    peers ignore the offer and never answer, so the link stays uncompressed.
+    """
+
+    # False for datagram paths (udp_transport.py): no ordering, no retransmits.
+    reliable = True
+
+    def __init__(self, username, outbound):
+        self.username = username
+        self.outbound = outbound
+        self.closed = False
+        self.codec = None
+
+    @property
+    def alive(self):
+        return not self.closed
+
+    def _encode(self, frames):
+        # Runs in wire order: under the send lock or on the connection's loop.
+        encode = self.codec.encode if self.codec else encode_frame
+        data = b"".join(encode(msg_type, payload, flags) for msg_type, payload, flags in frames)
+        for msg_type, _, _ in frames:
+            FRAMES_SENT.inc(type=FRAME_NAMES.get(msg_type, msg_type))
+        BYTES_SENT.inc(len(data))
+        return data
+
+    @staticmethod
+    def _count_chunk(header, count):
+        FRAMES_SENT.inc(type=FRAME_NAMES[MSG_FILE_CHUNK])
+        BYTES_SENT.inc(len(header) + count)
+
+    def _send_frames(self, frames, codec=None):
+        """Write `frames` in order, then switch to `codec` if given."""
+        raise NotImplementedError
+
+    def send(self, msg_type, payload=b"", flags=0):
+        self._send_frames([(msg_type, payload, flags)])
+
+    def send_many(self, frames):
+        self._send_frames([(msg_type, payload, 0) for msg_type, payload in frames])
+
+    def send_file_chunk(self, header, file, offset, count):
+        """Send a prebuilt chunk header, then `count` bytes of `file` zero-copy."""
+        raise NotImplementedError
+
+    def receive(self, frame):
+        """Decode an incoming frame; returns None for handshake frames."""
+        FRAMES_RECEIVED.inc(type=FRAME_NAMES.get(frame.type, frame.type))
+        BYTES_RECEIVED.inc(HEADER_SIZE + len(frame.payload))
+        if frame.type == MSG_CAPS:
+            if self.outbound:
+                if compression.accepted(frame.payload):
+                    self._send_frames([], codec=compression.FrameCodec())
+            else:
+                answer, enabled = compression.negotiate(frame.payload)
+                codec = compression.FrameCodec() if enabled else None
+                self._send_frames([(MSG_CAPS, answer, 0)], codec=codec)
+            return None
+        if frame.flags & compression.FLAG_COMPRESSED:
+            if self.codec is None:
+                raise ProtocolError("compressed frame on an uncompressed connection")
+            return self.codec.decode(frame)
+        return frame
+
+    def close(self):
+        self.closed = True
+
+
+class SocketConnection(PeerConnection):
+    """Blocking socket; frames are read by `read_loop()` (own thread or caller's)."""
+
+    def __init__(self, sock, username, reader, outbound, on_frame, on_close, buffer_size=65536):
+        super().__init__(username, outbound)
+        self.sock = sock
+        self.reader = reader or FrameReader(sock, buffer_size)
+        self.on_frame = on_frame
+        self.on_close = on_close
+        self._send_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.read_loop, name=f"peer-{self.username}", daemon=True).start()
+        return self
+
+    def _send_frames(self, frames, codec=None):
+        with self._send_lock:
+            if frames:
+                self.sock.sendall(self._encode(frames))
+            if codec:
+                self.codec = codec
+
+    def send_file_chunk(self, header, file, offset, count):
+        # Holding the lock for one chunk only lets text frames in between.
+        with self._send_lock:
+            self.sock.sendall(header)
+            sent = self.sock.sendfile(file, offset, count)
+        self._count_chunk(header, sent)
+        if sent != count:
+            raise ConnectionError(f"short sendfile ({sent} of {count} bytes)")
+
+    def read_loop(self):
+        try:
+            for frame in self.reader:
+                frame = self.receive(frame)
+                if frame is not None:
+                    self.on_frame(self.username, frame)
+            if not self.closed:
+                print(f"⚪ [INFO] {self.username} disconnected")
+        except ConnectionResetError:
+            print(f"⚪ [INFO] {self.username} connection reset")
+        except ProtocolError as e:
+            print(f"⚠️ [PROTOCOL ERROR] {self.username}: {e}")
+        except OSError:
+            # closed locally
+            pass
+        except Exception as e:
+            print(f"⚠️ [CONNECTION ERROR] {self.username}: {e}")
+        finally:
+            self.close()
+            self.on_close(self)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class StreamConnection(PeerConnection):
+    """An inbound asyncio stream, written to from other threads through its loop."""
+
+    def __init__(self, writer, loop, username):
+        super().__init__(username, outbound=False)
+        self.writer = writer
+        self.loop = loop
+        self._held = None
+        self._sendfile_lock = asyncio.Lock()
+
+    @property
+    def alive(self):
+        return not self.closed and not self.writer.is_closing()
+
+    def _write_now(self, frames, codec):
+        # Encoding and writing happen in one loop step, so frames from
+        # different threads keep the order the compressor saw them in.
+        if frames:
+            data = self._encode(frames)
+            if self._held is not None:
+                # The transport refuses writes while a sendfile is running.
+                self._held.append(data)
+            else:
+                self.writer.write(data)
+        if codec:
+            self.codec = codec
+
+    async def _sendfile(self, header, file, offset, count):
+        async with self._sendfile_lock:
+            self.writer.write(header)
+            self._held = []
+            try:
+                sent = await self.loop.sendfile(self.writer.transport, file, offset, count)
+            finally:
+                held, self._held = self._held, None
+                for data in held:
+                    self.writer.write(data)
+            await self.writer.drain()
+        self._count_chunk(header, sent)
+        if sent != count:
+            raise ConnectionError(f"short sendfile ({sent} of {count} bytes)")
+
+    def send_file_chunk(self, header, file, offset, count):
+        if not self.alive:
+            raise ConnectionResetError(f"connection to {self.username} is closed")
+        future = asyncio.run_coroutine_threadsafe(self._sendfile(header, file, offset, count), self.loop)
+        future.result(FILE_SEND_TIMEOUT)
+
+    async def _write(self, frames, codec):
+        self._write_now(frames, codec)
+        await self.writer.drain()
+
+    def _send_frames(self, frames, codec=None):
+        if not self.alive:
+            raise ConnectionResetError(f"connection to {self.username} is closed")
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            # Called from a frame handler on the loop itself (e.g. an ack).
+            self._write_now(frames, codec)
+            return
+        future = asyncio.run_coroutine_threadsafe(self._write(frames, codec), self.loop)
+        future.result(SEND_TIMEOUT)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class ConnectionManager:
+    """
+    Keeps one healthy duplex connection per peer and reuses it across chat
+    sessions, whichever side opened it.
+
+    If both peers dial each other at the same time, both keep the
+    connection opened by the peer whose username sorts first, so they agree
+    on which one to drop. Sends over a broken connection reconnect with
+    backoff and are retried once.
+
+    With `resolve`/`invalidate` (cached address lookups) a failed dial drops
+    the cached address and retries once if the peer has moved. With
+    `punch(username)`, a peer that can't be dialed at all (e.g. behind a
+    NAT) is then reached over a UDP hole-punched path; a TCP connection
+    replaces that path whenever one comes up.
+    """
+
+    def __init__(self, my_username, on_frame, buffer_size=65536, connect_timeout=CONNECT_TIMEOUT,
+                 attempts=CONNECT_ATTEMPTS, backoff=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 resolve=None, invalidate=None, punch=None):
+        self.my_username = my_username
+        self.on_frame = on_frame
+        self.resolve = resolve
+        self.invalidate = invalidate
+        self.punch = punch
+        self.buffer_size = buffer_size
+        self.connect_timeout = connect_timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+        self._conns = {}
+        self._lock = threading.Lock()
+        self._dial_locks = {}
+
+    # -------- registry --------
+    def _preferred(self, a, b):
+        initiator_wins = min(self.my_username, a.username)
+
+        def initiator(conn):
+            return self.my_username if conn.outbound else conn.username
+
+        return a if initiator(a) == initiator_wins else b
+
+    def register(self, conn):
+        """Add a connection; returns the connection that stays in use."""
+        loser = None
+        with self._lock:
+            current = self._conns.get(conn.username)
+            if current is None or not current.alive or current is conn:
+                self._conns[conn.username] = conn
+                keep = conn
+            elif current.reliable != conn.reliable:
+                keep = current if current.reliable else conn
+                loser = conn if keep is current else current
+                self._conns[conn.username] = keep
+            else:
+                keep = self._preferred(current, conn)
+                loser = conn if keep is current else current
+                self._conns[conn.username] = keep
+        if loser is not None and loser.outbound and loser.reliable:
+            # Only the dialing side closes, the other side sees the EOF.
+            # A UDP path stays open, the other side may still be using it.
+            loser.close()
+        return keep
+
+    def remove(self, conn):
+        with self._lock:
+            if self._conns.get(conn.username) is conn:
+                del self._conns[conn.username]
+
+    def get(self, username):
+        with self._lock:
+            conn = self._conns.get(username)
+        return conn if conn is not None and conn.alive else None
+
+    def active(self):
+        with self._lock:
+            return [conn for conn in self._conns.values() if conn.alive]
+
+    def close_all(self):
+        with self._lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for conn in conns:
+            conn.close()
+
+    # -------- outbound --------
+    def adopt_socket(self, sock, username, reader, outbound):
+        tune_socket(sock)
+        return SocketConnection(sock, username, reader, outbound, self.on_frame, self.remove, self.buffer_size)
+
+    def _dial(self, peer):
+        last_error = None
+        for attempt in range(self.attempts):
+            if attempt:
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt))))
+            try:
+                sock = socket.create_connection((peer["ip"], peer["port"]), timeout=self.connect_timeout)
+                sock.settimeout(None)
+                conn = self.adopt_socket(sock, peer["username"], None, outbound=True)
+                conn.send_many([(MSG_HELLO, self.my_username.encode()), (MSG_CAPS, compression.offer())])
+                DIALS.inc(result="ok")
+                return conn
+            except OSError as e:
+                DIALS.inc(result="failed")
+                last_error = e
+        raise last_error
+
+    def _dial_resolved(self, peer):
+        try:
+            return self._dial(peer)
+        except OSError:
+            if not (self.resolve and self.invalidate):
+                raise
+            username = peer["username"]
+            self.invalidate(username)
+            fresh = self.resolve(username)
+            if not fresh or (fresh["ip"], fresh["port"]) == (peer["ip"], peer["port"]):
+                raise
+            return self._dial(fresh)
+
+    def connect(self, peer):
+        """Existing healthy connection to `peer`, or a new one."""
+        username = peer["username"]
+        conn = self.get(username)
+        if conn:
+            return conn
+
+        with self._lock:
+            dial_lock = self._dial_locks.setdefault(username, threading.Lock())
+        with dial_lock:
+            conn = self.get(username)
+            if conn:
+                return conn
+            try:
+                conn = self._dial_resolved(peer)
+            except OSError as e:
+                if self.punch is None:
+                    raise
+                try:
+                    conn = self.punch(username)
+                except OSError:
+                    raise e from None
+            keep = self.register(conn)
+            if keep is conn:
+                conn.start()
+            return keep
+
+    def send(self, peer, msg_type, payload=b"", flags=0):
+        """Send one frame, transparently reconnecting once if the link broke."""
+        conn = self.connect(peer)
+        try:
+            conn.send(msg_type, payload, flags)
+        except (OSError, asyncio.TimeoutError, TimeoutError):
+            conn.close()
+            self.remove(conn)
+            conn = self.connect(peer)
+            conn.send(msg_type, payload, flags)
+        return conn
@@ -0,0 +1,130 @@
+import sys
+import threading
+from collections import OrderedDict, deque
+
+CONVERSATION_CAPACITY = 200
+MEMORY_BUDGET = 8 * 1024 * 1024
+
+
+class MessageRecord:
+    """One chat message; sender names are interned so they are shared."""
+
+    __slots__ = ("id", "sender", "text")
+
+    def __init__(self, id, sender, text):
+        self.id = id
+        self.sender = sys.intern(sender)
+        self.text = text
+
+    def __repr__(self):
+        return f"MessageRecord({self.id!r}, {self.sender!r}, {self.text!r})"
+
+
+RECORD_SIZE = sys.getsizeof(MessageRecord(None, "", ""))
+
+
+def record_size(record):
+    return RECORD_SIZE + sys.getsizeof(record.text)
+
+
+class ConversationStore:
+    """
+    In-memory recent history, one fixed-size ring per conversation.
+
+    Each conversation keeps its last `capacity` messages. When the estimated
+    size of all conversations goes over `memory_budget`, whole conversations
+    are evicted, least recently used first. An evicted conversation is
+    reloaded through `loader(peer)` (e.g. the local store) the next time it
+    is accessed.
+    """
+
+    def __init__(self, capacity=CONVERSATION_CAPACITY, memory_budget=MEMORY_BUDGET, loader=None):
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self.evictions = 0
+
+        self._conversations = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    # -------- internals --------
+    def _ring(self, peer):
+        ring = self._conversations.get(peer)
+        if ring is None:
+            ring = deque(maxlen=self.capacity)
+            self._conversations[peer] = ring
+            self._sizes[peer] = 0
+            if self.loader:
+                for record in self.loader(peer):
+                    self._push(peer, ring, record)
+        self._conversations.move_to_end(peer)
+        return ring
+
+    def _push(self, peer, ring, record):
+        if len(ring) == ring.maxlen:
+            dropped = record_size(ring[0])
+            self._sizes[peer] -= dropped
+            self._bytes -= dropped
+        ring.append(record)
+        size = record_size(record)
+        self._sizes[peer] += size
+        self._bytes += size
+
+    def _evict(self, keep):
+        while self._bytes > self.memory_budget and len(self._conversations) > 1:
+            peer = next(iter(self._conversations))
+            if peer == keep:
+                self._conversations.move_to_end(peer)
+                peer = next(iter(self._conversations))
+            del self._conversations[peer]
+            self._bytes -= self._sizes.pop(peer)
+            self.evictions += 1
+
+    # -------- API --------
+    def append(self, peer, sender, text, id=None):
+        with self._lock:
+            self._push(peer, self._ring(peer), MessageRecord(id, sender, text))
+            self._evict(keep=peer)
+
+    def extend(self, peer, records):
+        with self._lock:
+            ring = self._ring(peer)
+            for record in records:
+                self._push(peer, ring, record)
+            self._evict(keep=peer)
+
+    def recent(self, peer, limit=None):
+        """Most recent messages of a conversation, oldest first."""
+        with self._lock:
+            records = list(self._ring(peer))
+        return records[-limit:] if limit else records
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._conversations))
+
+    def __contains__(self, peer):
+        return peer in self._conversations
+
+    def __len__(self):
+        return len(self._conversations)
+
+    @property
+    def memory_usage(self):
+        return self._bytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "conversations": len(self._conversations),
+                "messages": sum(len(ring) for ring in self._conversations.values()),
+                "bytes": self._bytes,
+                "evictions": self.evictions,
+            }
+
+    def __repr__(self):
+        stats = self.stats()
+        return (f"<ConversationStore {stats['conversations']} conversations, "
+                f"{stats['messages']} messages, ~{stats['bytes'] // 1024} KiB>")
@@ -0,0 +1,399 @@
+import hashlib
+import json
+import mmap
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+import zlib
+
+from local_store import STORE_DIR
+from protocol import (
+    MSG_FILE_CHUNK, MSG_FILE_DONE, MSG_FILE_OFFER, MSG_FILE_RESUME,
+    ProtocolError, decode_file_chunk, encode_file_chunk_header,
+)
+
+CHUNK_SIZE = 256 * 1024
+DOWNLOAD_DIR = os.path.join(STORE_DIR, "downloads")
+MAX_FILE_SIZE = 256 * 1024 * 1024  # larger offers are rejected, not preallocated
+FREE_SPACE_MARGIN = 64 * 1024 * 1024  # left free on the disk after preallocating
+PROGRESS_INTERVAL = 4 * 1024 * 1024  # persist the receive offset this often
+REPLY_TIMEOUT = 15
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10.0
+FINISHED_IDS = 1000
+
+
+class TransferError(Exception):
+    pass
+
+
+class TransferRejected(TransferError):
+    pass
+
+
+def transfer_id(peer_username, path, stat):
+    """Stable id for (receiver, file version), so a re-sent file resumes."""
+    key = f"{peer_username}\0{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).digest()[:16]
+
+
+def _safe_name(name, what):
+    """`name` if it can be used as one path component under the download directory."""
+    if (not name or "\0" in name or ".." in name or os.path.isabs(name)
+            or os.sep in name or (os.altsep and os.altsep in name)):
+        raise ValueError(f"invalid {what} {name!r}")
+    return name
+
+
+def _json(payload):
+    try:
+        return json.loads(bytes(payload).decode())
+    except (UnicodeDecodeError, ValueError):
+        raise ProtocolError("malformed file transfer frame")
+
+
+class OutgoingFile:
+    def __init__(self, peer, path):
+        self.peer = peer
+        self.path = path
+        self.name = os.path.basename(path)
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.id = transfer_id(peer["username"], path, stat)
+        self.sent = 0
+        self.replies = queue.Queue()  # ("resume", offset) | ("done", ok) | ("error", reason)
+
+
+class IncomingFile:
+    """A .part file preallocated to its final size and written through mmap."""
+
+    def __init__(self, transfer_id, peer, name, path, size, received=0):
+        self.id = transfer_id
+        self.peer = peer
+        self.name = name
+        self.path = path
+        self.size = size
+        self.received = received
+        self.persisted = received
+        self.rewind_requested = False
+
+        part = path + ".part"
+        fresh = not os.path.exists(part)
+        self._file = open(part, "w+b" if fresh else "r+b")
+        if os.fstat(self._file.fileno()).st_size != size:
+            self._file.truncate(size)
+            if hasattr(os, "posix_fallocate") and size:
+                try:
+                    os.posix_fallocate(self._file.fileno(), 0, size)
+                except OSError:
+                    pass  # sparse file then
+        self._map = mmap.mmap(self._file.fileno(), size) if size else None
+
+    def write(self, offset, data):
+        self._map[offset:offset + len(data)] = data
+        self.received = offset + len(data)
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def finish(self):
+        self.close()
+        os.replace(self.path + ".part", self.path)
+
+
+class FileTransfers:
+    """
+    Peer to peer file transfer over the existing chat connection.
+
+    The sender offers a file (MSG_FILE_OFFER), the receiver answers with the
+    offset to start from (MSG_FILE_RESUME), then chunks are streamed with
+    `sendfile`, one CHUNK_SIZE frame at a time, so text frames are
+    interleaved between chunks instead of waiting for the whole file. Each
+    chunk carries a CRC32; a bad or out of order chunk makes the receiver
+    ask for a resume from its last verified offset.
+
+    The receiver writes into a preallocated `.part` file through mmap and
+    records its offset in the local store, so a transfer interrupted by a
+    disconnect (or a restart) continues where it stopped when the same file
+    is offered again.
+    """
+
+    def __init__(self, store, connections, resolve, download_dir=DOWNLOAD_DIR, chunk_size=CHUNK_SIZE,
+                 max_size=MAX_FILE_SIZE):
+        self.store = store
+        self.connections = connections
+        self.resolve = resolve
+        self.download_dir = download_dir
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+
+        self._outgoing = {}
+        self._incoming = {}
+        self._finished = []
+        self._lock = threading.Lock()
+        self._running = True
+
+    # -------- sending --------
+    def send(self, peer, path):
+        """Start sending `path` to `peer` in the background."""
+        transfer = OutgoingFile(peer, path)
+        with self._lock:
+            if transfer.id in self._outgoing:
+                raise TransferError(f"{transfer.name} is already being sent to {peer['username']}")
+            self._outgoing[transfer.id] = transfer
+        threading.Thread(target=self._send, args=(transfer,), name=f"file-{transfer.name}", daemon=True).start()
+        return transfer
+
+    def _send(self, transfer):
+        username = transfer.peer["username"]
+        failures = 0
+        try:
+            with open(transfer.path, "rb") as file:
+                view = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if transfer.size else b""
+                try:
+                    while self._running:
+                        progress = transfer.sent
+                        try:
+                            if self._deliver(transfer, file, view):
+                                print(f"✅ [FILE] {transfer.name} delivered to {username}")
+                                return
+                            if self._running:
+                                raise TransferError("receiver could not complete the file")
+                        except TransferRejected:
+                            raise
+                        except (OSError, TimeoutError, TransferError) as e:
+                            failures = 0 if transfer.sent > progress else failures + 1
+                            if failures > MAX_RETRIES:
+                                raise
+                            print(f"⚠️ [FILE] {transfer.name} to {username} interrupted ({e}), resuming...")
+                            time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** failures)))
+                finally:
+                    if transfer.size:
+                        view.close()
+        except Exception as e:
+            print(f"❌ [FILE] Sending {transfer.name} to {username} failed: {e}")
+        finally:
+            with self._lock:
+                self._outgoing.pop(transfer.id, None)
+
+    def _deliver(self, transfer, file, view):
+        """One attempt on one connection; True once the receiver confirmed."""
+        conn = self.connections.get(transfer.peer["username"])
+        if conn is None:
+            peer = self.resolve(transfer.peer["username"]) or transfer.peer
+            conn = self.connections.connect(peer)
+
+        while not transfer.replies.empty():
+            transfer.replies.get_nowait()
+        conn.send(MSG_FILE_OFFER, json.dumps({
+            "id": transfer.id.hex(),
+            "name": transfer.name,
+            "size": transfer.size,
+            "chunk_size": self.chunk_size,
+        }).encode())
+        kind, offset = self._reply(transfer)
+        if kind == "done":
+            return offset  # received completely before
+
+        while True:
+            while offset < transfer.size:
+                if not self._running:
+                    return False
+                rewind = self._pending_rewind(transfer)
+                if rewind is not None:
+                    offset = rewind
+                    continue
+                count = min(self.chunk_size, transfer.size - offset)
+                crc = zlib.crc32(memoryview(view)[offset:offset + count])
+                conn.send_file_chunk(encode_file_chunk_header(transfer.id, offset, crc, count), file, offset, count)
+                offset += count
+                transfer.sent = max(transfer.sent, offset)
+
+            conn.send(MSG_FILE_DONE, json.dumps({"id": transfer.id.hex()}).encode())
+            kind, value = self._reply(transfer)
+            if kind == "done":
+                return value
+            offset = value  # the receiver is missing data, continue from there
+
+    def _reply(self, transfer):
+        try:
+            kind, value = transfer.replies.get(timeout=REPLY_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError("no answer from receiver")
+        if kind == "error":
+            raise TransferRejected(f"rejected by receiver: {value}")
+        return kind, value
+
+    def _pending_rewind(self, transfer):
+        rewind = None
+        while not transfer.replies.empty():
+            kind, value = transfer.replies.get_nowait()
+            if kind == "error":
+                raise TransferRejected(f"rejected by receiver: {value}")
+            if kind == "resume":
+                rewind = value
+        return rewind
+
+    # -------- receiving --------
+    def handle(self, peer_username, frame):
+        """Dispatch one file transfer frame from `peer_username`."""
+        if frame.type == MSG_FILE_CHUNK:
+            self._on_chunk(peer_username, *decode_file_chunk(frame.payload))
+            return
+
+        message = _json(frame.payload)
+        tid = bytes.fromhex(message["id"])
+        if frame.type == MSG_FILE_OFFER:
+            self._on_offer(peer_username, tid, message)
+        elif frame.type == MSG_FILE_DONE and "ok" not in message:
+            self._on_done(peer_username, tid)
+        else:
+            # Answers for one of our own transfers.
+            with self._lock:
+                transfer = self._outgoing.get(tid)
+            if transfer is None:
+                return
+            if frame.type == MSG_FILE_RESUME:
+                if "error" in message:
+                    transfer.replies.put(("error", message["error"]))
+                else:
+                    transfer.replies.put(("resume", int(message["offset"])))
+            else:
+                transfer.replies.put(("done", bool(message["ok"])))
+
+    def _answer(self, peer_username, msg_type, message):
+        conn = self.connections.get(peer_username)
+        if conn:
+            try:
+                conn.send(msg_type, json.dumps(message).encode())
+            except OSError:
+                pass
+
+    def _on_offer(self, peer_username, tid, offer):
+        with self._lock:
+            incoming = self._incoming.get(tid)
+            finished = tid in self._finished
+        if finished:
+            self._answer(peer_username, MSG_FILE_DONE, {"id": tid.hex(), "ok": True})
+            return
+        if incoming is None:
+            try:
+                incoming = self._open(peer_username, tid, offer)
+            except (OSError, ValueError, KeyError) as e:
+                self._answer(peer_username, MSG_FILE_RESUME, {"id": tid.hex(), "error": str(e)})
+                return
+            with self._lock:
+                self._incoming[tid] = incoming
+            if incoming.received:
+                print(f"📥 [FILE] Resuming {incoming.name} from {peer_username} at {incoming.received} bytes")
+            else:
+                print(f"📥 [FILE] Receiving {incoming.name} ({incoming.size} bytes) from {peer_username}")
+        incoming.rewind_requested = False
+        self._answer(peer_username, MSG_FILE_RESUME, {"id": tid.hex(), "offset": incoming.received})
+
+    def _open(self, peer_username, tid, offer):
+        size = int(offer["size"])
+        if not 0 <= size <= self.max_size:
+            raise ValueError(f"file too large ({size} bytes)")
+
+        saved = self.store.incoming_file(tid.hex())
+        if saved and saved[0] == peer_username and os.path.exists(saved[2] + ".part"):
+            _, name, path, saved_size, received = saved
+            if saved_size == size:
+                return IncomingFile(tid, peer_username, name, path, size, received)
+
+        # Both come from the peer (the HELLO username is not authenticated).
+        name = _safe_name(str(offer["name"]), "file name")
+        root = os.path.realpath(self.download_dir)
+        directory = os.path.realpath(os.path.join(root, _safe_name(peer_username, "peer name")))
+        path = os.path.realpath(os.path.join(directory, name))
+        if os.path.commonpath([root, path]) != root or os.path.dirname(path) != directory:
+            raise ValueError(f"invalid file name {name!r}")
+        os.makedirs(directory, exist_ok=True)
+        free = shutil.disk_usage(directory).free
+        if size + FREE_SPACE_MARGIN > free:
+            raise ValueError(f"not enough disk space for {size} bytes")
+        path = _free_path(path)
+        incoming = IncomingFile(tid, peer_username, name, path, size)
+        self.store.save_incoming_file(tid.hex(), peer_username, name, path, size, 0)
+        return incoming
+
+    def _on_chunk(self, peer_username, tid, offset, crc, data):
+        with self._lock:
+            incoming = self._incoming.get(tid)
+        if incoming is None or incoming.peer != peer_username:
+            return
+
+        if offset != incoming.received or offset + len(data) > incoming.size or zlib.crc32(data) != crc:
+            # Drop everything until the sender rewinds to our verified offset.
+            if not incoming.rewind_requested:
+                incoming.rewind_requested = True
+                self._answer(peer_username, MSG_FILE_RESUME, {"id": tid.hex(), "offset": incoming.received})
+            return
+
+        incoming.rewind_requested = False
+        incoming.write(offset, data)
+        if incoming.received - incoming.persisted >= PROGRESS_INTERVAL:
+            self._persist(incoming)
+
+    def _persist(self, incoming):
+        incoming.persisted = incoming.received
+        self.store.save_incoming_file(
+            incoming.id.hex(), incoming.peer, incoming.name, incoming.path, incoming.size, incoming.received
+        )
+
+    def _on_done(self, peer_username, tid):
+        with self._lock:
+            incoming = self._incoming.get(tid)
+        if incoming is None:
+            self._answer(peer_username, MSG_FILE_DONE, {"id": tid.hex(), "ok": tid in self._finished})
+            return
+        if incoming.received < incoming.size:
+            incoming.rewind_requested = True
+            self._answer(peer_username, MSG_FILE_RESUME, {"id": tid.hex(), "offset": incoming.received})
+            return
+
+        incoming.finish()
+        self.store.remove_incoming_file(tid.hex())
+        with self._lock:
+            self._incoming.pop(tid, None)
+            self._finished.append(tid)
+            del self._finished[:-FINISHED_IDS]
+        print(f"📥 [FILE] Received {incoming.name} from {peer_username} → {incoming.path}")
+        self._answer(peer_username, MSG_FILE_DONE, {"id": tid.hex(), "ok": True})
+
+    # -------- lifecycle --------
+    def active(self):
+        """([(name, peer, sent, size)], [(name, peer, received, size)])"""
+        with self._lock:
+            outgoing = [(t.name, t.peer["username"], t.sent, t.size) for t in self._outgoing.values()]
+            incoming = [(t.name, t.peer, t.received, t.size) for t in self._incoming.values()]
+        return outgoing, incoming
+
+    def close(self):
+        """Stop sending and keep the progress of partial downloads for later."""
+        self._running = False
+        with self._lock:
+            incoming = list(self._incoming.values())
+            self._incoming.clear()
+        for transfer in incoming:
+            self._persist(transfer)
+            transfer.close()
+
+
+def _free_path(path):
+    """`path`, or `name (n).ext` if a file (or partial download) already uses it."""
+    base, ext = os.path.splitext(path)
+    candidate, n = path, 1
+    while os.path.exists(candidate) or os.path.exists(candidate + ".part"):
+        candidate = f"{base} ({n}){ext}"
+        n += 1
+    return candidate
@@ -0,0 +1,80 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from protocol import MSG_GROUP, encode_group_message
+
+# Group conversations share the message box and local store with 1:1 chats
+# under "#<group name>".
+GROUP_PREFIX = "#"
+FANOUT_WORKERS = 32
+FANOUT_TIMEOUT = 2.0
+OFFLINE_RETRY = 30.0
+
+
+def group_key(name):
+    return GROUP_PREFIX + name
+
+
+def is_group(key):
+    return key.startswith(GROUP_PREFIX)
+
+
+def group_name(key):
+    return key[len(GROUP_PREFIX):]
+
+
+class GroupFanout:
+    """
+    Sends a group message to all members at once.
+
+    Every member is sent to from a thread pool over the pooled peer
+    connections, so a send takes about as long as the slowest member instead
+    of the sum of all of them. Members that could not be reached are not
+    dialed again for `offline_retry` seconds unless they connect to us; they
+    get the message from the STUN server, where it is stored once for the
+    whole group.
+    """
+
+    def __init__(self, connections, max_workers=FANOUT_WORKERS, timeout=FANOUT_TIMEOUT,
+                 offline_retry=OFFLINE_RETRY):
+        self.connections = connections
+        self.timeout = timeout
+        self.offline_retry = offline_retry
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fanout")
+        self._offline = {}
+        self._lock = threading.Lock()
+
+    def _deliver(self, member, payload):
+        username = member["username"]
+        if self.connections.get(username) is None:
+            with self._lock:
+                if self._offline.get(username, 0) > time.monotonic():
+                    return False
+        try:
+            self.connections.send(member, MSG_GROUP, payload)
+        except OSError:
+            with self._lock:
+                self._offline[username] = time.monotonic() + self.offline_retry
+            return False
+        with self._lock:
+            self._offline.pop(username, None)
+        return True
+
+    def send(self, group, members, text, msg_id=None):
+        """Returns (delivered, unreachable) usernames; slow members count as unreachable."""
+        payload = encode_group_message(msg_id or uuid.uuid4().bytes, group, text)
+        futures = {self._executor.submit(self._deliver, member, payload): member["username"] for member in members}
+        done, _ = wait(futures, timeout=self.timeout)
+
+        delivered, unreachable = [], []
+        for future, username in futures.items():
+            if future in done and future.result():
+                delivered.append(username)
+            else:
+                unreachable.append(username)
+        return delivered, unreachable
+
+    def close(self):
+        self._executor.shutdown(wait=False)
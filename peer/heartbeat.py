@@ -0,0 +1,54 @@
+import random
+import threading
+import time
+
+import metrics
+
+HEARTBEAT_INTERVAL = 20.0  # the server's online window is 120 s, so a few lost beats are fine
+HEARTBEAT_MAGIC = b"P2HB"
+HEARTBEAT_ACK = b"P2HA"
+
+HEARTBEATS = metrics.counter("peer_heartbeats_total", "UDP heartbeats to the STUN server, by result")
+
+
+class HeartbeatSender:
+    """
+    Tells the STUN server we're online with one small UDP datagram every
+    `interval` seconds, instead of an HTTP request per keep-alive.
+
+    `send(datagram)` writes to the server from the UDP transport's socket,
+    so the beats also keep its NAT mapping open for hole punching; the
+    transport reports the server's acks through `acked()`.
+    """
+
+    def __init__(self, username, send, interval=HEARTBEAT_INTERVAL):
+        self.payload = HEARTBEAT_MAGIC + username.encode()
+        self.send = send
+        self.interval = interval
+        self.last_ack = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def beat(self):
+        try:
+            self.send(self.payload)
+            HEARTBEATS.inc(result="sent")
+        except OSError:
+            HEARTBEATS.inc(result="failed")
+
+    def acked(self):
+        self.last_ack = time.time()
+        HEARTBEATS.inc(result="acked")
+
+    def _run(self):
+        self.beat()
+        while not self._stop.wait(self.interval * random.uniform(0.9, 1.1)):
+            self.beat()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(1)
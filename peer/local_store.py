@@ -0,0 +1,240 @@
+import os
+import sqlite3
+import threading
+
+from conversation_store import MessageRecord
+
+STORE_DIR = os.environ.get("P2P_CHAT_HOME", os.path.join(os.path.expanduser("~"), ".p2p_chat"))
+RECENT_LIMIT = 50
+
+# Synced messages in server order, then the ones not synced yet (newest).
+HISTORY_ORDER_DESC = "server_id IS NULL DESC, server_id DESC, local_id DESC"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    local_id  INTEGER PRIMARY KEY AUTOINCREMENT,
+    peer      TEXT NOT NULL,
+    server_id INTEGER UNIQUE,
+    sender    TEXT NOT NULL,
+    content   TEXT NOT NULL,
+    msg_id    TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_history_idx ON messages (peer, server_id, local_id);
+CREATE INDEX IF NOT EXISTS messages_unsynced_idx ON messages (peer, sender) WHERE server_id IS NULL;
+
+CREATE TABLE IF NOT EXISTS outbox (
+    msg_id  TEXT PRIMARY KEY,
+    peer    TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_peer_idx ON outbox (peer);
+
+CREATE TABLE IF NOT EXISTS incoming_files (
+    transfer_id TEXT PRIMARY KEY,
+    peer        TEXT NOT NULL,
+    name        TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    received    INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sync_cursors (
+    peer    TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+"""
+
+
+class LocalStore:
+    """
+    On-disk chat history of one user (a SQLite file per username).
+
+    Messages seen over P2P are stored right away without a server id.
+    `merge_server_messages()` attaches server ids to them once the STUN
+    server returns the same message, and keeps a per-conversation cursor
+    (highest server id seen) so only newer messages have to be fetched.
+    """
+
+    def __init__(self, username, directory=STORE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{username}.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+        if "msg_id" not in columns:
+            # Store created before messages kept their P2P id.
+            self._conn.execute("ALTER TABLE messages ADD COLUMN msg_id TEXT")
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS messages_msg_id_idx ON messages (msg_id) WHERE msg_id IS NOT NULL"
+        )
+
+    @staticmethod
+    def exists(username, directory=STORE_DIR):
+        return os.path.exists(os.path.join(directory, f"{username}.sqlite3"))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add_local(self, peer, sender, content, msg_id=None):
+        """
+        Store a message sent or received over P2P. False if one with the
+        same `msg_id` (hex) is stored already, e.g. synced from the server
+        before the peer's replay arrived.
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO messages (peer, sender, content, msg_id) VALUES (?, ?, ?, ?)",
+                (peer, sender, content, msg_id)
+            )
+        return cursor.rowcount == 1
+
+    # -------- outbox (messages not acknowledged by the peer yet) --------
+    def outbox_add(self, peer, msg_id, content):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outbox (msg_id, peer, content) VALUES (?, ?, ?)",
+                (msg_id, peer, content)
+            )
+
+    def outbox_remove(self, msg_ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM outbox WHERE msg_id = ?", [(i,) for i in msg_ids])
+
+    def outbox_pending(self):
+        """[(peer, msg_id, content)] in the order they were queued."""
+        with self._lock:
+            return self._conn.execute("SELECT peer, msg_id, content FROM outbox ORDER BY rowid").fetchall()
+
+    # -------- partially received files (resume after a disconnect) --------
+    def incoming_file(self, transfer_id):
+        """(peer, name, path, size, received) or None."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT peer, name, path, size, received FROM incoming_files WHERE transfer_id = ?",
+                (transfer_id,)
+            ).fetchone()
+
+    def save_incoming_file(self, transfer_id, peer, name, path, size, received):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO incoming_files (transfer_id, peer, name, path, size, received) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (transfer_id, peer, name, path, size, received)
+            )
+
+    def remove_incoming_file(self, transfer_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM incoming_files WHERE transfer_id = ?", (transfer_id,))
+
+    def cursor(self, peer):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_id FROM sync_cursors WHERE peer = ?", (peer,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def cursors(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT peer, last_id FROM sync_cursors").fetchall())
+
+    def merge_server_messages(self, peer, messages, match_unsynced=True):
+        """
+        Store messages returned by the STUN server ({"id", "message", "from",
+        "msg_id"}).
+
+        Returns the ones that were not known locally yet. A message with a
+        msg_id is matched with the P2P copy of the same id; messages without
+        one with an unsynced local message of the same sender and content.
+        Older pages are merged with match_unsynced=False, they can't be a
+        local message.
+        """
+        new = []
+        last_id = None
+        with self._lock, self._conn:
+            for msg in messages:
+                server_id = msg["id"]
+                last_id = server_id if last_id is None else max(last_id, server_id)
+
+                if self._conn.execute(
+                    "SELECT 1 FROM messages WHERE server_id = ?", (server_id,)
+                ).fetchone():
+                    continue
+
+                msg_id = msg.get("msg_id")
+                if msg_id:
+                    row = self._conn.execute(
+                        "SELECT local_id, server_id FROM messages WHERE msg_id = ?", (msg_id,)
+                    ).fetchone()
+                    if row:
+                        if row[1] is None:
+                            self._conn.execute(
+                                "UPDATE messages SET server_id = ? WHERE local_id = ?", (server_id, row[0])
+                            )
+                        continue
+
+                row = match_unsynced and not msg_id and self._conn.execute(
+                    "SELECT local_id FROM messages "
+                    "WHERE peer = ? AND sender = ? AND content = ? AND server_id IS NULL "
+                    "ORDER BY local_id LIMIT 1",
+                    (peer, msg["from"], msg["message"])
+                ).fetchone()
+                if row:
+                    self._conn.execute(
+                        "UPDATE messages SET server_id = ? WHERE local_id = ?", (server_id, row[0])
+                    )
+                    continue
+
+                self._conn.execute(
+                    "INSERT INTO messages (peer, server_id, sender, content, msg_id) VALUES (?, ?, ?, ?, ?)",
+                    (peer, server_id, msg["from"], msg["message"], msg_id)
+                )
+                new.append(msg)
+
+            if last_id is not None:
+                self._conn.execute(
+                    "INSERT INTO sync_cursors (peer, last_id) VALUES (?, ?) "
+                    "ON CONFLICT(peer) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                    (peer, last_id)
+                )
+        return new
+
+    def recent(self, peer, limit=RECENT_LIMIT):
+        """Last `limit` messages of a conversation, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT server_id, sender, content FROM messages WHERE peer = ? "
+                f"ORDER BY {HISTORY_ORDER_DESC} LIMIT ?",
+                (peer, limit)
+            ).fetchall()
+        return _as_messages(reversed(rows))
+
+    def before(self, peer, server_id, limit=RECENT_LIMIT):
+        """Up to `limit` synced messages older than `server_id`, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT server_id, sender, content FROM messages "
+                "WHERE peer = ? AND server_id < ? "
+                "ORDER BY server_id DESC LIMIT ?",
+                (peer, server_id, limit)
+            ).fetchall()
+        return _as_messages(reversed(rows))
+
+    def oldest_server_id(self, peer):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(server_id) FROM messages WHERE peer = ?", (peer,)
+            ).fetchone()
+        return row[0]
+
+    def peers(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT peer FROM messages").fetchall()
+        return [row[0] for row in rows]
+
+
+def _as_messages(rows):
+    return [MessageRecord(server_id, sender, content) for server_id, sender, content in rows]
@@ -1,318 +1,941 @@
-import socket
-import threading
-from com_server import *
-from utils import *
-
-BUFFER_SIZE = 1024
-
-server_socket = None
-server_running = True
-server_thread = None
-my_user = None
-logged_in = False
-username = None
-user_friends = None
-messages = None
-new_message_flags = None
-active_chat_flags = None
-
-
-# ===============================
-# TCP SERVER
-# ===============================
-def start_server(listen_port):
-    global server_socket, server_running
-
-    try:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind(("0.0.0.0", listen_port))
-        server_socket.listen(5)
-        server_socket.settimeout(1.0)
-
-        print(f"🟢 [SERVER] Listening on port {listen_port} ...")
-
-        while server_running:
-            try:
-                conn, addr = server_socket.accept()
-                print(f"🔗 [SERVER] Connected by {addr}")
-
-                data = conn.recv(BUFFER_SIZE)
-                if not data:
-                    continue
-                peer_username = data.decode().strip()
-
-                if peer_username not in user_friends:
-                    friendship(username, peer_username)
-
-                threading.Thread(
-                    target=handle_peer,
-                    args=(conn, peer_username),
-                    daemon=True
-                ).start()
-
-            except socket.timeout:
-                continue
-            except OSError as e:
-                print(f"⚠️ [SERVER ERROR] Socket closed or error: {e}")
-                break
-            except Exception as e:
-                print(f"⚠️ [SERVER ERROR] {e}")
-
-    except Exception as e:
-        print(f"❌ [SERVER INIT ERROR] Failed to start server: {e}")
-    finally:
-        if server_socket:
-            server_socket.close()
-        print("🛑 [SERVER] Server stopped")
-
-
-def handle_peer(conn, peer_username):
-    try:
-        while True:
-            data = conn.recv(BUFFER_SIZE)
-            if not data:
-                print(f"⚪ [INFO] {peer_username} disconnected")
-                break
-
-            msg_text = data.decode().strip()
-
-            if active_chat_flags.get(peer_username, False):
-                print(f"💬 [{peer_username}] {msg_text}")
-                new_message_flags[peer_username] = False
-            else:
-                new_message_flags[peer_username] = True
-
-            if len(message_box.get(peer_username, [])) == 0:
-                messages = fetch_messages(peer_username, username)
-                message_box[peer_username] = messages
-            else:
-                message_box[peer_username].append({"message": msg_text, "from": peer_username})
-
-    except ConnectionResetError:
-        print(f"⚪ [INFO] {peer_username} connection reset")
-    except Exception as e:
-        print(f"⚠️ [SERVER ERROR] {e}")
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
-
-
-# ===============================
-# TCP CLIENT
-# ===============================
-def start_client(peer):
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        client.connect((peer["ip"], peer["port"]))
-        print(f"🔗 [CLIENT] Connected to peer {peer['ip']}:{peer['port']}")
-
-        try:
-            client.sendall(username.encode())
-        except Exception as e:
-            print(f"⚠️ [CLIENT ERROR] Failed to send username: {e}")
-            return
-
-        while True:
-            try:
-                msg = input("✉️ Enter message (type 'exit' to end): ").strip()
-            except KeyboardInterrupt:
-                print("\n🛑 [CLIENT] Keyboard interrupt, exiting chat...")
-                break
-            except Exception as e:
-                print(f"⚠️ [CLIENT INPUT ERROR] {e}")
-                continue
-
-            if msg.lower() == "exit":
-                print("✅ [CLIENT] Chat ended")
-                break
-
-            try:
-                client.sendall(msg.encode())
-                save_message(my_user["username"], peer["username"], msg)
-                message_box[peer["username"]].append({"message": msg, "from": username})
-            except BrokenPipeError:
-                print(f"⚪ [INFO] {peer['username']} disconnected")
-                break
-            except Exception as e:
-                print(f"⚠️ [CLIENT ERROR] Failed to send message: {e}")
-                break
-
-    except ConnectionRefusedError:
-        print(f"⚪ [INFO] Peer {peer['username']} is offline or refused connection")
-    except Exception as e:
-        print(f"❌ [CLIENT ERROR] {e}")
-    finally:
-        try:
-            client.close()
-        except Exception:
-            pass
-        print("🛑 [CLIENT] Connection closed")
-
-
-# ===============================
-# MAIN
-# ===============================
-def print_command_prompt():
-    print("\n🔹 Available commands: register | login | connect | status | show chat | end chat | logout | exit")
-    print("🔹 Enter your command:")
-
-
-if __name__ == "__main__":
-
-    try:
-        while True:
-            try:
-                command = input("👉 Command: ").strip().lower()
-            except KeyboardInterrupt:
-                print("\n🛑 Exiting application by user...")
-                break
-            except Exception as e:
-                print(f"⚠️ [INPUT ERROR] {e}")
-                continue
-
-            # -------- REGISTER --------
-            if command == "register":
-                if logged_in:
-                    print("❌ Logout first to register again")
-                    continue
-                try:
-                    username = input("Choose username: ").strip()
-                    port = int(input("Choose port: ").strip())
-                    user_ip = get_local_ip()
-                    if register(username, user_ip, port):
-                        print("✅ Registered successfully")
-                    else:
-                        print("❌ Registration failed")
-                except ValueError:
-                    print("⚠️ Invalid port, please enter a number")
-                except Exception as e:
-                    print(f"⚠️ [REGISTER ERROR] {e}")
-
-            # -------- LOGIN --------
-            elif command == "login":
-                if logged_in:
-                    print("❌ Already logged in")
-                    continue
-                try:
-                    username = input("Enter your username: ").strip()
-                    peers = get_peers()
-                    for p in peers:
-                        if p["username"] == username:
-                            print("✅ Login successful")
-                            logged_in = True
-
-                            my_user = get_peer_info(username)
-                            user_friends = get_friends(username)
-                            message_box, new_message_flags = create_messagebox(user_friends)
-                            active_chat_flags = new_message_flags.copy()
-                            print("📦 Messages loaded:", message_box)
-
-                            if server_thread is None:
-                                server_running = True
-                                server_thread = threading.Thread(
-                                    target=start_server,
-                                    args=(my_user["port"],),
-                                    daemon=False
-                                )
-                                server_thread.start()
-                            break
-                    else:
-                        print("❌ Username not found")
-                except Exception as e:
-                    print(f"⚠️ [LOGIN ERROR] {e}")
-
-            # -------- CONNECT --------
-            elif command == "connect":
-                if not logged_in:
-                    print("❌ Login first")
-                    continue
-                try:
-                    peer_username = input("Enter peer username to connect: ").strip()
-                    peer_info = get_peer_info(peer_username)
-                    if peer_username not in user_friends:
-                        friendship(username, peer_username)
-                    if len(message_box.get(peer_username, [])) == 0:
-                        messages = fetch_messages(peer_username, username)
-                        message_box[peer_username] = messages
-                    if peer_info and peer_info.get("ip"):
-                        start_client(peer_info)
-                    else:
-                        print("❌ Peer not found or offline")
-                except Exception as e:
-                    print(f"⚠️ [CONNECT ERROR] {e}")
-
-            # -------- STATUS --------
-            elif command == "status":
-                if not logged_in:
-                    print("❌ Login first")
-                    continue
-                print("📊 Friends status:")
-                for friend in user_friends:
-                    flag = "*" if new_message_flags.get(friend, False) else ""
-                    print(f"👤 {friend} {flag}")
-
-            # -------- SHOW CHAT --------
-            elif command == "show chat":
-                if not logged_in:
-                    print("❌ Login first")
-                    continue
-                try:
-                    peer_username = input("Enter peer username to show chat: ").strip()
-                    if len(message_box.get(peer_username, [])) == 0:
-                        messages = fetch_messages(peer_username, username)
-                        message_box[peer_username] = messages
-                    print("💬 Chat with", peer_username)
-                    print_messages(message_box[peer_username], username)
-                    active_chat_flags[peer_username] = True
-                    new_message_flags[peer_username] = False
-                except Exception as e:
-                    print(f"⚠️ [SHOW CHAT ERROR] {e}")
-
-            # -------- END SHOW CHAT --------
-            elif command == "end chat":
-                if not logged_in:
-                    print("❌ Login first")
-                    continue
-                try:
-                    peer_username = input("Enter peer username to end chat: ").strip()
-                    active_chat_flags[peer_username] = False
-                    print(f"✅ Chat with {peer_username} ended")
-                except Exception as e:
-                    print(f"⚠️ [END CHAT ERROR] {e}")
-
-            # -------- LOGOUT --------
-            elif command == "logout":
-                if not logged_in:
-                    print("❌ Not logged in")
-                    continue
-                print("🔌 Logging out...")
-                logged_in = False
-                server_running = False
-                try:
-                    if server_socket:
-                        server_socket.close()
-                except Exception:
-                    pass
-                server_thread = None
-                username = None
-                print("✅ Logged out successfully")
-
-            # -------- EXIT --------
-            elif command == "exit":
-                print("👋 Exiting application...")
-                server_running = False
-                try:
-                    if server_socket:
-                        server_socket.close()
-                except Exception:
-                    pass
-                break
-
-            else:
-                print("⚠️ Unknown command! Please try again.")
-
-    except Exception as e:
-        print(f"❌ [FATAL ERROR] {e}")
+import asyncio
+import os
+import socket
+import threading
+import uuid
+from com_server import *
+from utils import *
+from protocol import *
+from aio_server import AsyncPeerServer
+from connections import ConnectionManager
+from write_behind import WriteBehindQueue
+from local_store import LocalStore
+from conversation_store import MessageRecord
+from outbox import Outbox, RecentIds
+from file_transfer import FileTransfers, TransferError
+from groups import GroupFanout, group_key, group_name, is_group
+from udp_transport import STUN_UDP_PORT, UdpTransport
+from push import PushListener
+import metrics
+
+BUFFER_SIZE = 64 * 1024
+PAGE_SIZE = 50
+CONVERSATION_CAPACITY = 200
+MEMORY_BUDGET = 8 * 1024 * 1024
+SERVER_MODE = "asyncio"  # "asyncio" or "threaded"
+LISTEN_BACKLOG = 128
+METRICS_PORT = int(os.environ.get("PEER_METRICS_PORT", "0"))  # 0: no HTTP endpoint
+
+FRAME_HANDLING = metrics.histogram("peer_frame_handle_seconds", "Time spent handling a received frame, by type")
+
+server_socket = None
+server_running = True
+server_thread = None
+async_server = None
+connections = None
+outbox = None
+transfers = None
+group_fanout = None
+udp = None
+public_address = None
+push = None
+seen_message_ids = RecentIds()
+message_writer = None
+local_store = None
+history_before = {}
+my_user = None
+logged_in = False
+username = None
+user_friends = None
+user_groups = None
+messages = None
+new_message_flags = None
+active_chat_flags = None
+
+
+# ===============================
+# INCOMING PEERS
+# ===============================
+def accept_peer(connection):
+    if connection.username not in user_friends:
+        friendship(username, connection.username)
+        add_friend(connection.username)
+    connections.register(connection)
+    outbox.peer_online(connection.username)
+
+
+def punch_peer(peer_username):
+    if udp is None:
+        raise ConnectionError("UDP transport is not running")
+    return udp.punch(peer_username)
+
+
+def dispatch_frame(peer_username, frame):
+    with FRAME_HANDLING.time(type=FRAME_NAMES.get(frame.type, frame.type)):
+        handle_frame(peer_username, frame)
+
+
+def handle_frame(peer_username, frame):
+    if frame.type == MSG_TEXT:
+        on_peer_message(peer_username, frame.payload.decode())
+
+    elif frame.type == MSG_MESSAGE:
+        msg_id, msg_text = decode_message(frame.payload)
+        conn = connections.get(peer_username)
+        if conn:
+            try:
+                conn.send(MSG_ACK, encode_ack([msg_id]))
+            except OSError:
+                pass
+        # Replays of a message we already have are only acknowledged again.
+        if seen_message_ids.add(msg_id):
+            on_peer_message(peer_username, msg_text, msg_id.hex())
+
+    elif frame.type == MSG_ACK:
+        outbox.ack(peer_username, decode_ack(frame.payload))
+
+    elif frame.type == MSG_GROUP:
+        msg_id, group, msg_text = decode_group_message(frame.payload)
+        if seen_message_ids.add(msg_id):
+            on_group_message(peer_username, group, msg_text, msg_id.hex())
+
+    elif frame.type in FILE_FRAMES:
+        transfers.handle(peer_username, frame)
+
+
+def on_peer_message(peer_username, msg_text, msg_id=None):
+    # Known already if the server's copy was synced first (seen_message_ids
+    # only covers this session).
+    if not local_store.add_local(peer_username, peer_username, msg_text, msg_id):
+        return
+
+    if active_chat_flags.get(peer_username, False):
+        print(f"💬 [{peer_username}] {msg_text}")
+        new_message_flags[peer_username] = False
+    else:
+        new_message_flags[peer_username] = True
+
+    remember(peer_username, peer_username, msg_text)
+
+
+def on_group_message(sender, group, msg_text, msg_id=None):
+    conversation = group_key(group)
+    if group not in user_groups:
+        # Added to the group after we logged in.
+        user_groups.append(group)
+    if not local_store.add_local(conversation, sender, msg_text, msg_id):
+        return
+
+    if active_chat_flags.get(conversation, False):
+        print(f"💬 [{conversation}] {sender}: {msg_text}")
+        new_message_flags[conversation] = False
+    else:
+        new_message_flags[conversation] = True
+
+    remember(conversation, sender, msg_text)
+
+
+def remember(conversation, sender, msg_text):
+    """Add a message just written to the local store to the message box."""
+    if conversation in message_box:
+        message_box.append(conversation, sender, msg_text)
+    else:
+        # Not in memory: loading it from the local store picks it up.
+        message_box.recent(conversation)
+
+
+# ===============================
+# METRICS
+# ===============================
+def register_gauges():
+    """Gauges read the current session's state whenever metrics are collected."""
+    metrics.gauge("peer_connections_active", "Open peer connections",
+                  lambda: len(connections.active()) if connections else 0)
+    metrics.gauge("peer_server_handlers", "Inbound peers served by the asyncio server",
+                  lambda: async_server.handler_count if async_server else 0)
+    metrics.gauge("peer_outbox_pending", "Messages waiting for an ack or a retry",
+                  lambda: outbox.pending_count() if outbox else 0)
+    metrics.gauge("peer_write_behind_pending", "Messages not yet saved on the STUN server",
+                  lambda: message_writer.pending if message_writer else 0)
+    metrics.gauge("peer_file_transfers_active", "File transfers in progress, by direction",
+                  lambda: dict(zip(("sending", "receiving"), map(len, transfers.active())))
+                  if transfers else {}, label="direction")
+    metrics.gauge("peer_threads", "Live threads, by name prefix", metrics.thread_counts, label="group")
+    metrics.gauge("peer_udp_paths", "Open hole-punched UDP paths",
+                  lambda: len(udp.paths()) if udp else 0)
+    metrics.gauge("peer_address_cache", "Peer address cache hits, misses, hit ratio and size",
+                  peer_cache_stats, label="stat")
+
+
+register_gauges()
+
+
+# ===============================
+# HISTORY SYNC
+# ===============================
+def merge_history(peer_username, messages):
+    new_messages = local_store.merge_server_messages(peer_username, messages)
+    if peer_username in message_box:
+        message_box.extend(peer_username, [
+            MessageRecord(message["id"], message["from"], message["message"]) for message in new_messages
+        ])
+    else:
+        # Not in memory: loading it from the local store picks them up.
+        message_box.recent(peer_username)
+    return new_messages
+
+
+def fetch_page(conversation, before=None, after=None, limit=PAGE_SIZE):
+    if is_group(conversation):
+        return fetch_group_page(group_name(conversation), before, after, limit)
+    return fetch_message_page(conversation, username, before, after, limit)
+
+
+def sync_conversation(peer_username):
+    cursor = local_store.cursor(peer_username)
+    if cursor is None:
+        # Never synced: only the most recent page, older ones on demand.
+        page = fetch_page(peer_username, limit=PAGE_SIZE)
+        messages = page["messages"] if page else []
+    elif is_group(peer_username):
+        messages = fetch_group_messages(group_name(peer_username), after=cursor)
+    else:
+        messages = fetch_messages(peer_username, username, after=cursor)
+    return merge_history(peer_username, messages)
+
+
+def sync_history(friends):
+    """Pull only messages newer than the local cursors, for all friends at once."""
+    async def pull_one(client, friend):
+        cursor = local_store.cursor(friend)
+        if is_group(friend):
+            if cursor is None:
+                page = await client.fetch_group_page(group_name(friend), limit=PAGE_SIZE)
+                return page["messages"] if page else []
+            return await client.fetch_group_messages(group_name(friend), cursor)
+        if cursor is None:
+            page = await client.fetch_message_page(friend, username, limit=PAGE_SIZE)
+            return page["messages"] if page else []
+        return await client.fetch_messages(friend, username, cursor)
+
+    async def pull():
+        client = AsyncStunClient(stun_client)
+        try:
+            return await asyncio.gather(*(pull_one(client, friend) for friend in friends))
+        finally:
+            client.close()
+
+    try:
+        results = asyncio.run(pull())
+        for friend, messages in zip(friends, results):
+            new_messages = merge_history(friend, messages)
+            if any(m["from"] != username for m in new_messages) and not active_chat_flags.get(friend, False):
+                new_message_flags[friend] = True
+    except Exception as e:
+        print(f"⚠️ [SYNC ERROR] {e}")
+
+
+def close_message_writer():
+    # Unsaved messages stay in the local store, only the server copy is missing.
+    unsaved = message_writer.close()
+    if unsaved:
+        print(f"⚠️ [DB] {unsaved} messages could not be saved on the STUN server")
+
+
+# ===============================
+# PUSH NOTIFICATIONS
+# ===============================
+def add_friend(friend):
+    if friend != username and friend not in user_friends:
+        user_friends.append(friend)
+        new_message_flags.setdefault(friend, False)
+
+
+def on_push_events(events):
+    """Sync only the conversations the STUN server says have new messages."""
+    stale = []
+    for event in events:
+        if event["type"] == "message":
+            conversation = event["from"]
+            add_friend(conversation)
+        elif event["type"] == "group_message":
+            conversation = group_key(event["group"])
+            if event["group"] not in user_groups:
+                user_groups.append(event["group"])
+        elif event["type"] == "friendship":
+            add_friend(event["username"])
+            continue
+        elif event["type"] == "address":
+            invalidate_peer(event["username"])
+            continue
+        else:
+            continue
+        if conversation not in stale:
+            stale.append(conversation)
+
+    for conversation in stale:
+        # Messages that already came over a peer connection are matched, not new.
+        new_messages = [m for m in sync_conversation(conversation) if m["from"] != username]
+        if not new_messages:
+            continue
+        if not active_chat_flags.get(conversation, False):
+            new_message_flags[conversation] = True
+        elif is_group(conversation):
+            for message in new_messages:
+                print(f"💬 [{conversation}] {message['from']}: {message['message']}")
+        else:
+            for message in new_messages:
+                print(f"💬 [{conversation}] {message['message']}")
+
+
+def resync_all():
+    sync_history(user_friends + [group_key(group) for group in user_groups])
+
+
+def start_push(cursor=None):
+    global push
+    push = PushListener(username, poll_events, on_push_events, resync_all, cursor).start()
+
+
+def stop_push():
+    global push
+    if push:
+        push.close()
+        push = None
+
+
+def show_recent(peer_username):
+    page = message_box.recent(peer_username, PAGE_SIZE)
+    ids = [message.id for message in page if message.id]
+    history_before[peer_username] = min(ids) if ids else None
+    print_messages(page, username)
+
+
+def load_older(peer_username):
+    """Next older page: from the local store, topped up from the server."""
+    before = history_before.get(peer_username) or 2 ** 63 - 1
+    older = local_store.before(peer_username, before, PAGE_SIZE)
+
+    if len(older) < PAGE_SIZE:
+        oldest = older[0].id if older else local_store.oldest_server_id(peer_username)
+        # Nothing synced yet: before=None would be the latest page (sync's job),
+        # and merged as older messages it would duplicate the unsynced ones.
+        page = fetch_page(peer_username, before=oldest, limit=PAGE_SIZE - len(older)) if oldest else None
+        if page and page["messages"]:
+            local_store.merge_server_messages(peer_username, page["messages"], match_unsynced=False)
+            older = local_store.before(peer_username, before, PAGE_SIZE)
+
+    if older:
+        history_before[peer_username] = older[0].id
+    return older
+
+
+def start_listening(listen_port):
+    global server_thread, server_running, async_server
+
+    if SERVER_MODE == "asyncio":
+        if async_server is None:
+            async_server = AsyncPeerServer(
+                listen_port,
+                on_hello=accept_peer,
+                on_frame=dispatch_frame,
+                on_close=connections.remove,
+                backlog=LISTEN_BACKLOG,
+                blocking_frames=FILE_FRAMES
+            ).start()
+    elif server_thread is None:
+        server_running = True
+        server_thread = threading.Thread(
+            target=start_server,
+            args=(listen_port,),
+            daemon=False
+        )
+        server_thread.start()
+
+
+def start_udp(listen_port):
+    """UDP socket for heartbeats, STUN binding and hole-punched paths."""
+    global udp
+
+    try:
+        udp = UdpTransport(
+            username,
+            listen_port,
+            (server_host(), STUN_UDP_PORT),
+            on_frame=dispatch_frame,
+            on_path=accept_peer,
+            on_close=connections.remove
+        ).start()
+    except OSError as e:
+        print(f"⚠️ [UDP ERROR] Presence updates and hole punching disabled: {e}")
+        return
+    threading.Thread(target=discover_public_address, args=(udp,), daemon=True).start()
+
+
+def discover_public_address(transport):
+    global public_address
+
+    address = transport.binding()
+    if address is None:
+        print("⚠️ [UDP] No STUN binding response, public address unknown")
+        return
+    public_address = address
+    if address[0] != my_user["ip"]:
+        print(f"🌐 [UDP] Behind NAT, public address {address[0]}:{address[1]}")
+
+
+def stop_udp():
+    global udp, public_address
+
+    if udp:
+        udp.close()
+        udp = None
+    public_address = None
+
+
+def stop_listening():
+    global server_thread, server_running, async_server
+
+    server_running = False
+    if async_server:
+        async_server.stop()
+        async_server = None
+    if connections:
+        connections.close_all()
+    try:
+        if server_socket:
+            server_socket.close()
+    except Exception:
+        pass
+    server_thread = None
+
+
+# ===============================
+# TCP SERVER (threaded mode)
+# ===============================
+def start_server(listen_port):
+    global server_socket, server_running
+
+    try:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(("0.0.0.0", listen_port))
+        server_socket.listen(LISTEN_BACKLOG)
+        server_socket.settimeout(1.0)
+
+        print(f"🟢 [SERVER] Listening on port {listen_port} ...")
+
+        while server_running:
+            try:
+                conn, addr = server_socket.accept()
+                print(f"🔗 [SERVER] Connected by {addr}")
+
+                reader = FrameReader(conn, BUFFER_SIZE)
+                hello = reader.read_frame()
+                if hello is None or hello.type != MSG_HELLO:
+                    conn.close()
+                    continue
+                peer_username = hello.payload.decode().strip()
+
+                threading.Thread(
+                    target=handle_peer,
+                    args=(conn, peer_username, reader),
+                    daemon=True
+                ).start()
+
+            except socket.timeout:
+                continue
+            except OSError as e:
+                print(f"⚠️ [SERVER ERROR] Socket closed or error: {e}")
+                break
+            except Exception as e:
+                print(f"⚠️ [SERVER ERROR] {e}")
+
+    except Exception as e:
+        print(f"❌ [SERVER INIT ERROR] Failed to start server: {e}")
+    finally:
+        if server_socket:
+            server_socket.close()
+        print("🛑 [SERVER] Server stopped")
+
+
+def handle_peer(conn, peer_username, reader):
+    connection = connections.adopt_socket(conn, peer_username, reader, outbound=False)
+    accept_peer(connection)
+    connection.read_loop()
+
+
+# ===============================
+# TCP CLIENT
+# ===============================
+def send_chat_message(peer, msg):
+    """Send, persist and record one message; False if it was queued for retry."""
+    msg_id = uuid.uuid4().bytes
+    delivered = outbox.send(peer, msg, msg_id)
+    message_writer.put(my_user["username"], peer["username"], msg, msg_id=msg_id.hex())
+    message_box.append(peer["username"], username, msg)
+    local_store.add_local(peer["username"], username, msg, msg_id.hex())
+    return delivered
+
+
+def start_client(peer):
+    reused = connections.get(peer["username"]) is not None
+    try:
+        conn = connections.connect(peer)
+        if reused:
+            print(f"♻️ [CLIENT] Reusing connection with {peer['username']}")
+        elif not conn.reliable:
+            print(f"🕳️ [CLIENT] Connected to peer over UDP via {conn.addr[0]}:{conn.addr[1]}")
+        else:
+            print(f"🔗 [CLIENT] Connected to peer {peer['ip']}:{peer['port']}")
+    except OSError as e:
+        if isinstance(e, ConnectionRefusedError):
+            print(f"⚪ [INFO] Peer {peer['username']} is offline or refused connection")
+        else:
+            print(f"❌ [CLIENT ERROR] {e}")
+        print("📥 [CLIENT] Messages will be queued and delivered when the peer is back")
+
+    # Replies arrive on the same connection, show them live.
+    was_active = active_chat_flags.get(peer["username"], False)
+    active_chat_flags[peer["username"]] = True
+    try:
+        while True:
+            try:
+                msg = input("✉️ Enter message (type 'exit' to end): ").strip()
+            except KeyboardInterrupt:
+                print("\n🛑 [CLIENT] Keyboard interrupt, exiting chat...")
+                break
+            except Exception as e:
+                print(f"⚠️ [CLIENT INPUT ERROR] {e}")
+                continue
+
+            if msg.lower() == "exit":
+                print("✅ [CLIENT] Chat ended")
+                break
+            if not msg:
+                continue
+
+            try:
+                if not send_chat_message(peer, msg):
+                    print(f"📥 [CLIENT] {peer['username']} unreachable, message queued for retry")
+            except Exception as e:
+                print(f"⚠️ [CLIENT ERROR] Failed to send message: {e}")
+                break
+    finally:
+        active_chat_flags[peer["username"]] = was_active
+
+
+def start_group_chat(group, members):
+    conversation = group_key(group)
+    others = [member for member in members if member["username"] != username]
+    print(f"👥 [GROUP] Chat in {conversation} with {len(others)} members")
+
+    was_active = active_chat_flags.get(conversation, False)
+    active_chat_flags[conversation] = True
+    try:
+        while True:
+            try:
+                msg = input("✉️ Enter message (type 'exit' to end): ").strip()
+            except KeyboardInterrupt:
+                print("\n🛑 [GROUP] Keyboard interrupt, exiting chat...")
+                break
+            except Exception as e:
+                print(f"⚠️ [GROUP INPUT ERROR] {e}")
+                continue
+
+            if msg.lower() == "exit":
+                print("✅ [GROUP] Chat ended")
+                break
+            if not msg:
+                continue
+
+            try:
+                msg_id = uuid.uuid4().bytes
+                delivered, unreachable = group_fanout.send(group, others, msg, msg_id)
+                if unreachable:
+                    print(f"📥 [GROUP] Delivered to {len(delivered)}/{len(others)} members, "
+                          f"the others get it from the server")
+                # Stored once for the whole group, offline members sync it from there.
+                message_writer.put(username, None, msg, group=group, msg_id=msg_id.hex())
+                message_box.append(conversation, username, msg)
+                local_store.add_local(conversation, username, msg, msg_id.hex())
+            except Exception as e:
+                print(f"⚠️ [GROUP ERROR] Failed to send message: {e}")
+                break
+    finally:
+        active_chat_flags[conversation] = was_active
+
+
+# ===============================
+# MAIN
+# ===============================
+def print_command_prompt():
+    print("\n🔹 Available commands: register | login | find | connect | send file | create group | add member | group chat | status | stats | export | show chat | show older | end chat | logout | exit")
+    print("🔹 Enter your command:")
+
+
+if __name__ == "__main__":
+
+    if METRICS_PORT:
+        try:
+            metrics.MetricsServer(METRICS_PORT).start()
+            print(f"📈 [METRICS] Serving on http://{metrics.METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print(f"⚠️ [METRICS ERROR] Could not listen on port {METRICS_PORT}: {e}")
+
+    try:
+        while True:
+            try:
+                command = input("👉 Command: ").strip().lower()
+            except KeyboardInterrupt:
+                print("\n🛑 Exiting application by user...")
+                break
+            except Exception as e:
+                print(f"⚠️ [INPUT ERROR] {e}")
+                continue
+
+            # -------- REGISTER --------
+            if command == "register":
+                if logged_in:
+                    print("❌ Logout first to register again")
+                    continue
+                try:
+                    username = input("Choose username: ").strip()
+                    port = int(input("Choose port: ").strip())
+                    user_ip = get_local_ip()
+                    if register(username, user_ip, port):
+                        print("✅ Registered successfully")
+                    else:
+                        print("❌ Registration failed")
+                except ValueError:
+                    print("⚠️ Invalid port, please enter a number")
+                except Exception as e:
+                    print(f"⚠️ [REGISTER ERROR] {e}")
+
+            # -------- LOGIN --------
+            elif command == "login":
+                if logged_in:
+                    print("❌ Already logged in")
+                    continue
+                try:
+                    username = input("Enter your username: ").strip()
+                    store = LocalStore(username) if LocalStore.exists(username) else None
+                    cursors = store.cursors() if store else {}
+                    session = bootstrap(
+                        username,
+                        {peer: last_id for peer, last_id in cursors.items() if not is_group(peer)},
+                        {group_name(key): last_id for key, last_id in cursors.items() if is_group(key)}
+                    )
+                    if session is None:
+                        if store:
+                            store.close()
+                        print("❌ Username not found")
+                        continue
+
+                    print("✅ Login successful")
+                    logged_in = True
+
+                    my_user = session["peer"]
+                    user_friends = [friend["username"] for friend in session["friends"]]
+                    user_groups = [group["name"] for group in session.get("groups", [])]
+                    local_store = store or LocalStore(username)
+                    message_box, new_message_flags = create_messagebox(
+                        user_friends, local_store, capacity=CONVERSATION_CAPACITY, memory_budget=MEMORY_BUDGET
+                    )
+                    active_chat_flags = new_message_flags.copy()
+                    for friend in session["friends"]:
+                        new_message_flags[friend["username"]] = friend["unread"] > 0
+                    for group in session.get("groups", []):
+                        new_message_flags[group_key(group["name"])] = group["unread"] > 0
+                        active_chat_flags[group_key(group["name"])] = False
+                    print("📦 Messages loaded:", message_box)
+
+                    # Only conversations with messages past the local cursor need a sync.
+                    latest = {friend["username"]: friend["last_message_id"] for friend in session["friends"]}
+                    for group in session.get("groups", []):
+                        latest[group_key(group["name"])] = group["last_message_id"]
+                    stale = [
+                        conversation for conversation, last_id in latest.items()
+                        if last_id and last_id > cursors.get(conversation, 0)
+                    ]
+                    if stale:
+                        threading.Thread(
+                            target=sync_history,
+                            args=(stale,),
+                            daemon=True
+                        ).start()
+
+                    if message_writer is None:
+                        message_writer = WriteBehindQueue(save_messages)
+                    connections = ConnectionManager(
+                        username,
+                        on_frame=dispatch_frame,
+                        buffer_size=BUFFER_SIZE,
+                        resolve=resolve_peer,
+                        invalidate=invalidate_peer,
+                        punch=punch_peer
+                    )
+                    outbox = Outbox(local_store, connections, resolve_peer)
+                    transfers = FileTransfers(local_store, connections, resolve_peer)
+                    group_fanout = GroupFanout(connections)
+                    start_listening(my_user["port"])
+                    start_udp(my_user["port"])
+                    start_push(session.get("events_cursor"))
+                except Exception as e:
+                    print(f"⚠️ [LOGIN ERROR] {e}")
+
+            # -------- FIND --------
+            elif command == "find":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    prefix = input("Enter username prefix (empty for all): ").strip()
+                    online_only = input("Online only? (y/n): ").strip().lower() == "y"
+                    after = None
+                    while True:
+                        page = search_peers(prefix, online=True if online_only else None, after=after)
+                        if page is None:
+                            break
+                        for peer in page["peers"]:
+                            print(f"{'🟢' if peer['online'] else '⚪'} {peer['username']}")
+                        after = page["next"]
+                        if not page["peers"]:
+                            print("🔍 No peers found")
+                        if not after or input("🔹 More? (y/n): ").strip().lower() != "y":
+                            break
+                except Exception as e:
+                    print(f"⚠️ [FIND ERROR] {e}")
+
+            # -------- CONNECT --------
+            elif command == "connect":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    peer_username = input("Enter peer username to connect: ").strip()
+                    peer_info = resolve_peer(peer_username)
+                    if peer_username not in user_friends:
+                        friendship(username, peer_username)
+                        add_friend(peer_username)
+                    sync_conversation(peer_username)
+                    if peer_info and peer_info.get("ip"):
+                        start_client(peer_info)
+                    else:
+                        print("❌ Peer not found or offline")
+                except Exception as e:
+                    print(f"⚠️ [CONNECT ERROR] {e}")
+
+            # -------- CREATE GROUP --------
+            elif command == "create group":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    name = input("Enter group name: ").strip().lstrip("#")
+                    members = [m.strip() for m in input("Enter members (comma separated): ").split(",") if m.strip()]
+                    if not name:
+                        print("❌ Group name is required")
+                        continue
+                    if create_group(name, username, members) is not None:
+                        user_groups.append(name)
+                        new_message_flags[group_key(name)] = False
+                        print(f"✅ Group {group_key(name)} created")
+                except Exception as e:
+                    print(f"⚠️ [CREATE GROUP ERROR] {e}")
+
+            # -------- ADD MEMBER --------
+            elif command == "add member":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    name = input("Enter group name: ").strip().lstrip("#")
+                    usernames = [u.strip() for u in input("Enter usernames (comma separated): ").split(",") if u.strip()]
+                    members = add_group_members(name, usernames) if usernames else None
+                    if members is not None:
+                        print(f"✅ {group_key(name)} has {len(members)} members")
+                        if name not in user_groups and any(m["username"] == username for m in members):
+                            user_groups.append(name)
+                except Exception as e:
+                    print(f"⚠️ [ADD MEMBER ERROR] {e}")
+
+            # -------- GROUP CHAT --------
+            elif command == "group chat":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    name = input("Enter group name: ").strip().lstrip("#")
+                    members = get_group_members(name)
+                    if members is None:
+                        print("❌ Group not found")
+                        continue
+                    if not any(m["username"] == username for m in members):
+                        print("❌ You are not a member of this group")
+                        continue
+                    sync_conversation(group_key(name))
+                    start_group_chat(name, members)
+                except Exception as e:
+                    print(f"⚠️ [GROUP CHAT ERROR] {e}")
+
+            # -------- SEND FILE --------
+            elif command == "send file":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    peer_username = input("Enter peer username to send to: ").strip()
+                    path = os.path.expanduser(input("Enter file path: ").strip())
+                    if not os.path.isfile(path):
+                        print("❌ File not found")
+                        continue
+                    peer_info = resolve_peer(peer_username)
+                    if not peer_info or not peer_info.get("ip"):
+                        print("❌ Peer not found or offline")
+                        continue
+                    transfer = transfers.send(peer_info, path)
+                    print(f"📎 [FILE] Sending {transfer.name} ({transfer.size} bytes) to {peer_username} in the background")
+                except TransferError as e:
+                    print(f"⚠️ {e}")
+                except Exception as e:
+                    print(f"⚠️ [SEND FILE ERROR] {e}")
+
+            # -------- STATUS --------
+            elif command == "status":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                if public_address:
+                    print(f"🌐 Public UDP address: {public_address[0]}:{public_address[1]}")
+                print("📊 Friends status:")
+                for friend in user_friends:
+                    flag = "*" if new_message_flags.get(friend, False) else ""
+                    print(f"👤 {friend} {flag}")
+                for group in user_groups:
+                    flag = "*" if new_message_flags.get(group_key(group), False) else ""
+                    print(f"👥 {group_key(group)} {flag}")
+                sending, receiving = transfers.active()
+                for name, peer_username, done, size in sending:
+                    print(f"📤 {name} → {peer_username}: {done}/{size} bytes")
+                for name, peer_username, done, size in receiving:
+                    print(f"📥 {name} ← {peer_username}: {done}/{size} bytes")
+
+            # -------- STATS --------
+            elif command == "stats":
+                print("📈 Metrics:")
+                print(metrics.REGISTRY.format_stats())
+
+            # -------- EXPORT --------
+            elif command == "export":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    conversation = input("Enter peer or #group to export (empty for all): ").strip()
+                    default = os.path.join(os.getcwd(), f"{username}-{conversation or 'all'}.ndjson")
+                    path = os.path.expanduser(input(f"Enter output file [{default}]: ").strip()) or default
+                    if is_group(conversation):
+                        count = export_messages(username, path, group=group_name(conversation))
+                    else:
+                        count = export_messages(username, path, peer=conversation or None)
+                    if count is not None:
+                        print(f"💾 [EXPORT] {count} messages written to {path}")
+                except Exception as e:
+                    print(f"⚠️ [EXPORT ERROR] {e}")
+
+            # -------- SHOW CHAT --------
+            elif command == "show chat":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    peer_username = input("Enter peer username to show chat: ").strip()
+                    sync_conversation(peer_username)
+                    print("💬 Chat with", peer_username)
+                    show_recent(peer_username)
+                    print("🔹 Type 'show older' to load earlier messages")
+                    active_chat_flags[peer_username] = True
+                    new_message_flags[peer_username] = False
+                except Exception as e:
+                    print(f"⚠️ [SHOW CHAT ERROR] {e}")
+
+            # -------- SHOW OLDER --------
+            elif command == "show older":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    peer_username = input("Enter peer username to load older messages: ").strip()
+                    older = load_older(peer_username)
+                    if older:
+                        print(f"📜 {len(older)} older messages with {peer_username}")
+                        print_messages(older, username)
+                    else:
+                        print("📜 No older messages")
+                except Exception as e:
+                    print(f"⚠️ [SHOW OLDER ERROR] {e}")
+
+            # -------- END SHOW CHAT --------
+            elif command == "end chat":
+                if not logged_in:
+                    print("❌ Login first")
+                    continue
+                try:
+                    peer_username = input("Enter peer username to end chat: ").strip()
+                    active_chat_flags[peer_username] = False
+                    print(f"✅ Chat with {peer_username} ended")
+                except Exception as e:
+                    print(f"⚠️ [END CHAT ERROR] {e}")
+
+            # -------- LOGOUT --------
+            elif command == "logout":
+                if not logged_in:
+                    print("❌ Not logged in")
+                    continue
+                print("🔌 Logging out...")
+                logged_in = False
+                stop_push()
+                stop_udp()
+                if transfers:
+                    transfers.close()
+                    transfers = None
+                if group_fanout:
+                    group_fanout.close()
+                    group_fanout = None
+                stop_listening()
+                if outbox:
+                    outbox.close()
+                    outbox = None
+                if message_writer:
+                    close_message_writer()
+                    message_writer = None
+                if local_store:
+                    local_store.close()
+                    local_store = None
+                username = None
+                print("✅ Logged out successfully")
+
+            # -------- EXIT --------
+            elif command == "exit":
+                print("👋 Exiting application...")
+                stop_push()
+                stop_udp()
+                if transfers:
+                    transfers.close()
+                if group_fanout:
+                    group_fanout.close()
+                stop_listening()
+                if outbox:
+                    outbox.close()
+                if message_writer:
+                    close_message_writer()
+                if local_store:
+                    local_store.close()
+                break
+
+            else:
+                print("⚠️ Unknown command! Please try again.")
+
+    except Exception as e:
+        print(f"❌ [FATAL ERROR] {e}")
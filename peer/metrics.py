@@ -0,0 +1,240 @@
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers a loopback frame handler up to a slow STUN server call.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_HOST = "127.0.0.1"
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_key(labels), 0)
+
+
+class Gauge:
+    """
+    A value read when the metrics are collected: `fn()` returns a number, or
+    a dict of {label value: number} for the single label `label`.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            # Whatever the gauge reads may be gone (e.g. after logout).
+            return []
+        if self.label is None:
+            return [((), value)]
+        return [(((self.label, name),), v) for name, v in sorted(value.items())]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            return [(key, list(series)) for key, series in self._series.items()]
+
+    def summary(self, series):
+        """count, sum and approximate p50 / p90 / p99 (bucket upper bounds)."""
+        counts, total = series[:-1], series[-1]
+        count = sum(counts)
+        result = {"count": count, "sum": total, "mean": total / count if count else 0.0}
+        for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            seen = 0
+            result[name] = float("inf")
+            for bound, n in zip(self.buckets, counts):
+                seen += n
+                if count and seen >= q * count:
+                    result[name] = bound
+                    break
+        return result
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            # Re-registering (e.g. gauges after a new login) replaces the old one.
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        with self._lock:
+            existing = self._metrics.get(name)
+        return existing if isinstance(existing, Counter) else self._add(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            existing = self._metrics.get(name)
+        return existing if isinstance(existing, Histogram) else self._add(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, fn, label=None):
+        return self._add(Gauge(name, help, fn, label))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4)."""
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if metric.kind != "histogram":
+                for key, value in metric.samples():
+                    lines.append(f"{metric.name}{_format_labels(key)} {value}")
+                continue
+            for key, series in metric.samples():
+                cumulative = 0
+                for bound, n in zip(metric.buckets + ("+Inf",), series[:-1]):
+                    cumulative += n
+                    lines.append(f"{metric.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{_format_labels(key)} {series[-1]}")
+                lines.append(f"{metric.name}_count{_format_labels(key)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def format_stats(self):
+        """Human readable dump for the `stats` command."""
+        lines = []
+        for metric in self.metrics():
+            samples = sorted(metric.samples(), key=lambda sample: sample[0])
+            if not samples:
+                continue
+            lines.append(f"{metric.name} ({metric.help})")
+            for key, value in samples:
+                label = f"  {_format_labels(key)} " if key else "  "
+                if metric.kind == "histogram":
+                    s = metric.summary(value)
+                    lines.append(
+                        f"{label}n={s['count']} mean={s['mean'] * 1000:.2f}ms "
+                        f"p50<={s['p50'] * 1000:g}ms p90<={s['p90'] * 1000:g}ms p99<={s['p99'] * 1000:g}ms"
+                    )
+                else:
+                    lines.append(f"{label}{value}")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+
+
+def thread_counts():
+    """Live threads grouped by name ("peer-alice" -> "peer", "fanout_3" -> "fanout")."""
+    counts = {}
+    for thread in threading.enumerate():
+        group = thread.name.split("-")[0].split("_")[0] if not thread.name.startswith("Thread-") else "other"
+        counts[group] = counts.get(group, 0) + 1
+    return counts
+
+
+class MetricsServer:
+    """Serves REGISTRY at http://host:port/metrics from a background thread."""
+
+    def __init__(self, port, host=METRICS_HOST, registry=REGISTRY):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
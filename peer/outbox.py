@@ -0,0 +1,171 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from protocol import MSG_MESSAGE, encode_message
+
+RETRY_BASE = 1.0
+RETRY_MAX = 60.0
+ACK_TIMEOUT = 10.0
+SEEN_IDS = 10000
+
+
+class Outbox:
+    """
+    At-least-once delivery of chat messages to peers.
+
+    Every message gets an id and is persisted in the local store until the
+    receiver acknowledges it. Unacknowledged messages of a peer are replayed
+    with exponential backoff, all of them coalesced into one burst (a single
+    sendall), and right away when the peer connects to us again.
+    """
+
+    def __init__(self, store, connections, resolve, base_delay=RETRY_BASE, max_delay=RETRY_MAX,
+                 ack_timeout=ACK_TIMEOUT):
+        self.store = store
+        self.connections = connections
+        self.resolve = resolve
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.ack_timeout = ack_timeout
+
+        self._pending = {}    # peer -> OrderedDict(msg_id -> text)
+        self._schedule = {}   # peer -> (due time, current backoff)
+        self._cond = threading.Condition()
+        self._running = True
+
+        for peer, msg_id, content in store.outbox_pending():
+            self._pending.setdefault(peer, OrderedDict())[bytes.fromhex(msg_id)] = content
+        for peer in self._pending:
+            self._schedule[peer] = (time.monotonic(), base_delay)
+
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    # -------- API --------
+    def send(self, peer, text, msg_id=None):
+        """Queue `text` for `peer` and try to deliver it now. Returns True if it went out."""
+        username = peer["username"]
+        msg_id = msg_id or uuid.uuid4().bytes
+        self.store.outbox_add(username, msg_id.hex(), text)
+
+        with self._cond:
+            self._pending.setdefault(username, OrderedDict())[msg_id] = text
+            due, delay = self._schedule.get(username, (0, self.base_delay))
+            backing_off = due > time.monotonic() and delay > self.base_delay
+
+        conn = self.connections.get(username)
+        try:
+            if conn is None:
+                if backing_off:
+                    return False
+                conn = self.connections.connect(peer)
+            conn.send(MSG_MESSAGE, encode_message(msg_id, text))
+        except OSError:
+            self._backoff(username)
+            return False
+
+        self._reschedule(username, self.ack_timeout, self.base_delay)
+        return True
+
+    def ack(self, username, msg_ids):
+        with self._cond:
+            pending = self._pending.get(username, {})
+            acked = [msg_id for msg_id in msg_ids if pending.pop(msg_id, None) is not None]
+            if not pending:
+                self._pending.pop(username, None)
+                self._schedule.pop(username, None)
+        if acked:
+            self.store.outbox_remove([msg_id.hex() for msg_id in acked])
+
+    def peer_online(self, username):
+        """The peer is reachable again: replay its backlog now."""
+        with self._cond:
+            if username in self._pending:
+                self._schedule[username] = (time.monotonic(), self.base_delay)
+                self._cond.notify()
+
+    def pending_count(self, username=None):
+        with self._cond:
+            if username is not None:
+                return len(self._pending.get(username, ()))
+            return sum(len(p) for p in self._pending.values())
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(5)
+
+    # -------- retry loop --------
+    def _reschedule(self, username, after, delay):
+        with self._cond:
+            if username in self._pending:
+                self._schedule[username] = (time.monotonic() + after, delay)
+                self._cond.notify()
+
+    def _backoff(self, username):
+        with self._cond:
+            _, delay = self._schedule.get(username, (0, self.base_delay / 2))
+            delay = min(self.max_delay, delay * 2)
+        self._reschedule(username, delay, delay)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                due = [peer for peer, (when, _) in self._schedule.items() if when <= now]
+                if not due:
+                    upcoming = [when for when, _ in self._schedule.values() if when != float("inf")]
+                    self._cond.wait(min(upcoming, default=now + 60) - now)
+                    continue
+                # Don't pick the same peers again while they are being flushed.
+                for peer in due:
+                    self._schedule[peer] = (float("inf"), self._schedule[peer][1])
+
+            for peer in due:
+                self._flush(peer)
+
+    def _flush(self, username):
+        with self._cond:
+            backlog = list(self._pending.get(username, {}).items())
+        if not backlog:
+            return
+
+        try:
+            conn = self.connections.get(username)
+            if conn is None:
+                peer = self.resolve(username)
+                if not peer:
+                    raise ConnectionError(f"cannot resolve {username}")
+                conn = self.connections.connect(peer)
+            conn.send_many([(MSG_MESSAGE, encode_message(msg_id, text)) for msg_id, text in backlog])
+        except OSError:
+            self._backoff(username)
+            return
+
+        print(f"📤 [OUTBOX] Replayed {len(backlog)} unacknowledged message(s) to {username}")
+        self._reschedule(username, self.ack_timeout, self.base_delay)
+
+
+class RecentIds:
+    """Bounded set of recently received message ids, to drop replays."""
+
+    def __init__(self, size=SEEN_IDS):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, msg_id):
+        """False if the id was already seen."""
+        with self._lock:
+            if msg_id in self._ids:
+                self._ids.move_to_end(msg_id)
+                return False
+            self._ids[msg_id] = None
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+            return True
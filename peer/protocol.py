@@ -0,0 +1,219 @@
+import asyncio
+import struct
+from collections import namedtuple
+
+# ===============================
+# WIRE FORMAT
+# ===============================
+# Every frame is an 8 byte header followed by the payload:
+#
+#   version (u8) | type (u8) | flags (u8) | reserved (u8) | length (u32, big endian)
+#
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBBxI")
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+# Frame types
+MSG_HELLO = 1
+MSG_TEXT = 2
+MSG_MESSAGE = 3  # message id (16 bytes) + UTF-8 text, acknowledged
+MSG_ACK = 4      # one or more 16 byte message ids
+MSG_CAPS = 5     # JSON capabilities, sent by the dialer after HELLO and answered once
+
+# File transfer (see file_transfer.py)
+MSG_FILE_OFFER = 6   # JSON: id, name, size, chunk_size
+MSG_FILE_RESUME = 7  # JSON: id, offset to (re)start from, or error
+MSG_FILE_CHUNK = 8   # FILE_CHUNK header + raw file bytes
+MSG_FILE_DONE = 9    # JSON: id (sender), id + ok (receiver)
+FILE_FRAMES = (MSG_FILE_OFFER, MSG_FILE_RESUME, MSG_FILE_CHUNK, MSG_FILE_DONE)
+
+MSG_GROUP = 10  # message id (16 bytes) + group name length (u8) + group name + text
+
+FRAME_NAMES = {
+    MSG_HELLO: "hello", MSG_TEXT: "text", MSG_MESSAGE: "message", MSG_ACK: "ack", MSG_CAPS: "caps",
+    MSG_FILE_OFFER: "file_offer", MSG_FILE_RESUME: "file_resume", MSG_FILE_CHUNK: "file_chunk",
+    MSG_FILE_DONE: "file_done", MSG_GROUP: "group",
+}
+
+#   transfer id (16B) | offset (u64) | crc32 of the data (u32)
+FILE_CHUNK = struct.Struct("!16sQI")
+
+MESSAGE_ID_SIZE = 16
+
+Frame = namedtuple("Frame", ["type", "flags", "payload"])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(msg_type, payload=b"", flags=0):
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"payload too large ({len(payload)} bytes)")
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, len(payload)) + payload
+
+
+def send_frame(sock, msg_type, payload=b"", flags=0):
+    sock.sendall(encode_frame(msg_type, payload, flags))
+
+
+def send_frames(sock, frames):
+    """Pipeline several (type, payload) frames into a single sendall."""
+    sock.sendall(b"".join(encode_frame(msg_type, payload) for msg_type, payload in frames))
+
+
+def encode_message(msg_id, text):
+    return msg_id + text.encode()
+
+
+def decode_message(payload):
+    if len(payload) < MESSAGE_ID_SIZE:
+        raise ProtocolError("message frame without id")
+    return payload[:MESSAGE_ID_SIZE], payload[MESSAGE_ID_SIZE:].decode()
+
+
+def encode_group_message(msg_id, group, text):
+    name = group.encode()
+    if len(name) > 255:
+        raise ProtocolError("group name too long")
+    return msg_id + bytes([len(name)]) + name + text.encode()
+
+
+def decode_group_message(payload):
+    if len(payload) < MESSAGE_ID_SIZE + 1:
+        raise ProtocolError("group message frame without id")
+    name_end = MESSAGE_ID_SIZE + 1 + payload[MESSAGE_ID_SIZE]
+    if len(payload) < name_end:
+        raise ProtocolError("malformed group message frame")
+    return (
+        payload[:MESSAGE_ID_SIZE],
+        payload[MESSAGE_ID_SIZE + 1:name_end].decode(),
+        payload[name_end:].decode(),
+    )
+
+
+def encode_ack(msg_ids):
+    return b"".join(msg_ids)
+
+
+def decode_ack(payload):
+    if len(payload) % MESSAGE_ID_SIZE:
+        raise ProtocolError("malformed ack frame")
+    return [payload[i:i + MESSAGE_ID_SIZE] for i in range(0, len(payload), MESSAGE_ID_SIZE)]
+
+
+def encode_file_chunk_header(transfer_id, offset, crc, count):
+    """Frame header plus chunk header; the `count` data bytes follow separately (sendfile)."""
+    length = FILE_CHUNK.size + count
+    if length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"chunk too large ({count} bytes)")
+    return HEADER.pack(PROTOCOL_VERSION, MSG_FILE_CHUNK, 0, length) + FILE_CHUNK.pack(transfer_id, offset, crc)
+
+
+def decode_file_chunk(payload):
+    if len(payload) < FILE_CHUNK.size:
+        raise ProtocolError("malformed file chunk")
+    transfer_id, offset, crc = FILE_CHUNK.unpack_from(payload)
+    return transfer_id, offset, crc, memoryview(payload)[FILE_CHUNK.size:]
+
+
+def parse_header(header):
+    version, msg_type, flags, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"frame too large ({length} bytes)")
+    return msg_type, flags, length
+
+
+def decode_frame(data):
+    """A single complete frame, e.g. one UDP datagram."""
+    if len(data) < HEADER_SIZE:
+        raise ProtocolError("truncated frame")
+    msg_type, flags, length = parse_header(data[:HEADER_SIZE])
+    if len(data) != HEADER_SIZE + length:
+        raise ProtocolError(f"frame length {length} does not match the {len(data) - HEADER_SIZE} bytes received")
+    return Frame(msg_type, flags, bytes(data[HEADER_SIZE:]))
+
+
+class FrameReader:
+    """
+    Reads frames from a blocking socket into one reusable buffer.
+
+    Several frames that arrive in the same recv are parsed without another
+    syscall, and a frame split over several recvs is reassembled in place.
+    """
+
+    def __init__(self, sock, buffer_size=65536):
+        self.sock = sock
+        self._buf = bytearray(max(buffer_size, HEADER_SIZE))
+        self._start = 0
+        self._end = 0
+
+    def _ensure_room(self, needed):
+        # Move unread bytes to the front, then grow only if a frame is
+        # bigger than the whole buffer.
+        if self._start:
+            pending = self._end - self._start
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+        if needed > len(self._buf):
+            self._buf.extend(bytes(needed - len(self._buf)))
+
+    def _fill(self, needed):
+        if self._start + needed > len(self._buf):
+            self._ensure_room(needed)
+        with memoryview(self._buf) as view:
+            n = self.sock.recv_into(view[self._end:])
+        self._end += n
+        return n > 0
+
+    def read_frame(self):
+        """Return the next Frame, or None when the peer closed cleanly."""
+        while True:
+            available = self._end - self._start
+            if available >= HEADER_SIZE:
+                msg_type, flags, length = parse_header(
+                    self._buf[self._start:self._start + HEADER_SIZE]
+                )
+                total = HEADER_SIZE + length
+                if available >= total:
+                    begin = self._start + HEADER_SIZE
+                    payload = bytes(self._buf[begin:begin + length])
+                    self._start += total
+                    if self._start == self._end:
+                        self._start = self._end = 0
+                    return Frame(msg_type, flags, payload)
+                needed = total
+            else:
+                needed = HEADER_SIZE
+
+            if not self._fill(needed):
+                if self._end - self._start:
+                    raise ProtocolError("connection closed in the middle of a frame")
+                return None
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+
+async def read_frame_async(reader):
+    """asyncio counterpart of FrameReader.read_frame for a StreamReader."""
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError("connection closed in the middle of a frame")
+        return None
+
+    msg_type, flags, length = parse_header(header)
+    try:
+        payload = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("connection closed in the middle of a frame")
+    return Frame(msg_type, flags, payload)
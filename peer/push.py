@@ -0,0 +1,67 @@
+import random
+import threading
+
+import metrics
+
+RETRY_BASE = 1.0
+RETRY_MAX = 30.0
+
+PUSH_EVENTS = metrics.counter("peer_push_events_total", "Notifications received from the STUN server, by type")
+
+
+class PushListener:
+    """
+    Keeps one long-poll open on the STUN server's /events/ and hands each
+    batch of events to `on_events(events)`, so new messages, friendships
+    and address changes arrive within a round trip instead of at the next
+    manual fetch.
+
+    `on_reset()` is called when the server may have dropped events (it
+    restarted, or we were away longer than its backlog); the caller then
+    resyncs everything. Failed polls back off exponentially.
+
+    Start from the `cursor` returned by /session/bootstrap, so events
+    between the login and the first poll aren't skipped; without one the
+    first poll only fetches the current cursor.
+    """
+
+    def __init__(self, username, poll, on_events, on_reset, cursor=None):
+        self.username = username
+        self.poll = poll
+        self.on_events = on_events
+        self.on_reset = on_reset
+        self.cursor = cursor
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="push", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        cursor = self.cursor
+        failures = 0
+        while not self._stop.is_set():
+            result = self.poll(self.username, cursor)
+            if self._stop.is_set():
+                return
+            if result is None:
+                failures += 1
+                self._stop.wait(random.uniform(0.5, 1) * min(RETRY_MAX, RETRY_BASE * 2 ** failures))
+                continue
+            failures = 0
+            try:
+                if result["reset"] and cursor is not None:
+                    PUSH_EVENTS.inc(type="reset")
+                    self.on_reset()
+                if result["events"]:
+                    for event in result["events"]:
+                        PUSH_EVENTS.inc(type=event.get("type"))
+                    self.on_events(result["events"])
+            except Exception as e:
+                print(f"⚠️ [PUSH ERROR] {e}")
+            cursor = result["cursor"]
+
+    def close(self):
+        # A poll in flight returns within its wait; its result is discarded.
+        self._stop.set()
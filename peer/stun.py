@@ -0,0 +1,60 @@
+import ipaddress
+import os
+import struct
+
+# RFC 5389 message header (see the STUN server's server/stun.py):
+#
+#   0b00 + type (14 bits) | length (u16) | magic cookie (u32) | transaction id (12 bytes)
+#
+HEADER = struct.Struct("!HHI12s")
+MAGIC_COOKIE = 0x2112A442
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+ATTR_MAPPED_ADDRESS = 0x0001
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+FAMILY_IPV4 = 0x01
+
+
+def is_stun(data):
+    return len(data) >= HEADER.size and data[0] & 0xC0 == 0 and data[4:8] == MAGIC_COOKIE.to_bytes(4, "big")
+
+
+def binding_request():
+    """(transaction id, datagram) of a new Binding request."""
+    transaction_id = os.urandom(12)
+    return transaction_id, HEADER.pack(BINDING_REQUEST, 0, MAGIC_COOKIE, transaction_id)
+
+
+def transaction_id(data):
+    return data[8:HEADER.size]
+
+
+def _address(value, mask, txid):
+    family, port = value[1], struct.unpack_from("!H", value, 2)[0]
+    packed = value[4:8] if family == FAMILY_IPV4 else value[4:20]
+    if mask:
+        port ^= MAGIC_COOKIE >> 16
+        key = MAGIC_COOKIE.to_bytes(4, "big") + txid
+        packed = bytes(a ^ b for a, b in zip(packed, key))
+    return str(ipaddress.ip_address(packed)), port
+
+
+def parse_binding_response(data):
+    """(ip, port) reported by a Binding success response, or None."""
+    if not is_stun(data):
+        return None
+    msg_type, length, _, txid = HEADER.unpack_from(data)
+    if msg_type != BINDING_SUCCESS or len(data) < HEADER.size + length:
+        return None
+    mapped = None
+    offset, end = HEADER.size, HEADER.size + length
+    while offset + 4 <= end:
+        attr_type, attr_length = struct.unpack_from("!HH", data, offset)
+        value = data[offset + 4:offset + 4 + attr_length]
+        if attr_type == ATTR_XOR_MAPPED_ADDRESS:
+            return _address(value, True, txid)
+        if attr_type == ATTR_MAPPED_ADDRESS:
+            # Pre-RFC 5389 servers only send the plain attribute.
+            mapped = _address(value, False, txid)
+        offset += 4 + (attr_length + 3) // 4 * 4
+    return mapped
@@ -0,0 +1,101 @@
+import queue
+import socket
+import threading
+import time
+import unittest
+
+from aio_server import AsyncPeerServer
+from protocol import MSG_ACK, MSG_FILE_OFFER, MSG_HELLO, MSG_TEXT, FrameReader, encode_frame
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class AsyncPeerServerTest(unittest.TestCase):
+    def setUp(self):
+        self.hellos = queue.Queue()
+        self.frames = queue.Queue()
+        self.closed = queue.Queue()
+        self.server = AsyncPeerServer(
+            free_port(),
+            on_hello=self.hellos.put,
+            on_frame=lambda peer, frame: self.frames.put((peer, frame, threading.current_thread())),
+            on_close=self.closed.put,
+            host="127.0.0.1",
+            blocking_frames=(MSG_FILE_OFFER,)
+        ).start()
+        self.addCleanup(self.server.stop)
+
+    def dial(self, username):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(encode_frame(MSG_HELLO, username.encode()))
+        return sock
+
+    def test_frames_are_dispatched_in_order(self):
+        sock = self.dial("alice")
+        connection = self.hellos.get(timeout=5)
+        self.assertEqual(connection.username, "alice")
+        self.assertFalse(connection.outbound)
+
+        sock.sendall(encode_frame(MSG_TEXT, b"one") + encode_frame(MSG_FILE_OFFER, b"{}") + encode_frame(MSG_TEXT, b"two"))
+        received = [self.frames.get(timeout=5) for _ in range(3)]
+        self.assertEqual([(peer, frame.payload) for peer, frame, _ in received],
+                         [("alice", b"one"), ("alice", b"{}"), ("alice", b"two")])
+        # Blocking frames run off the loop thread, the others on it.
+        loop_thread = received[0][2]
+        self.assertEqual(loop_thread, self.server._thread)
+        self.assertNotEqual(received[1][2], loop_thread)
+        self.assertEqual(self.server.handler_count, 1)
+
+    def test_connection_sends_from_other_threads(self):
+        sock = self.dial("alice")
+        connection = self.hellos.get(timeout=5)
+        connection.send(MSG_ACK, b"x" * 16)
+        frame = FrameReader(sock).read_frame()
+        self.assertEqual((frame.type, frame.payload), (MSG_ACK, b"x" * 16))
+
+    def test_connection_without_hello_is_dropped(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        self.addCleanup(sock.close)
+        sock.sendall(encode_frame(MSG_TEXT, b"hi"))
+        self.assertEqual(sock.recv(1), b"")
+        self.assertTrue(self.hellos.empty())
+
+    def test_peer_disconnect_closes_the_connection(self):
+        sock = self.dial("alice")
+        connection = self.hellos.get(timeout=5)
+        sock.close()
+        self.assertIs(self.closed.get(timeout=5), connection)
+        self.assertTrue(connection.closed)
+        self.assertTrue(wait_until(lambda: self.server.handler_count == 0))
+
+    def test_stop_closes_connected_peers(self):
+        socks = [self.dial(name) for name in ("alice", "bob")]
+        connections = [self.hellos.get(timeout=5) for _ in socks]
+        self.assertTrue(wait_until(lambda: self.server.handler_count == 2))
+
+        self.server.stop()
+        self.assertFalse(self.server.running)
+        self.assertEqual(self.server.handler_count, 0)
+        self.assertEqual({self.closed.get(timeout=5) for _ in socks}, set(connections))
+        for sock in socks:
+            self.assertEqual(sock.recv(1), b"")
+        with self.assertRaises(OSError):
+            socket.create_connection(("127.0.0.1", self.server.port), timeout=1).close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import argparse
+import socket
+import unittest
+
+import bench
+
+
+def free_port_range(count):
+    """A base port with `count` free ports after it (best effort)."""
+    for _ in range(20):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            base = probe.getsockname()[1]
+        if base + count > 65535:
+            continue
+        try:
+            for port in range(base, base + count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port))
+        except OSError:
+            continue
+        return base
+    raise RuntimeError("no free port range")
+
+
+class BenchSmokeTest(unittest.TestCase):
+    def test_short_run_delivers_messages(self):
+        args = argparse.Namespace(peers=2, duration=1.0, size=64, rate=50, server_mode="asyncio",
+                                  base_port=free_port_range(2))
+        result = bench.run(args)
+        self.assertGreater(result["total"]["sent"], 0)
+        self.assertGreater(result["total"]["received"], 0)
+        self.assertIsNotNone(result["total"]["latency_ms"]["p50"])
+
+
+if __name__ == "__main__":
+    unittest.main()
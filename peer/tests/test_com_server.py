@@ -0,0 +1,187 @@
+import json
+import socket
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+from com_server import PeerAddressCache, StunClient
+from connections import ConnectionManager
+from protocol import MSG_HELLO, FrameReader
+
+
+class ScriptedServer:
+    """Local HTTP server answering each request with the next (status, body)."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append((self.path, None))
+                self._reply()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                server.requests.append((self.path, json.loads(body or b"null")))
+                self._reply()
+
+            def _reply(self):
+                status, reply = server.answers.pop(0)
+                data = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class SaveMessagesTest(unittest.TestCase):
+    batch = [
+        {"sender": "alice", "receiver": "bob", "content": "hi"},
+        {"sender": "alice", "receiver": "bob", "content": ""},
+    ]
+
+    def save(self, status, body):
+        server = ScriptedServer([(status, body)])
+        self.addCleanup(server.close)
+        client = StunClient(server.url, retries=0)
+        self.addCleanup(client.close)
+        result = client.save_messages(self.batch)
+        self.assertEqual(server.requests[0][0], "/message/bulk_create/")
+        return result
+
+    def test_stored_batch_with_rejected_items_is_done(self):
+        body = {"status": "ok", "count": 1, "message_ids": [7, None],
+                "errors": [{"index": 1, "error": "Missing fields"}]}
+        self.assertIs(self.save(201, body), True)
+
+    def test_client_errors_are_permanent(self):
+        self.assertIsNone(self.save(400, {"error": "No valid messages", "errors": []}))
+        self.assertIsNone(self.save(404, {"error": "not found"}))
+
+    def test_server_errors_and_throttling_are_retried(self):
+        self.assertIs(self.save(500, {"error": "boom"}), False)
+        self.assertIs(self.save(429, {"error": "slow down"}), False)
+
+    def test_unreachable_server_is_retried(self):
+        server = ScriptedServer([])
+        url = server.url
+        server.close()
+        client = StunClient(url, retries=0)
+        self.addCleanup(client.close)
+        self.assertIs(client.save_messages(self.batch), False)
+
+
+class RetryTest(unittest.TestCase):
+    def test_server_errors_are_retried_and_their_responses_released(self):
+        server = ScriptedServer([(503, {"error": "busy"}), (500, {"error": "boom"}), (200, {"ok": True})])
+        self.addCleanup(server.close)
+        client = StunClient(server.url, retries=2, backoff=0.001)
+        self.addCleanup(client.close)
+
+        close = requests.Response.close
+        with mock.patch.object(requests.Response, "close", autospec=True, side_effect=close) as closed:
+            # Streamed, so only close() gives the connection back to the pool.
+            r = client._get("/message/export/", stream=True)
+            self.assertEqual(closed.call_count, 2)
+        self.assertEqual((r.status_code, r.json()), (200, {"ok": True}))
+        r.close()
+        self.assertEqual(len(server.requests), 3)
+
+    def test_last_server_error_is_returned(self):
+        server = ScriptedServer([(500, {"error": "boom"})] * 2)
+        self.addCleanup(server.close)
+        client = StunClient(server.url, retries=1, backoff=0.001)
+        self.addCleanup(client.close)
+        r = client._get("/peers")
+        self.assertEqual(r.status_code, 500)
+        self.assertEqual(len(server.requests), 2)
+
+
+class PeerAddressCacheTest(unittest.TestCase):
+    def client(self, *answers, **cache_options):
+        server = ScriptedServer(answers)
+        self.addCleanup(server.close)
+        client = StunClient(server.url, retries=0)
+        self.addCleanup(client.close)
+        if cache_options:
+            client.peer_cache = PeerAddressCache(**cache_options)
+        return server, client
+
+    def test_cache_hits_need_no_request(self):
+        alice = {"username": "alice", "ip": "10.0.0.1", "port": 5000}
+        server, client = self.client((200, alice))
+        self.assertEqual(client.resolve_peer("alice"), alice)
+        self.assertEqual(client.resolve_peer("alice"), alice)
+        self.assertEqual(server.requests, [("/peerinfo?username=alice", None)])
+        self.assertEqual(client.peer_cache.stats(), {"hits": 1, "misses": 1, "hit_ratio": 0.5, "size": 1})
+
+    def test_unknown_usernames_are_cached_too(self):
+        server, client = self.client((404, {"error": "Peer not found"}))
+        self.assertIsNone(client.resolve_peer("nobody"))
+        self.assertIsNone(client.resolve_peer("nobody"))
+        self.assertEqual(len(server.requests), 1)
+
+    def test_server_errors_are_not_cached(self):
+        alice = {"username": "alice", "ip": "10.0.0.1", "port": 5000}
+        server, client = self.client((500, {"error": "boom"}), (200, alice))
+        self.assertIsNone(client.resolve_peer("alice"))
+        self.assertEqual(client.resolve_peer("alice"), alice)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_entries_expire(self):
+        before = {"username": "alice", "ip": "10.0.0.1", "port": 5000}
+        after = {"username": "alice", "ip": "10.0.0.2", "port": 5000}
+        server, client = self.client((200, before), (200, after), (404, {}), (200, after),
+                                     ttl=0.05, negative_ttl=0.05)
+        self.assertEqual(client.resolve_peer("alice"), before)
+        time.sleep(0.1)
+        self.assertEqual(client.resolve_peer("alice"), after)
+        self.assertIsNone(client.resolve_peer("bob"))
+        time.sleep(0.1)
+        self.assertEqual(client.resolve_peer("bob"), after)
+        self.assertEqual(len(server.requests), 4)
+
+    def test_failed_connect_drops_the_cached_address(self):
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            moved_away = {"username": "alice", "ip": "127.0.0.1", "port": unused.getsockname()[1]}
+        current = {"username": "alice", "ip": "127.0.0.1", "port": listener.getsockname()[1]}
+        server, client = self.client((200, moved_away), (200, current))
+
+        manager = ConnectionManager("bob", on_frame=lambda sender, frame: None, attempts=1,
+                                    resolve=client.resolve_peer, invalidate=client.invalidate_peer)
+        self.addCleanup(manager.close_all)
+        conn = manager.connect(client.resolve_peer("alice"))
+        accepted, _ = listener.accept()
+        self.addCleanup(accepted.close)
+        hello = FrameReader(accepted).read_frame()
+        self.assertEqual((hello.type, hello.payload), (MSG_HELLO, b"bob"))
+        self.assertEqual(conn.sock.getpeername(), ("127.0.0.1", current["port"]))
+
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(client.resolve_peer("alice"), current)
+        self.assertEqual(len(server.requests), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import unittest
+
+import compression
+from compression import FLAG_COMPRESSED, FrameCodec
+from protocol import MSG_MESSAGE, MSG_TEXT, Frame, ProtocolError, decode_frame
+
+TEXTS = [
+    "hey, how are you doing today? let me know when you're free for a call",
+    "I'm good thanks! what about a meeting tomorrow morning, does that work for you?",
+    "sure, tomorrow morning works. see you then, have a good day",
+    "ok",
+]
+
+
+class FrameCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.sender = FrameCodec()
+        self.receiver = FrameCodec()
+
+    def round_trip(self, msg_type, payload):
+        frame = decode_frame(self.sender.encode(msg_type, payload))
+        return frame, self.receiver.decode(frame)
+
+    def test_frames_round_trip_in_order(self):
+        for text in TEXTS:
+            wire, frame = self.round_trip(MSG_MESSAGE, text.encode())
+            self.assertEqual(frame, Frame(MSG_MESSAGE, 0, text.encode()))
+            self.assertEqual(bool(wire.flags & FLAG_COMPRESSED), len(text) >= compression.COMPRESSION_THRESHOLD)
+        self.assertLess(self.sender.ratio, 1.0)
+
+    def test_stream_history_shrinks_repeated_text(self):
+        first, _ = self.round_trip(MSG_TEXT, TEXTS[0].encode())
+        again, frame = self.round_trip(MSG_TEXT, TEXTS[0].encode())
+        self.assertEqual(frame.payload, TEXTS[0].encode())
+        self.assertLess(len(again.payload), len(first.payload))
+
+    def test_other_flags_survive(self):
+        frame = self.receiver.decode(decode_frame(self.sender.encode(MSG_TEXT, b"y" * 200, flags=0x80)))
+        self.assertEqual((frame.flags, frame.payload), (0x80, b"y" * 200))
+
+    def test_corrupt_frame(self):
+        with self.assertRaises(ProtocolError):
+            self.receiver.decode(Frame(MSG_TEXT, FLAG_COMPRESSED, b"\xff" * 20))
+
+
+class NegotiationTest(unittest.TestCase):
+    def test_matching_offer_enables_compression(self):
+        answer, enabled = compression.negotiate(compression.offer())
+        self.assertTrue(enabled)
+        self.assertTrue(compression.accepted(answer))
+
+    def test_other_dictionary_or_algorithm_disables_it(self):
+        for caps in ({"compression": ["zlib"], "dictionary": compression.DICTIONARY_ID + 1},
+                     {"compression": ["zstd"], "dictionary": compression.DICTIONARY_ID},
+                     {}):
+            answer, enabled = compression.negotiate(json.dumps(caps).encode())
+            self.assertFalse(enabled)
+            self.assertFalse(compression.accepted(answer))
+
+    def test_malformed_capabilities(self):
+        with self.assertRaises(ProtocolError):
+            compression.negotiate(b"\xff{")
+        with self.assertRaises(ProtocolError):
+            compression.accepted(b"not json")
+
+
+if __name__ == "__main__":
+    unittest.main()
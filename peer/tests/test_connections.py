@@ -0,0 +1,143 @@
+import queue
+import socket
+import threading
+import time
+import unittest
+
+from connections import ConnectionManager
+from protocol import MSG_HELLO, MSG_TEXT, FrameReader
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Peer:
+    """A ConnectionManager with a listener that accepts like main.handle_peer."""
+
+    def __init__(self, username):
+        self.username = username
+        self.frames = queue.Queue()
+        self.manager = ConnectionManager(username, on_frame=lambda sender, frame: self.frames.put((sender, frame)))
+        self.created = []  # every connection the manager adopted, in order
+        adopt = self.manager.adopt_socket
+
+        def adopt_socket(*args, **kwargs):
+            conn = adopt(*args, **kwargs)
+            self.created.append(conn)
+            return conn
+
+        self.manager.adopt_socket = adopt_socket
+        self.admit = threading.Event()  # incoming connections wait for this before registering
+        self.admit.set()
+
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.address = {"username": username, "ip": "127.0.0.1", "port": self.listener.getsockname()[1]}
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(sock,), daemon=True).start()
+
+    def _handle(self, sock):
+        reader = FrameReader(sock)
+        hello = reader.read_frame()
+        if hello is None or hello.type != MSG_HELLO:
+            sock.close()
+            return
+        self.admit.wait()
+        conn = self.manager.adopt_socket(sock, hello.payload.decode(), reader, outbound=False)
+        self.manager.register(conn)
+        conn.read_loop()
+
+    def close(self):
+        self.listener.close()
+        self.manager.close_all()
+
+    def received(self):
+        sender, frame = self.frames.get(timeout=5)
+        return sender, frame.payload
+
+
+class ConnectionManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.alice = Peer("alice")
+        self.bob = Peer("bob")
+        self.addCleanup(self.alice.close)
+        self.addCleanup(self.bob.close)
+
+    def test_simultaneous_dials_keep_the_connection_opened_by_the_first_username(self):
+        # Both dial before either side registers the other's incoming connection.
+        self.alice.admit.clear()
+        self.bob.admit.clear()
+        dialed = {}
+        threads = [
+            threading.Thread(target=lambda: dialed.update(alice=self.alice.manager.connect(self.bob.address))),
+            threading.Thread(target=lambda: dialed.update(bob=self.bob.manager.connect(self.alice.address))),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertTrue(dialed["alice"].outbound and dialed["bob"].outbound)
+        self.alice.admit.set()
+        self.bob.admit.set()
+
+        self.assertTrue(wait_until(lambda: len(self.alice.created) == len(self.bob.created) == 2))
+        self.assertTrue(wait_until(lambda: self.bob.manager.get("alice") is not dialed["bob"]))
+        at_alice, at_bob = self.alice.manager.get("bob"), self.bob.manager.get("alice")
+        self.assertIs(at_alice, dialed["alice"])
+        self.assertFalse(at_bob.outbound)
+        self.assertEqual(at_alice.sock.getsockname(), at_bob.sock.getpeername())
+
+        # bob closes the connection it dialed; alice's end of it sees the EOF.
+        self.assertTrue(dialed["bob"].closed)
+        bob_dialed_at_alice = next(conn for conn in self.alice.created if not conn.outbound)
+        self.assertTrue(wait_until(lambda: bob_dialed_at_alice.closed))
+        self.assertIs(self.alice.manager.get("bob"), at_alice)
+
+        self.bob.manager.send(self.alice.address, MSG_TEXT, b"hi alice")
+        self.assertEqual(self.alice.received(), ("bob", b"hi alice"))
+        self.alice.manager.send(self.bob.address, MSG_TEXT, b"hi bob")
+        self.assertEqual(self.bob.received(), ("alice", b"hi bob"))
+
+    def test_connection_is_reused(self):
+        first = self.alice.manager.connect(self.bob.address)
+        self.assertIs(self.alice.manager.connect(self.bob.address), first)
+        self.assertTrue(wait_until(lambda: self.bob.manager.get("alice")))
+        self.assertIs(self.bob.manager.connect(self.alice.address), self.bob.manager.get("alice"))
+        self.assertEqual(len(self.bob.created), 1)
+
+    def test_send_on_a_broken_connection_reconnects_once(self):
+        broken = self.alice.manager.send(self.bob.address, MSG_TEXT, b"one")
+        self.assertEqual(self.bob.received(), ("alice", b"one"))
+        # Still registered and not closed, but writing fails.
+        broken.sock.shutdown(socket.SHUT_WR)
+
+        fresh = self.alice.manager.send(self.bob.address, MSG_TEXT, b"two")
+        self.assertIsNot(fresh, broken)
+        self.assertTrue(broken.closed)
+        self.assertIs(self.alice.manager.get("bob"), fresh)
+        self.assertEqual(self.bob.received(), ("alice", b"two"))
+
+    def test_unreachable_peer(self):
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            carol = {"username": "carol", "ip": "127.0.0.1", "port": unused.getsockname()[1]}
+        manager = ConnectionManager("alice", on_frame=lambda sender, frame: None, attempts=2, backoff=0.01)
+        with self.assertRaises(OSError):
+            manager.send(carol, MSG_TEXT, b"hi")
+        self.assertIsNone(manager.get("carol"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+from conversation_store import ConversationStore, MessageRecord, record_size
+
+
+def texts(records):
+    return [record.text for record in records]
+
+
+class ConversationStoreTest(unittest.TestCase):
+    def test_messages_keep_their_order(self):
+        store = ConversationStore()
+        store.append("bob", "alice", "one", id=1)
+        store.append("bob", "bob", "two")
+        store.extend("bob", [MessageRecord(3, "alice", "three"), MessageRecord(4, "bob", "four")])
+        self.assertEqual(texts(store.recent("bob")), ["one", "two", "three", "four"])
+        self.assertEqual(texts(store.recent("bob", limit=2)), ["three", "four"])
+        self.assertEqual([(r.id, r.sender) for r in store.recent("bob")],
+                         [(1, "alice"), (None, "bob"), (3, "alice"), (4, "bob")])
+        self.assertEqual(store.recent("carol"), [])
+
+    def test_each_conversation_keeps_its_last_messages(self):
+        store = ConversationStore(capacity=3)
+        for i in range(5):
+            store.append("bob", "bob", f"m{i}")
+        store.append("carol", "carol", "hi")
+        self.assertEqual(texts(store.recent("bob")), ["m2", "m3", "m4"])
+        self.assertEqual(texts(store.recent("carol")), ["hi"])
+        # Dropped messages no longer count against the budget.
+        expected = sum(record_size(r) for peer in ("bob", "carol") for r in store.recent(peer))
+        self.assertEqual(store.memory_usage, expected)
+        self.assertEqual(store.stats(), {"conversations": 2, "messages": 4, "bytes": expected, "evictions": 0})
+
+    def test_least_recently_used_conversation_is_evicted(self):
+        size = record_size(MessageRecord(None, "x", "x" * 100))
+        store = ConversationStore(memory_budget=3 * size)
+        for peer in ("bob", "carol", "dave"):
+            store.append(peer, peer, "x" * 100)
+        store.recent("bob")  # bob is now more recent than carol
+
+        store.append("erin", "erin", "x" * 100)
+        self.assertEqual(list(store), ["dave", "bob", "erin"])
+        self.assertNotIn("carol", store)
+        self.assertEqual(store.evictions, 1)
+        self.assertEqual(store.memory_usage, 3 * size)
+
+    def test_conversation_being_written_is_never_evicted(self):
+        size = record_size(MessageRecord(None, "x", "x" * 100))
+        store = ConversationStore(memory_budget=2 * size)
+        store.append("bob", "bob", "x" * 100)
+        store.extend("carol", [MessageRecord(None, "carol", "x" * 100) for _ in range(4)])
+        self.assertEqual(list(store), ["carol"])
+        self.assertEqual(len(store.recent("carol")), 4)
+
+    def test_evicted_conversation_is_reloaded(self):
+        loads = []
+
+        def loader(peer):
+            loads.append(peer)
+            return [MessageRecord(1, peer, "from disk")]
+
+        size = record_size(MessageRecord(None, "x", "x" * 100))
+        store = ConversationStore(memory_budget=2 * size, loader=loader)
+        store.append("bob", "bob", "x" * 100)
+        store.append("carol", "carol", "x" * 100)
+        store.append("dave", "dave", "x" * 100)
+        self.assertNotIn("bob", store)
+
+        self.assertEqual(texts(store.recent("bob")), ["from disk"])
+        self.assertEqual(loads, ["bob", "carol", "dave", "bob"])
+        store.recent("bob")
+        self.assertEqual(loads.count("bob"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,220 @@
+import json
+import os
+import queue
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import file_transfer
+from connections import SocketConnection
+from file_transfer import FileTransfers
+from local_store import LocalStore
+from protocol import MSG_FILE_CHUNK, MSG_FILE_OFFER, MSG_FILE_RESUME, Frame, decode_file_chunk
+
+CHUNK = 16 * 1024
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Side:
+    """ConnectionManager stand-in for one peer: its end of the current link."""
+
+    def __init__(self, link):
+        self.link = link
+        self.conn = None
+
+    def get(self, username):
+        return self.conn if self.conn and self.conn.alive else None
+
+    def connect(self, peer):
+        self.link.connect()
+        return self.conn
+
+
+class Link:
+    """alice -> bob over a socketpair, opened again (by alice) after a disconnect."""
+
+    def __init__(self, on_alice_frame, on_bob_frame, alice_name="alice"):
+        self.alice = Side(self)
+        self.bob = Side(self)
+        self.on_alice_frame = on_alice_frame
+        self.on_bob_frame = on_bob_frame
+        self.alice_name = alice_name
+        self.count = 0
+
+    def connect(self):
+        a, b = socket.socketpair()
+        self.count += 1
+        self.alice.conn = SocketConnection(a, "bob", None, True, self.on_alice_frame, lambda conn: None).start()
+        self.bob.conn = SocketConnection(b, self.alice_name, None, False, self.on_bob_frame,
+                                         lambda conn: None).start()
+        return self
+
+    def close(self):
+        for side in (self.alice, self.bob):
+            if side.conn:
+                side.conn.close()
+
+
+class FileTransferTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.home = directory.name
+        self.downloads = os.path.join(self.home, "downloads")
+        self.chunks = []  # (link number, offset) of every chunk bob handled
+
+        self.link = Link(lambda peer, frame: self.alice.handle(peer, frame), self.on_bob_frame)
+        self.alice = self.transfers("alice", self.link.alice)
+        self.bob = self.transfers("bob", self.link.bob)
+        self.link.connect()
+        self.addCleanup(self.link.close)
+
+        self.data = os.urandom(10 * CHUNK + 123)
+        self.path = os.path.join(self.home, "photo.jpg")
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def transfers(self, username, side, **kwargs):
+        store = LocalStore(username, os.path.join(self.home, username))
+        self.addCleanup(store.close)
+        transfers = FileTransfers(store, side, lambda name: None, download_dir=self.downloads, chunk_size=CHUNK,
+                                  **kwargs)
+        self.addCleanup(transfers.close)
+        return transfers
+
+    def on_bob_frame(self, peer, frame):
+        if frame.type == MSG_FILE_CHUNK:
+            self.chunks.append((self.link.count, decode_file_chunk(frame.payload)[1]))
+            frame = self.tamper(frame)
+        self.bob.handle(peer, frame)
+        if frame.type == MSG_FILE_CHUNK:
+            self.after_chunk()
+
+    def tamper(self, frame):
+        return frame
+
+    def after_chunk(self):
+        pass
+
+    def received(self):
+        path = os.path.join(self.downloads, "alice", "photo.jpg")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def send(self):
+        self.alice.send({"username": "bob", "ip": "127.0.0.1", "port": 5000}, self.path)
+        self.assertTrue(wait_until(lambda: self.received() is not None and not self.alice.active()[0]))
+        self.assertEqual(self.received(), self.data)
+        self.assertEqual(self.bob.active(), ([], []))
+
+    def test_round_trip(self):
+        self.send()
+        self.assertEqual([offset for _, offset in self.chunks], list(range(0, len(self.data), CHUNK)))
+        self.assertFalse(os.path.exists(os.path.join(self.downloads, "alice", "photo.jpg.part")))
+
+    def test_interrupted_transfer_resumes_where_it_stopped(self):
+        def drop_link():
+            if self.link.count == 1 and len(self.chunks) == 4:
+                self.link.close()
+
+        self.after_chunk = drop_link
+        # The sender notices the drop when the receiver's answer is overdue.
+        with mock.patch.multiple(file_transfer, BACKOFF_BASE=0.01, REPLY_TIMEOUT=0.5):
+            self.send()
+        self.assertEqual(self.link.count, 2)
+        first = [offset for link, offset in self.chunks if link == 1]
+        resumed = [offset for link, offset in self.chunks if link == 2]
+        self.assertGreaterEqual(len(first), 4)
+        self.assertEqual(resumed[0], len(first) * CHUNK)
+        self.assertEqual(resumed[-1], 10 * CHUNK)
+
+    def test_corrupt_chunk_is_sent_again(self):
+        corrupted = []
+
+        def flip_a_bit(frame):
+            tid, offset, crc, data = decode_file_chunk(frame.payload)
+            if offset == 3 * CHUNK and not corrupted:
+                corrupted.append(offset)
+                payload = bytearray(frame.payload)
+                payload[-1] ^= 1
+                return Frame(frame.type, frame.flags, bytes(payload))
+            return frame
+
+        self.tamper = flip_a_bit
+        self.send()
+        self.assertEqual(corrupted, [3 * CHUNK])
+        offsets = [offset for _, offset in self.chunks]
+        self.assertGreaterEqual(offsets.count(3 * CHUNK), 2)
+        self.assertEqual(self.link.count, 1)
+
+
+class RejectedOfferTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.downloads = os.path.join(directory.name, "downloads")
+        self.replies = queue.Queue()
+        store = LocalStore("bob", directory.name)
+        self.addCleanup(store.close)
+        self.link = None
+        self.bob = None
+        self.store = store
+
+    def offer(self, name="notes.txt", size=100, peer_name="alice", max_size=1000):
+        self.link = Link(lambda peer, frame: self.replies.put(frame),
+                         lambda peer, frame: self.bob.handle(peer, frame), alice_name=peer_name)
+        self.bob = FileTransfers(self.store, self.link.bob, lambda name: None, download_dir=self.downloads,
+                                 max_size=max_size)
+        self.addCleanup(self.bob.close)
+        self.link.connect()
+        self.addCleanup(self.link.close)
+        self.link.alice.conn.send(MSG_FILE_OFFER, json.dumps(
+            {"id": "ab" * 16, "name": name, "size": size, "chunk_size": CHUNK}
+        ).encode())
+        frame = self.replies.get(timeout=5)
+        self.assertEqual(frame.type, MSG_FILE_RESUME)
+        return json.loads(frame.payload)
+
+    def assertRejected(self, reply):
+        self.assertIn("error", reply)
+        self.assertEqual(self.bob.active(), ([], []))
+
+    def test_accepted_offer(self):
+        self.assertEqual(self.offer(), {"id": "ab" * 16, "offset": 0})
+        self.assertTrue(os.path.exists(os.path.join(self.downloads, "alice", "notes.txt.part")))
+
+    def test_oversized_offer(self):
+        self.assertRejected(self.offer(size=1001))
+        self.assertFalse(os.path.exists(self.downloads))
+
+    def test_offer_larger_than_the_free_space(self):
+        with mock.patch.object(file_transfer, "FREE_SPACE_MARGIN", 1 << 60):
+            self.assertRejected(self.offer())
+
+    def test_file_name_outside_the_download_directory(self):
+        for name in ("../notes.txt", "../../.bashrc", "/etc/passwd", "a/b.txt", "..", ""):
+            with self.subTest(name=name):
+                self.assertRejected(self.offer(name=name))
+        self.assertFalse(os.path.exists(self.downloads))
+
+    def test_peer_name_outside_the_download_directory(self):
+        for peer_name in ("..", "../mallory", "/tmp", "a/../.."):
+            with self.subTest(peer_name=peer_name):
+                self.assertRejected(self.offer(peer_name=peer_name))
+        self.assertFalse(os.path.exists(self.downloads))
+
+
+if __name__ == "__main__":
+    unittest.main()
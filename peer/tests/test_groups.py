@@ -0,0 +1,97 @@
+import threading
+import time
+import unittest
+
+from groups import GroupFanout
+from protocol import MSG_GROUP, decode_group_message
+
+
+class FakeConnections:
+    """ConnectionManager stand-in; `behaviour[username]` runs before a send succeeds."""
+
+    def __init__(self, behaviour=None):
+        self.behaviour = behaviour or {}
+        self.connected = set()
+        self.sent = []
+        self.attempts = []
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        return object() if username in self.connected else None
+
+    def send(self, member, msg_type, payload):
+        username = member["username"]
+        with self._lock:
+            self.attempts.append(username)
+        action = self.behaviour.get(username)
+        if action:
+            action()
+        with self._lock:
+            self.sent.append((username, msg_type, decode_group_message(payload)))
+
+
+def members(*names):
+    return [{"username": name, "ip": "127.0.0.1", "port": 5000} for name in names]
+
+
+def offline():
+    raise ConnectionRefusedError("offline")
+
+
+class GroupFanoutTest(unittest.TestCase):
+    def fanout(self, connections, **options):
+        fanout = GroupFanout(connections, **options)
+        self.addCleanup(fanout.close)
+        return fanout
+
+    def test_members_are_sent_to_in_parallel(self):
+        names = [f"m{i}" for i in range(20)]
+        # Only returns once every member's send has started.
+        everyone = threading.Barrier(len(names), timeout=5)
+        connections = FakeConnections({name: everyone.wait for name in names})
+        delivered, unreachable = self.fanout(connections, timeout=5).send("team", members(*names), "hi", b"1" * 16)
+        self.assertEqual((sorted(delivered), unreachable), (sorted(names), []))
+        self.assertEqual({(msg_type, message) for _, msg_type, message in connections.sent},
+                         {(MSG_GROUP, (b"1" * 16, "team", "hi"))})
+
+    def test_failing_and_slow_members_do_not_hold_up_the_others(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        connections = FakeConnections({"bob": offline, "carol": release.wait})
+        fanout = self.fanout(connections, timeout=0.3)
+        started = time.monotonic()
+        delivered, unreachable = fanout.send("team", members("bob", "carol", "dave", "erin"), "hi")
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(sorted(delivered), ["dave", "erin"])
+        self.assertEqual(sorted(unreachable), ["bob", "carol"])
+
+    def test_unreachable_members_are_not_dialed_again_for_a_while(self):
+        connections = FakeConnections({"bob": offline})
+        fanout = self.fanout(connections, offline_retry=60)
+        fanout.send("team", members("bob", "dave"), "one")
+        fanout.send("team", members("bob", "dave"), "two")
+        self.assertEqual(connections.attempts.count("bob"), 1)
+
+        # Unless bob connects to us in the meantime.
+        connections.connected.add("bob")
+        del connections.behaviour["bob"]
+        delivered, _ = fanout.send("team", members("bob", "dave"), "three")
+        self.assertEqual(sorted(delivered), ["bob", "dave"])
+
+        connections.connected.clear()
+        self.assertEqual(sorted(fanout.send("team", members("bob"), "four")[0]), ["bob"])
+
+    def test_close_stops_the_workers(self):
+        fanout = GroupFanout(FakeConnections())
+        fanout.send("team", members("bob", "carol"), "hi")
+        fanout.close()
+        with self.assertRaises(RuntimeError):
+            fanout.send("team", members("bob"), "too late")
+        deadline = time.monotonic() + 5
+        while any(t.name.startswith("fanout") for t in threading.enumerate()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse([t for t in threading.enumerate() if t.name.startswith("fanout")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import main
+from local_store import LocalStore
+
+
+def server_messages(ids, sender="bob"):
+    return [{"id": i, "from": sender, "message": f"m{i}", "msg_id": None} for i in ids]
+
+
+class LoadOlderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = LocalStore("alice", directory.name)
+        self.addCleanup(self.store.close)
+        self.pages = []
+
+        def fetch_page(conversation, before=None, after=None, limit=main.PAGE_SIZE):
+            self.pages.append((conversation, before, limit))
+            return {"messages": self.server.get(before, [])}
+
+        self.server = {}
+        for name, value in (("local_store", self.store), ("fetch_page", fetch_page), ("history_before", {}),
+                            ("PAGE_SIZE", 2)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def texts(self, records):
+        return [record.text for record in records]
+
+    def test_pages_back_through_local_then_server_history(self):
+        self.store.merge_server_messages("bob", server_messages([5, 6, 7]))
+        main.history_before["bob"] = 7
+        self.server = {5: server_messages([3, 4]), 3: server_messages([2])}
+
+        self.assertEqual(self.texts(main.load_older("bob")), ["m5", "m6"])
+        self.assertEqual(self.pages, [])
+        self.assertEqual(self.texts(main.load_older("bob")), ["m3", "m4"])
+        self.assertEqual(self.pages, [("bob", 5, 2)])
+        self.assertEqual(self.texts(main.load_older("bob")), ["m2"])
+        self.assertEqual(self.texts(main.load_older("bob")), [])
+        self.assertEqual(self.pages[-1], ("bob", 2, 2))
+
+    def test_no_fetch_without_a_synced_message(self):
+        # Sent while the server was unreachable: no server id to page back from.
+        self.store.add_local("bob", "alice", "offline message")
+        self.server = {None: server_messages([8, 9])}
+
+        self.assertEqual(main.load_older("bob"), [])
+        self.assertEqual(self.pages, [])
+        self.assertEqual(self.texts(self.store.recent("bob")), ["offline message"])
+
+
+if __name__ == "__main__":
+    unittest.main()
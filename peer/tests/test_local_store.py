@@ -0,0 +1,80 @@
+import sqlite3
+import tempfile
+import unittest
+
+from local_store import LocalStore
+
+
+class LocalStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.store = LocalStore("bob", self.directory)
+        self.addCleanup(self.store.close)
+
+    def rows(self, peer="alice"):
+        with self.store._lock:
+            return self.store._conn.execute(
+                "SELECT server_id, content FROM messages WHERE peer = ? ORDER BY local_id", (peer,)
+            ).fetchall()
+
+    def test_replay_after_server_sync_is_not_stored_twice(self):
+        new = self.store.merge_server_messages("alice", [{"id": 10, "message": "hi", "from": "alice", "msg_id": "ab"}])
+        self.assertEqual(len(new), 1)
+        self.assertFalse(self.store.add_local("alice", "alice", "hi", "ab"))
+        self.assertEqual(self.rows(), [(10, "hi")])
+
+    def test_server_copy_of_a_p2p_message_gets_its_id(self):
+        self.assertTrue(self.store.add_local("alice", "alice", "hi", "ab"))
+        new = self.store.merge_server_messages("alice", [{"id": 10, "message": "hi", "from": "alice", "msg_id": "ab"}])
+        self.assertEqual(new, [])
+        self.assertEqual(self.rows(), [(10, "hi")])
+        self.assertEqual(self.store.cursor("alice"), 10)
+
+    def test_same_text_with_another_id_is_a_new_message(self):
+        self.store.add_local("alice", "alice", "hi", "ab")
+        new = self.store.merge_server_messages("alice", [{"id": 10, "message": "hi", "from": "alice", "msg_id": "cd"}])
+        self.assertEqual(len(new), 1)
+        self.assertEqual(self.rows(), [(None, "hi"), (10, "hi")])
+
+    def test_duplicate_server_copies_are_merged_once(self):
+        self.store.merge_server_messages("alice", [
+            {"id": 10, "message": "hi", "from": "alice", "msg_id": "ab"},
+            {"id": 11, "message": "hi", "from": "alice", "msg_id": "ab"},
+        ])
+        self.assertEqual(self.rows(), [(10, "hi")])
+
+    def test_messages_without_id_match_by_content(self):
+        self.store.add_local("alice", "bob", "hello")
+        new = self.store.merge_server_messages("alice", [{"id": 3, "message": "hello", "from": "bob"}])
+        self.assertEqual(new, [])
+        self.assertEqual(self.rows(), [(3, "hello")])
+        self.assertTrue(self.store.add_local("alice", "bob", "hello"))
+
+    def test_recent_and_before_page_through_history(self):
+        self.store.merge_server_messages("alice", [
+            {"id": i, "message": f"m{i}", "from": "alice"} for i in range(1, 6)
+        ])
+        self.store.add_local("alice", "bob", "unsynced")
+        self.assertEqual([m.text for m in self.store.recent("alice", 3)], ["m4", "m5", "unsynced"])
+        self.assertEqual([m.text for m in self.store.before("alice", 4, 2)], ["m2", "m3"])
+        self.assertEqual(self.store.oldest_server_id("alice"), 1)
+
+    def test_store_from_before_msg_ids_is_upgraded(self):
+        conn = sqlite3.connect(f"{self.directory}/carol.sqlite3")
+        conn.executescript(
+            "CREATE TABLE messages (local_id INTEGER PRIMARY KEY AUTOINCREMENT, peer TEXT NOT NULL, "
+            "server_id INTEGER UNIQUE, sender TEXT NOT NULL, content TEXT NOT NULL);"
+            "INSERT INTO messages (peer, sender, content) VALUES ('alice', 'alice', 'old');"
+        )
+        conn.close()
+        store = LocalStore("carol", self.directory)
+        self.addCleanup(store.close)
+        self.assertTrue(store.add_local("alice", "alice", "new", "ab"))
+        self.assertFalse(store.add_local("alice", "alice", "new", "ab"))
+        self.assertEqual([m.text for m in store.recent("alice")], ["old", "new"])
+
+
+if __name__ == "__main__":
+    unittest.main()
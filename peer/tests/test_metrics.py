@@ -0,0 +1,101 @@
+import re
+import unittest
+import urllib.error
+import urllib.request
+
+from metrics import MetricsServer, Registry
+
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? \S+$')
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def lines(self):
+        text = self.registry.render()
+        self.assertTrue(text.endswith("\n"))
+        lines = text.splitlines()
+        for line in lines:
+            if not line.startswith("#"):
+                self.assertRegex(line, SAMPLE)
+        return lines
+
+    def test_counter(self):
+        frames = self.registry.counter("frames_total", "Frames sent, by type")
+        frames.inc(type="text")
+        frames.inc(2, type="text")
+        frames.inc(type="ack")
+        self.assertIs(self.registry.counter("frames_total", "again"), frames)
+        self.assertEqual(self.lines(), [
+            "# HELP frames_total Frames sent, by type",
+            "# TYPE frames_total counter",
+            'frames_total{type="text"} 3',
+            'frames_total{type="ack"} 1',
+        ])
+
+    def test_gauges(self):
+        self.registry.gauge("connections", "Open connections", lambda: 4)
+        self.registry.gauge("threads", "Threads by group", lambda: {"peer": 2, "fanout": 1}, label="group")
+        self.registry.gauge("gone", "Raises after logout", lambda: 1 / 0)
+        self.assertEqual(self.lines(), [
+            "# HELP connections Open connections",
+            "# TYPE connections gauge",
+            "connections 4",
+            "# HELP threads Threads by group",
+            "# TYPE threads gauge",
+            'threads{group="fanout"} 1',
+            'threads{group="peer"} 2',
+            "# HELP gone Raises after logout",
+            "# TYPE gone gauge",
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        latency = self.registry.histogram("latency_seconds", "Call latency", buckets=(0.1, 0.5))
+        for value in (0.05, 0.1, 0.3, 2.0):
+            latency.observe(value, endpoint="/peerinfo")
+        self.assertEqual(self.lines(), [
+            "# HELP latency_seconds Call latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{endpoint="/peerinfo",le="0.1"} 2',
+            'latency_seconds_bucket{endpoint="/peerinfo",le="0.5"} 3',
+            'latency_seconds_bucket{endpoint="/peerinfo",le="+Inf"} 4',
+            'latency_seconds_sum{endpoint="/peerinfo"} 2.45',
+            'latency_seconds_count{endpoint="/peerinfo"} 4',
+        ])
+
+    def test_histogram_without_labels(self):
+        with self.registry.histogram("handle_seconds", "Handling time", buckets=(60,)).time():
+            pass
+        lines = self.lines()
+        self.assertEqual(lines[2:4], ['handle_seconds_bucket{le="60"} 1', 'handle_seconds_bucket{le="+Inf"} 1'])
+        self.assertRegex(lines[4], r"^handle_seconds_sum \d")
+        self.assertEqual(lines[5], "handle_seconds_count 1")
+
+    def test_label_values_are_escaped(self):
+        self.registry.counter("errors_total", "Errors").inc(reason='bad "quote" \\ and\nnewline')
+        self.assertEqual(self.lines()[2], r'errors_total{reason="bad \"quote\" \\ and\nnewline"} 1')
+
+
+class MetricsServerTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.counter("frames_total", "Frames").inc()
+        self.server = MetricsServer(0, registry=self.registry).start()
+        self.addCleanup(self.server.close)
+        self.url = f"http://127.0.0.1:{self.server.port}"
+
+    def test_metrics_endpoint(self):
+        with urllib.request.urlopen(self.url + "/metrics") as response:
+            self.assertEqual(response.headers["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+            self.assertEqual(response.read().decode(), self.registry.render())
+
+    def test_other_paths(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(self.url + "/")
+        self.assertEqual(cm.exception.code, 404)
+        cm.exception.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
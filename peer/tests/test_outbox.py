@@ -0,0 +1,132 @@
+import tempfile
+import threading
+import time
+import unittest
+
+from local_store import LocalStore
+from outbox import Outbox, RecentIds
+from protocol import MSG_MESSAGE, decode_message
+
+ALICE = {"username": "alice", "ip": "127.0.0.1", "port": 5000}
+
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg_type, payload):
+        self.send_many([(msg_type, payload)])
+
+    def send_many(self, frames):
+        self.sent.extend(decode_message(payload) for msg_type, payload in frames if msg_type == MSG_MESSAGE)
+
+
+class FakeConnections:
+    """ConnectionManager stand-in: dialing fails while `reachable` is False."""
+
+    def __init__(self):
+        self.reachable = False
+        self.dials = 0
+        self.conn = FakeConnection()
+        self._connected = False
+
+    def get(self, username):
+        return self.conn if self._connected else None
+
+    def connect(self, peer):
+        self.dials += 1
+        if not self.reachable:
+            raise ConnectionRefusedError(f"{peer['username']} is offline")
+        self._connected = True
+        return self.conn
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = LocalStore("bob", directory.name)
+        self.addCleanup(self.store.close)
+        self.connections = FakeConnections()
+        self.resolved = threading.Event()
+        self.addresses = {"alice": ALICE}
+
+    def outbox(self, base_delay=0.05, max_delay=0.2):
+        def resolve(username):
+            self.resolved.set()
+            return self.addresses.get(username)
+
+        outbox = Outbox(self.store, self.connections, resolve, base_delay=base_delay, max_delay=max_delay,
+                        ack_timeout=0.2)
+        self.addCleanup(outbox.close)
+        return outbox
+
+    def test_unreachable_peer_gets_the_message_once_it_is_back(self):
+        outbox = self.outbox()
+        self.assertFalse(outbox.send(ALICE, "hi", b"1" * 16))
+        self.assertEqual(self.store.outbox_pending(), [("alice", (b"1" * 16).hex(), "hi")])
+
+        self.connections.reachable = True
+        self.assertTrue(wait_until(lambda: self.connections.conn.sent))
+        self.assertEqual(self.connections.conn.sent[0], (b"1" * 16, "hi"))
+
+        outbox.ack("alice", [b"1" * 16])
+        self.assertEqual(outbox.pending_count(), 0)
+        self.assertEqual(self.store.outbox_pending(), [])
+
+    def test_no_dial_per_message_while_backing_off(self):
+        outbox = self.outbox(base_delay=5, max_delay=60)
+        outbox.send(ALICE, "one")
+        outbox.send(ALICE, "two")
+        self.assertEqual(self.connections.dials, 2)
+        # Two failures in a row: wait for the retry instead of dialing again.
+        self.assertFalse(outbox.send(ALICE, "three"))
+        self.assertEqual(self.connections.dials, 2)
+        self.assertEqual(outbox.pending_count("alice"), 3)
+
+    def test_unacknowledged_messages_are_sent_again(self):
+        self.connections.reachable = True
+        outbox = self.outbox()
+        self.assertTrue(outbox.send(ALICE, "hi", b"1" * 16))
+        self.assertTrue(wait_until(lambda: len(self.connections.conn.sent) >= 2))
+        self.assertEqual(set(self.connections.conn.sent), {(b"1" * 16, "hi")})
+
+    def test_peer_without_address_stays_queued(self):
+        self.addresses.clear()
+        outbox = self.outbox()
+        outbox.send(ALICE, "hi")
+        self.assertTrue(self.resolved.wait(5))
+        self.assertEqual(outbox.pending_count("alice"), 1)
+
+    def test_pending_messages_survive_a_restart(self):
+        first = Outbox(self.store, self.connections, lambda username: None, base_delay=60)
+        first.send(ALICE, "hi", b"1" * 16)
+        first.close()
+
+        self.connections.reachable = True
+        self.outbox()
+        self.assertTrue(wait_until(lambda: self.connections.conn.sent))
+        self.assertEqual(self.connections.conn.sent[0], (b"1" * 16, "hi"))
+
+
+class RecentIdsTest(unittest.TestCase):
+    def test_replays_are_dropped_and_old_ids_forgotten(self):
+        seen = RecentIds(size=2)
+        self.assertTrue(seen.add(b"a"))
+        self.assertFalse(seen.add(b"a"))
+        seen.add(b"b")
+        seen.add(b"c")
+        self.assertTrue(seen.add(b"a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
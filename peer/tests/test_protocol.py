@@ -0,0 +1,95 @@
+import asyncio
+import socket
+import unittest
+
+from protocol import (
+    HEADER_SIZE, MAX_PAYLOAD_SIZE, MSG_ACK, MSG_TEXT, Frame, FrameReader,
+    ProtocolError, decode_ack, decode_frame, decode_group_message, decode_message, encode_ack,
+    encode_frame, encode_group_message, encode_message, read_frame_async
+)
+
+MSG_ID = bytes(range(16))
+
+
+class FramingTest(unittest.TestCase):
+    def setUp(self):
+        self.sender, receiver = socket.socketpair()
+        self.addCleanup(self.sender.close)
+        self.addCleanup(receiver.close)
+        # A small buffer, so frames have to be reassembled and the buffer grown.
+        self.reader = FrameReader(receiver, buffer_size=16)
+
+    def test_frames_in_one_recv(self):
+        self.sender.sendall(encode_frame(MSG_TEXT, b"one") + encode_frame(MSG_ACK, b"") + encode_frame(MSG_TEXT, b"two"))
+        self.sender.shutdown(socket.SHUT_WR)
+        self.assertEqual(list(self.reader), [
+            Frame(MSG_TEXT, 0, b"one"), Frame(MSG_ACK, 0, b""), Frame(MSG_TEXT, 0, b"two")
+        ])
+
+    def test_frame_split_over_recvs_and_larger_than_the_buffer(self):
+        data = encode_frame(MSG_TEXT, b"x" * 1000, flags=1)
+        for i in range(0, len(data), 7):
+            self.sender.sendall(data[i:i + 7])
+        self.assertEqual(self.reader.read_frame(), Frame(MSG_TEXT, 1, b"x" * 1000))
+
+    def test_clean_close_and_truncated_frame(self):
+        self.sender.sendall(encode_frame(MSG_TEXT, b"complete") + encode_frame(MSG_TEXT, b"cut short")[:-3])
+        self.sender.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.reader.read_frame().payload, b"complete")
+        with self.assertRaises(ProtocolError):
+            self.reader.read_frame()
+
+    def test_closed_between_frames(self):
+        self.sender.shutdown(socket.SHUT_WR)
+        self.assertIsNone(self.reader.read_frame())
+
+    def test_unknown_version_and_oversized_frames_are_rejected(self):
+        data = bytearray(encode_frame(MSG_TEXT, b"hi"))
+        data[0] = 2
+        with self.assertRaises(ProtocolError):
+            decode_frame(bytes(data))
+        with self.assertRaises(ProtocolError):
+            encode_frame(MSG_TEXT, bytes(MAX_PAYLOAD_SIZE + 1))
+
+    def test_decode_frame_needs_exactly_one_frame(self):
+        data = encode_frame(MSG_TEXT, b"hi")
+        self.assertEqual(decode_frame(memoryview(data)), Frame(MSG_TEXT, 0, b"hi"))
+        for bad in (data[:HEADER_SIZE - 1], data[:-1], data + b"!"):
+            with self.assertRaises(ProtocolError):
+                decode_frame(bad)
+
+    def test_async_reader(self):
+        async def read(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [await read_frame_async(reader), await read_frame_async(reader)]
+
+        self.assertEqual(asyncio.run(read(encode_frame(MSG_TEXT, b"hi"))), [Frame(MSG_TEXT, 0, b"hi"), None])
+        with self.assertRaises(ProtocolError):
+            asyncio.run(read(encode_frame(MSG_TEXT, b"hi")[:-1]))
+
+
+class PayloadTest(unittest.TestCase):
+    def test_message(self):
+        self.assertEqual(decode_message(encode_message(MSG_ID, "héllo")), (MSG_ID, "héllo"))
+        with self.assertRaises(ProtocolError):
+            decode_message(MSG_ID[:10])
+
+    def test_group_message(self):
+        payload = encode_group_message(MSG_ID, "team", "hi all")
+        self.assertEqual(decode_group_message(payload), (MSG_ID, "team", "hi all"))
+        with self.assertRaises(ProtocolError):
+            decode_group_message(payload[:len(MSG_ID) + 3])
+        with self.assertRaises(ProtocolError):
+            encode_group_message(MSG_ID, "x" * 256, "hi")
+
+    def test_ack(self):
+        ids = [MSG_ID, bytes(16)]
+        self.assertEqual(decode_ack(encode_ack(ids)), ids)
+        with self.assertRaises(ProtocolError):
+            decode_ack(MSG_ID + b"x")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import queue
+import unittest
+
+from push import PushListener
+
+
+class PushListenerTest(unittest.TestCase):
+    def listen(self, results, cursor=None):
+        """Run a listener over scripted poll results; returns (polled cursors, calls)."""
+        results = list(results)
+        polled = []
+        calls = queue.Queue()
+
+        def poll(username, cursor):
+            polled.append(cursor)
+            if not results:
+                listener.close()
+                calls.put(("done",))
+                return {"events": [], "cursor": cursor, "reset": False}
+            return results.pop(0)
+
+        listener = PushListener(
+            "bob", poll,
+            on_events=lambda events: calls.put(("events", events)),
+            on_reset=lambda: calls.put(("reset",)),
+            cursor=cursor
+        )
+        listener.start()
+        seen = []
+        while True:
+            call = calls.get(timeout=5)
+            if call == ("done",):
+                return polled, seen
+            seen.append(call)
+
+    def test_starts_from_the_bootstrap_cursor(self):
+        event = {"type": "message", "from": "alice", "id": 3}
+        polled, calls = self.listen([{"events": [event], "cursor": "b:5", "reset": False}], cursor="b:4")
+        self.assertEqual(polled, ["b:4", "b:5"])
+        self.assertEqual(calls, [("events", [event])])
+
+    def test_reset_of_a_known_cursor_resyncs(self):
+        polled, calls = self.listen([{"events": [], "cursor": "c:0", "reset": True}], cursor="b:4")
+        self.assertEqual(calls, [("reset",)])
+        self.assertEqual(polled, ["b:4", "c:0"])
+
+    def test_first_poll_without_cursor_does_not_resync(self):
+        polled, calls = self.listen([{"events": [], "cursor": "b:7", "reset": False}])
+        self.assertEqual(polled, [None, "b:7"])
+        self.assertEqual(calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
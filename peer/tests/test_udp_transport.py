@@ -0,0 +1,127 @@
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import unittest
+
+from protocol import MSG_MESSAGE, decode_message, encode_message
+from udp_transport import PUNCH, UdpTransport
+
+SERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "stun server")
+
+# The STUN server's UDP side: server/presence.py and server/stun.py.
+try:
+    from django.conf import settings
+except ImportError:
+    presence = None
+else:
+    sys.path.append(SERVER_DIR)
+    if not settings.configured:
+        settings.configure(PEER_ONLINE_WINDOW=120)
+    from server import presence
+
+
+class PortRestrictedNat:
+    """
+    Stand-in for a UDP socket behind a port-restricted cone NAT: datagrams
+    only get in from an (ip, port) the socket has sent to before. Whatever
+    else arrives is dropped, and its source kept in `dropped`.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent_to = set()
+        self.dropped = []
+
+    def sendto(self, data, addr):
+        self.sent_to.add(addr)
+        return self.sock.sendto(data, addr)
+
+    def recvfrom(self, size):
+        while True:
+            data, addr = self.sock.recvfrom(size)
+            if addr in self.sent_to:
+                return data, addr
+            self.dropped.append(addr)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@unittest.skipIf(presence is None, "the STUN server needs Django")
+class HolePunchingTest(unittest.TestCase):
+    """Binding, punching and DATA frames between two NATed peers and the STUN server's UDP listener."""
+
+    def setUp(self):
+        self.server = presence.HeartbeatListener("127.0.0.1", 0, 3600, table=presence.PresenceTable())
+        # Only the receiving side: the flush thread would write to the database.
+        threading.Thread(target=self.server._receive_loop, daemon=True).start()
+        self.addCleanup(self.server.close)
+
+        self.frames = queue.Queue()
+        self.paths = queue.Queue()
+        self.alice = self.peer("alice")
+        self.bob = self.peer("bob")
+        self.assertTrue(wait_until(
+            lambda: self.server.table.address("alice") and self.server.table.address("bob")
+        ))
+
+    def peer(self, username):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        transport = UdpTransport(
+            username, 0, ("127.0.0.1", self.server.port),
+            on_frame=lambda sender, frame: self.frames.put((username, sender, frame)),
+            on_path=self.paths.put,
+            on_close=lambda conn: None,
+            sock=PortRestrictedNat(sock)
+        )
+        self.addCleanup(transport.close)
+        return transport.start()
+
+    def test_binding_reports_the_address_the_server_sees(self):
+        self.assertEqual(self.alice.binding(), self.alice.sock.getsockname())
+
+    def test_punched_path_carries_frames_both_ways(self):
+        to_bob = self.alice.punch("bob")
+        to_alice = self.paths.get(timeout=5)
+        self.assertEqual((to_bob.username, to_alice.username), ("bob", "alice"))
+        self.assertTrue(to_bob.outbound)
+        self.assertFalse(to_alice.outbound)
+
+        to_bob.send(MSG_MESSAGE, encode_message(b"1" * 16, "hi bob"))
+        receiver, sender, frame = self.frames.get(timeout=5)
+        self.assertEqual((receiver, sender, frame.type), ("bob", "alice", MSG_MESSAGE))
+        self.assertEqual(decode_message(frame.payload), (b"1" * 16, "hi bob"))
+
+        to_alice.send(MSG_MESSAGE, encode_message(b"2" * 16, "hi alice"))
+        receiver, sender, frame = self.frames.get(timeout=5)
+        self.assertEqual((receiver, sender), ("alice", "bob"))
+        self.assertEqual(decode_message(frame.payload), (b"2" * 16, "hi alice"))
+
+    def test_the_nat_drops_peers_it_was_not_introduced_to(self):
+        stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(stranger.close)
+        stranger.bind(("127.0.0.1", 0))
+        stranger.sendto(PUNCH + b"mallory", self.alice.sock.getsockname())
+        self.assertTrue(wait_until(lambda: stranger.getsockname() in self.alice.sock.dropped))
+        self.assertEqual(self.alice.paths(), [])
+
+    def test_punching_an_offline_peer_fails(self):
+        with self.assertRaises(ConnectionError):
+            self.alice.punch("carol", timeout=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
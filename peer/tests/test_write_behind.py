@@ -0,0 +1,111 @@
+import threading
+import time
+import unittest
+
+from write_behind import WriteBehindQueue
+
+
+class FakeServer:
+    """flush_fn with the /message/bulk_create/ answers of com_server.save_messages."""
+
+    def __init__(self, answers=()):
+        self.answers = list(answers)
+        self.saved = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self.lock:
+            self.calls += 1
+            answer = self.answers.pop(0) if self.answers else True
+            if answer is True:
+                self.saved.extend(item["content"] for item in batch)
+            return answer
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+    def queue(self, server, flush_interval=0.01, **kwargs):
+        writer = WriteBehindQueue(server, flush_interval=flush_interval, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_batches_are_saved_in_order(self):
+        server = FakeServer()
+        writer = self.queue(server, batch_size=2)
+        for content in ("a", "b", "c"):
+            writer.put("alice", "bob", content)
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(server.saved, ["a", "b", "c"])
+        self.assertEqual(writer.pending, 0)
+
+    def test_group_messages_carry_the_group_instead_of_a_receiver(self):
+        batches = []
+        writer = self.queue(lambda batch: batches.append(batch) or True)
+        writer.put("alice", None, "hi all", group="team")
+        writer.flush(5)
+        self.assertEqual(batches, [[{"sender": "alice", "group": "team", "content": "hi all"}]])
+
+    def test_rejected_batch_is_dropped_and_the_queue_moves_on(self):
+        server = FakeServer([None])
+        writer = self.queue(server, batch_size=2)
+        for content in ("hi", "", "later", "after"):
+            writer.put("alice", "bob", content)
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(server.saved, ["later", "after"])
+        self.assertEqual(writer.pending, 0)
+
+    def test_failed_batch_is_retried(self):
+        server = FakeServer([False, False])
+        writer = self.queue(server)
+        writer.put("alice", "bob", "hi")
+        self.assertTrue(wait_until(lambda: server.saved))
+        self.assertEqual(server.saved, ["hi"])
+        self.assertEqual(server.calls, 3)
+
+    def test_exceptions_count_as_failures(self):
+        answers = [RuntimeError("boom")]
+
+        def flush(batch):
+            if answers:
+                raise answers.pop()
+            return True
+
+        writer = self.queue(flush)
+        writer.put("alice", "bob", "hi")
+        self.assertTrue(wait_until(lambda: writer.pending == 0))
+
+    def test_overflow_drops_the_oldest_messages(self):
+        server = FakeServer([False])
+        # Everything put within flush_interval goes out as one batch.
+        writer = self.queue(server, flush_interval=0.2, batch_size=10, max_pending=2)
+        for content in ("a", "b", "c"):
+            writer.put("alice", "bob", content)
+        self.assertTrue(wait_until(lambda: server.saved))
+        self.assertEqual(server.saved, ["b", "c"])
+
+    def test_close_flushes_what_is_queued(self):
+        server = FakeServer()
+        writer = WriteBehindQueue(server, flush_interval=60)
+        for content in ("a", "b"):
+            writer.put("alice", "bob", content)
+        self.assertEqual(writer.close(), 0)
+        self.assertEqual(server.saved, ["a", "b"])
+
+    def test_close_reports_unsaved_messages(self):
+        server = FakeServer([False])
+        writer = WriteBehindQueue(server, flush_interval=60)
+        for content in ("a", "b"):
+            writer.put("alice", "bob", content)
+        self.assertEqual(writer.close(), 2)
+        self.assertEqual(server.saved, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,313 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import metrics
+import stun
+from connections import PeerConnection
+from heartbeat import HEARTBEAT_ACK, HeartbeatSender
+from protocol import ProtocolError, decode_frame
+
+STUN_UDP_PORT = int(os.environ.get("STUN_UDP_PORT", "3478"))
+BINDING_TIMEOUT = 2.0
+PUNCH_TIMEOUT = 5.0
+PUNCH_INTERVAL = 0.1
+KEEPALIVE_INTERVAL = 15.0  # well below common NAT UDP timeouts (30 s+)
+PATH_TIMEOUT = 60.0
+MAX_DATAGRAM = 1200  # fits the path MTU of practically any link, no fragmentation
+
+# Datagram tags, see the STUN server's server/presence.py.
+PUNCH_REQUEST = b"P2PC"
+INTRODUCTION = b"P2PI"
+UNREACHABLE = b"P2PN"
+PUNCH = b"P2PP"  # + utf-8 username: opens the NAT mappings, then keeps them alive
+DATA = b"P2PD"   # + one protocol frame
+
+PUNCHES = metrics.counter("peer_udp_punch_total", "UDP hole punching attempts, by result")
+DATAGRAMS_DROPPED = metrics.counter("peer_udp_dropped_total", "UDP datagrams ignored, by reason")
+
+
+class UdpConnection(PeerConnection):
+    """
+    A hole-punched UDP path to one peer, carrying one frame per datagram.
+
+    Frames may be lost or reordered; chat messages are still delivered
+    because the outbox retries until they're acknowledged. Frames larger
+    than a datagram (long messages, file chunks) need a TCP connection.
+    """
+
+    reliable = False
+
+    def __init__(self, transport, username, addr, outbound):
+        super().__init__(username, outbound)
+        self.transport = transport
+        self.addr = addr
+        self.last_heard = time.monotonic()
+
+    @property
+    def alive(self):
+        return not self.closed and not self.transport.closed
+
+    def start(self):
+        # Datagrams are read by the transport's thread.
+        return self
+
+    def _send_frames(self, frames, codec=None):
+        # Compression is never negotiated: each datagram must decode alone.
+        if not self.alive:
+            raise ConnectionResetError(f"UDP path to {self.username} is closed")
+        for frame in frames:
+            data = DATA + self._encode([frame])
+            if len(data) > MAX_DATAGRAM:
+                raise ConnectionError(f"frame of {len(data)} bytes is too large for the UDP path")
+            self.transport.sendto(data, self.addr)
+
+    def send_file_chunk(self, header, file, offset, count):
+        raise ConnectionError("file transfers need a TCP connection")
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.transport.forget(self)
+
+
+class _Punch:
+    def __init__(self, requested):
+        self.requested = requested
+        self.addr = None
+        self.conn = None
+        self.done = threading.Event()
+
+
+class UdpTransport:
+    """
+    One UDP socket per logged-in peer, used for:
+
+    - heartbeats to the STUN server (heartbeat.py), which also keep this
+      socket's NAT mapping known to the server,
+    - STUN Binding requests, telling us our public (reflexive) address,
+    - hole punching: `punch(username)` asks the server to introduce us;
+      both peers get the other's reflexive address and send PUNCH datagrams
+      to it until one arrives, which opens both NATs for the path,
+    - frames over the open paths (UdpConnection).
+
+    A path the other peer asked for is handed to `on_path(conn)`; paths
+    that stay silent for PATH_TIMEOUT are closed and passed to `on_close`.
+    `sock` replaces the UDP socket, e.g. with a stand-in in tests.
+    """
+
+    def __init__(self, username, port, server, on_frame, on_path, on_close, sock=None):
+        self.username = username
+        self.on_frame = on_frame
+        self.on_path = on_path
+        self.on_close = on_close
+        self.closed = False
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("0.0.0.0", port))
+        self.sock = sock
+        self.server = (socket.gethostbyname(server[0]), server[1])
+        self.heartbeat = HeartbeatSender(username, lambda data: self.sendto(data, self.server))
+
+        self._paths = {}     # addr -> UdpConnection
+        self._punches = {}   # username -> _Punch
+        self._bindings = {}  # transaction id -> [Event, (ip, port)]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        # close() can't interrupt a blocking recvfrom, the timeout lets the loop see it.
+        self.sock.settimeout(1.0)
+        threading.Thread(target=self._receive_loop, name="udp", daemon=True).start()
+        threading.Thread(target=self._keepalive_loop, name="udp-keepalive", daemon=True).start()
+        self.heartbeat.start()
+        return self
+
+    def sendto(self, data, addr):
+        self.sock.sendto(data, addr)
+
+    # -------- STUN binding --------
+    def binding(self, timeout=BINDING_TIMEOUT):
+        """Our reflexive (ip, port) as seen by the STUN server, or None."""
+        transaction_id, request = stun.binding_request()
+        pending = [threading.Event(), None]
+        with self._lock:
+            self._bindings[transaction_id] = pending
+        try:
+            # Retransmit like RFC 5389 clients, doubling the wait each time.
+            wait = timeout / 7
+            for _ in range(3):
+                self.sendto(request, self.server)
+                if pending[0].wait(wait):
+                    return pending[1]
+                wait *= 2
+            return None
+        finally:
+            with self._lock:
+                self._bindings.pop(transaction_id, None)
+
+    # -------- hole punching --------
+    def punch(self, username, timeout=PUNCH_TIMEOUT):
+        """Open a UDP path to `username` through the STUN server; raises OSError if it can't."""
+        with self._lock:
+            for conn in self._paths.values():
+                if conn.username == username and conn.alive:
+                    return conn
+            punch = self._punches.get(username)
+            if punch is None or punch.done.is_set():
+                punch = self._punches[username] = _Punch(requested=True)
+        request = PUNCH_REQUEST + json.dumps({"from": self.username, "to": username}).encode()
+        # The server only introduces sockets it has heard a heartbeat from.
+        self.heartbeat.beat()
+        self.sendto(request, self.server)
+        if not punch.done.wait(timeout):
+            PUNCHES.inc(result="timeout")
+            with self._lock:
+                if self._punches.get(username) is punch:
+                    del self._punches[username]
+            raise TimeoutError(f"UDP hole punching to {username} timed out")
+        if punch.conn is None:
+            PUNCHES.inc(result="unreachable")
+            raise ConnectionError(f"{username} has no UDP address on the STUN server")
+        PUNCHES.inc(result="ok")
+        return punch.conn
+
+    def _introduced(self, info):
+        username, addr = info["username"], (info["ip"], int(info["port"]))
+        with self._lock:
+            punch = self._punches.get(username)
+            if punch is None or punch.done.is_set():
+                punch = self._punches[username] = _Punch(requested=False)
+            punch.addr = addr
+        threading.Thread(target=self._punch_loop, args=(username, punch), name=f"punch-{username}", daemon=True).start()
+
+    def _punch_loop(self, username, punch):
+        deadline = time.monotonic() + PUNCH_TIMEOUT
+        datagram = PUNCH + self.username.encode()
+        while not punch.done.is_set() and not self._stop.is_set() and time.monotonic() < deadline:
+            try:
+                self.sendto(datagram, punch.addr)
+            except OSError:
+                pass
+            punch.done.wait(PUNCH_INTERVAL)
+        with self._lock:
+            if self._punches.get(username) is punch and not punch.done.is_set():
+                # Timed out; a requesting punch() reports it itself.
+                del self._punches[username]
+
+    def _unreachable(self, info):
+        with self._lock:
+            punch = self._punches.pop(info["username"], None)
+        if punch is not None:
+            punch.done.set()
+
+    def _punched(self, data, addr):
+        username = data[len(PUNCH):].decode(errors="replace")
+        with self._lock:
+            conn = self._paths.get(addr)
+            if conn is not None:
+                conn.last_heard = time.monotonic()
+                return
+            punch = self._punches.get(username)
+            if punch is None or punch.addr != addr:
+                DATAGRAMS_DROPPED.inc(reason="unexpected_punch")
+                return
+            conn = self._paths[addr] = UdpConnection(self, username, addr, outbound=punch.requested)
+            punch.conn = conn
+            del self._punches[username]
+        # One more punch, in case the other side's mapping opened after ours.
+        self.sendto(PUNCH + self.username.encode(), addr)
+        punch.done.set()
+        print(f"🕳️ [UDP] Path to {username} open via {addr[0]}:{addr[1]}")
+        if not punch.requested:
+            self.on_path(conn)
+
+    # -------- receiving --------
+    def _receive_loop(self):
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except OSError:
+                if self._stop.is_set():
+                    return
+                # ICMP unreachable for an earlier datagram
+                continue
+            try:
+                self.handle(data, addr)
+            except Exception as e:
+                print(f"⚠️ [UDP ERROR] {addr[0]}:{addr[1]}: {e}")
+
+    def handle(self, data, addr):
+        if data.startswith(DATA):
+            self._data(data, addr)
+        elif data.startswith(PUNCH):
+            self._punched(data, addr)
+        elif addr != self.server:
+            DATAGRAMS_DROPPED.inc(reason="unknown_sender")
+        elif stun.is_stun(data):
+            with self._lock:
+                pending = self._bindings.get(stun.transaction_id(data))
+            if pending is not None:
+                pending[1] = stun.parse_binding_response(data)
+                pending[0].set()
+        elif data == HEARTBEAT_ACK:
+            self.heartbeat.acked()
+        elif data.startswith(INTRODUCTION):
+            self._introduced(json.loads(data[len(INTRODUCTION):]))
+        elif data.startswith(UNREACHABLE):
+            self._unreachable(json.loads(data[len(UNREACHABLE):]))
+        else:
+            DATAGRAMS_DROPPED.inc(reason="unknown_type")
+
+    def _data(self, data, addr):
+        with self._lock:
+            conn = self._paths.get(addr)
+        if conn is None:
+            DATAGRAMS_DROPPED.inc(reason="no_path")
+            return
+        conn.last_heard = time.monotonic()
+        try:
+            frame = conn.receive(decode_frame(memoryview(data)[len(DATA):]))
+        except ProtocolError as e:
+            DATAGRAMS_DROPPED.inc(reason="malformed")
+            print(f"⚠️ [PROTOCOL ERROR] {conn.username} (UDP): {e}")
+            return
+        if frame is not None:
+            self.on_frame(conn.username, frame)
+
+    # -------- paths --------
+    def paths(self):
+        with self._lock:
+            return [conn for conn in self._paths.values() if conn.alive]
+
+    def forget(self, conn):
+        with self._lock:
+            if self._paths.get(conn.addr) is conn:
+                del self._paths[conn.addr]
+        self.on_close(conn)
+
+    def _keepalive_loop(self):
+        datagram = PUNCH + self.username.encode()
+        while not self._stop.wait(KEEPALIVE_INTERVAL):
+            now = time.monotonic()
+            for conn in self.paths():
+                if now - conn.last_heard > PATH_TIMEOUT:
+                    print(f"⚪ [UDP] Path to {conn.username} timed out")
+                    conn.close()
+                    continue
+                try:
+                    self.sendto(datagram, conn.addr)
+                except OSError:
+                    pass
+
+    def close(self):
+        paths = self.paths()
+        self.closed = True
+        self._stop.set()
+        self.heartbeat.close()
+        for conn in paths:
+            conn.close()
+        self.sock.close()
@@ -1,30 +1,36 @@
-import socket
-
-def get_local_ip():
-    
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80)) 
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        return "127.0.0.1" 
-
-
-def create_messagebox(user_friends):
-    messagebox = {}
-    new_message_flags = {}
-    for friend in user_friends:
-        messagebox[friend] = []
-        new_message_flags[friend] = False
-
-    return messagebox, new_message_flags
-
-def print_messages(messages, username):
-    for messsage in messages:
-        if messsage["from"] == username:
-            print("[YOU]: " + messsage["message"])
-        else:
-            message_from = messsage["from"]
-            print(f"[{message_from}]: " + messsage["message"])
\ No newline at end of file
+import socket
+
+from conversation_store import ConversationStore
+
+def get_local_ip():
+    
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80)) 
+        ip = s.getsockname()[0]
+        s.close()
+        return ip
+    except Exception:
+        return "127.0.0.1" 
+
+
+def create_messagebox(user_friends, store=None, capacity=None, memory_budget=None):
+    options = {}
+    if capacity:
+        options["capacity"] = capacity
+    if memory_budget:
+        options["memory_budget"] = memory_budget
+    messagebox = ConversationStore(loader=store.recent if store else None, **options)
+    new_message_flags = {}
+    for friend in user_friends:
+        messagebox.recent(friend)
+        new_message_flags[friend] = False
+
+    return messagebox, new_message_flags
+
+def print_messages(messages, username):
+    for message in messages:
+        if message.sender == username:
+            print("[YOU]: " + message.text)
+        else:
+            print(f"[{message.sender}]: " + message.text)
\ No newline at end of file
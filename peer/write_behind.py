@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+
+import metrics
+
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 1.0
+MAX_PENDING = 10000
+RETRY_DELAY_MAX = 30.0
+
+_STOP = object()
+
+WRITE_BEHIND_DROPPED = metrics.counter(
+    "peer_write_behind_dropped_total", "Queued messages given up on, by reason"
+)
+
+
+class WriteBehindQueue:
+    """
+    Background write-behind buffer for outgoing message persistence.
+
+    `put()` only enqueues, so sending a chat message never waits for the STUN
+    server. A worker thread groups queued messages and hands each batch to
+    `flush_fn(batch)` once `batch_size` messages are waiting or
+    `flush_interval` seconds have passed since the first one. `flush_fn`
+    returns True on success and None if the batch was rejected for good
+    (it is dropped, retrying can't fix it); on False or an exception the
+    batch is kept and retried with exponential backoff.
+    """
+
+    def __init__(self, flush_fn, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_pending=MAX_PENDING):
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._queue = queue.Queue()
+        self._batch = []
+        self._failures = 0
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, sender, receiver, content, group=None, msg_id=None):
+        if group is not None:
+            item = {"sender": sender, "group": group, "content": content}
+        else:
+            item = {"sender": sender, "receiver": receiver, "content": content}
+        if msg_id is not None:
+            # The P2P id (hex), lets the receiver match the server's copy.
+            item["msg_id"] = msg_id
+        self._queue.put(item)
+
+    @property
+    def pending(self):
+        return self._queue.qsize() + len(self._batch)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far was handed to flush_fn."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=5):
+        """Try one last flush and stop; returns the number of messages left unsaved."""
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        return len(self._batch) + sum(1 for item in list(self._queue.queue) if isinstance(item, dict))
+
+    # -------- worker --------
+    def _run(self):
+        deadline = None
+        while True:
+            if self._batch and deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush()
+                return
+            if isinstance(item, threading.Event):
+                self._drain()
+                self._flush()
+                item.set()
+                deadline = None
+                continue
+            if item is not None:
+                self._batch.append(item)
+                self._drain()
+
+            full = len(self._batch) >= self.batch_size and not self._failures
+            if full or item is None:
+                if self._flush():
+                    deadline = None
+                else:
+                    delay = min(RETRY_DELAY_MAX, self.flush_interval * (2 ** self._failures))
+                    deadline = time.monotonic() + delay
+
+    def _drain(self):
+        # Pull whatever is already queued without blocking, up to a batch.
+        while len(self._batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is _STOP or isinstance(item, threading.Event):
+                self._queue.put(item)
+                return
+            self._batch.append(item)
+
+    def _flush(self):
+        while self._batch:
+            batch = self._batch[:self.batch_size]
+            try:
+                ok = self.flush_fn(batch)
+            except Exception as e:
+                print(f"⚠️ [WRITE-BEHIND ERROR] {e}")
+                ok = False
+
+            if ok is None:
+                self._failures = 0
+                del self._batch[:len(batch)]
+                WRITE_BEHIND_DROPPED.inc(len(batch), reason="rejected")
+                print(f"⚠️ [WRITE-BEHIND] Server rejected {len(batch)} messages, dropped")
+                continue
+
+            if not ok:
+                self._failures += 1
+                if len(self._batch) > self.max_pending:
+                    dropped = len(self._batch) - self.max_pending
+                    del self._batch[:dropped]
+                    WRITE_BEHIND_DROPPED.inc(dropped, reason="overflow")
+                    print(f"⚠️ [WRITE-BEHIND] Dropped {dropped} unsaved messages")
+                return False
+
+            self._failures = 0
+            del self._batch[:len(batch)]
+        return True
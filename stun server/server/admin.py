@@ -1,6 +1,14 @@
-from django.contrib import admin
-from .models import Peer
-
-@admin.register(Peer)
-class PeerAdmin(admin.ModelAdmin):
-    list_display = ('username', 'ip', 'port', 'last_seen')
+from django.contrib import admin
+from .models import Peer, Group, Conversation
+
+@admin.register(Peer)
+class PeerAdmin(admin.ModelAdmin):
+    list_display = ('username', 'ip', 'port', 'last_seen')
+
+@admin.register(Group)
+class GroupAdmin(admin.ModelAdmin):
+    list_display = ('name', 'owner', 'created_at')
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ('peer_a', 'peer_b', 'last_message_id', 'unread_a', 'unread_b')
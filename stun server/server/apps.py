@@ -1,5 +1,10 @@
-from django.apps import AppConfig
-
-
-class ServerConfig(AppConfig):
-    name = 'server'
+from django.apps import AppConfig
+
+
+class ServerConfig(AppConfig):
+    name = 'server'
+
+    def ready(self):
+        from .presence import start_listener
+
+        start_listener()
@@ -0,0 +1,120 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+_MISSING = object()
+LOCK_POLL_INTERVAL = 0.01
+
+
+class CacheStats:
+    """
+    Reads per kind of key (the part before the first ":"). `waited` counts
+    the misses answered by another request's load (see `cached()`).
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, outcome):
+        kind = key.partition(":")[0]
+        with self._lock:
+            counts = self._counts.get(kind)
+            if counts is None:
+                counts = self._counts[kind] = {"hits": 0, "misses": 0, "waited": 0, "invalidations": 0}
+            counts[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = {kind: dict(values) for kind, values in self._counts.items()}
+        for values in counts.values():
+            reads = values["hits"] + values["misses"]
+            values["hit_ratio"] = round(values["hits"] / reads, 3) if reads else None
+        return counts
+
+
+cache_stats = CacheStats()
+
+
+def _version_key(key):
+    return f"v:{key}"
+
+
+def _version(key):
+    """(current version of `key`, whether it was just created)."""
+    version = cache.get(_version_key(key))
+    if version is not None:
+        return version, False
+    # Start from the clock, not 0: if the version was evicted, values
+    # stored under its old numbers must not become readable again.
+    version = time.time_ns()
+    if cache.add(_version_key(key), version, None):
+        return version, True
+    return cache.get(_version_key(key), 0), False
+
+
+def cached(key, load, timeout=None):
+    """
+    Value of `key` from the default cache, or `load()` stored under it.
+
+    Keys are versioned: `invalidate()` bumps the version instead of deleting
+    the value, so a `load()` that read the database before a write can't
+    store its stale result where later reads would find it.
+
+    Only one caller loads a missing key at a time: the others wait up to
+    CACHE_LOCK_TIMEOUT seconds for its result (then load it themselves), so
+    a popular key expiring doesn't send every request to the database.
+    """
+    if timeout is None:
+        timeout = settings.CACHE_TTL
+    version, new = _version(key)
+    versioned = f"{key}@{version}"
+
+    value = _MISSING if new else cache.get(versioned, _MISSING)
+    if value is not _MISSING:
+        cache_stats.inc(key, "hits")
+        return value
+    cache_stats.inc(key, "misses")
+
+    lock = f"lock:{versioned}"
+    if not cache.add(lock, True, settings.CACHE_LOCK_TIMEOUT):
+        deadline = time.monotonic() + settings.CACHE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            value = cache.get(versioned, _MISSING)
+            if value is not _MISSING:
+                cache_stats.inc(key, "waited")
+                return value
+        # The loader failed or is too slow: don't keep the request waiting.
+        return load()
+
+    try:
+        value = load()
+        cache.set(versioned, value, timeout)
+        return value
+    finally:
+        cache.delete(lock)
+
+
+def invalidate(*keys):
+    """Make the next `cached()` read of each key load it again."""
+    for key in keys:
+        try:
+            cache.incr(_version_key(key))
+        except ValueError:
+            # Never read, or evicted: a new clock-based version.
+            cache.add(_version_key(key), time.time_ns(), None)
+        cache_stats.inc(key, "invalidations")
+
+
+def peerinfo_key(username):
+    return f"peerinfo:{username}"
+
+
+def friends_key(username):
+    return f"friends:{username}"
+
+
+PEERS_KEY = "peers:all"
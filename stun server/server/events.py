@@ -0,0 +1,122 @@
+import asyncio
+import secrets
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+
+class EventHub:
+    """
+    Per-user event queues for the /events/ long-poll, kept in memory.
+
+    Every event gets a sequence number from one counter; a client's cursor
+    is "<boot>:<seq>" of the last event it saw. Each user keeps the last
+    EVENT_BACKLOG events, so a client that reconnects within that window
+    misses nothing. A cursor from before a restart (other boot id) or
+    older than the backlog comes back with `reset`, telling the client to
+    resync from the message endpoints.
+
+    `publish()` is called from the sync views' threads; waiters are
+    futures on the event loop of their request, woken thread-safely.
+    """
+
+    def __init__(self, backlog, max_users):
+        self.backlog = backlog
+        self.max_users = max_users
+        self.boot = secrets.token_hex(4)
+        self._seq = 0
+        self._evicted_seq = 0  # seq when a user's queue was last evicted
+        self._queues = OrderedDict()  # username -> [deque of (seq, event), last dropped seq]
+        self._waiters = {}            # username -> set of (loop, future)
+        self._lock = threading.Lock()
+
+    def cursor(self):
+        return f"{self.boot}:{self._seq}"
+
+    def publish(self, usernames, event):
+        with self._lock:
+            self._seq += 1
+            for username in set(usernames):
+                queue = self._queues.get(username)
+                if queue is None:
+                    queue = self._queues[username] = [deque(), 0]
+                    if len(self._queues) > self.max_users:
+                        # Least recently notified user; a later poll resyncs it.
+                        self._queues.popitem(last=False)
+                        self._evicted_seq = self._seq
+                else:
+                    self._queues.move_to_end(username)
+                events, _ = queue
+                events.append((self._seq, event))
+                if len(events) > self.backlog:
+                    queue[1] = events.popleft()[0]
+                for loop, future in self._waiters.pop(username, ()):
+                    loop.call_soon_threadsafe(_wake, future)
+
+    def _pending(self, username, seq):
+        """(events after `seq`, whether some may have been dropped), under the lock."""
+        queue = self._queues.get(username)
+        if queue is None:
+            # Never notified, or its queue was evicted since the cursor.
+            return [], seq < self._evicted_seq
+        events, dropped = queue
+        return [event for event_seq, event in events if event_seq > seq], seq < dropped
+
+    def _parse(self, cursor):
+        """seq of a cursor from this process, or None."""
+        if not cursor:
+            return None
+        boot, _, seq = cursor.partition(":")
+        if boot != self.boot or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        return int(seq)
+
+    async def wait(self, username, cursor, timeout):
+        """
+        {"events", "cursor", "reset"} for `username`: right away if events
+        past `cursor` are queued, else once one arrives or after `timeout`.
+        Without a cursor (first poll) nothing is waited for.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            seq = self._parse(cursor)
+            if seq is None:
+                return {"events": [], "cursor": self.cursor(), "reset": bool(cursor)}
+            events, reset = self._pending(username, seq)
+            if events or reset:
+                return {"events": events, "cursor": self.cursor(), "reset": reset}
+            future = loop.create_future()
+            self._waiters.setdefault(username, set()).add((loop, future))
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(username)
+                if waiters is not None:
+                    waiters.discard((loop, future))
+                    if not waiters:
+                        del self._waiters[username]
+
+        with self._lock:
+            events, reset = self._pending(username, seq)
+            return {"events": events, "cursor": self.cursor(), "reset": reset}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "seq": self._seq,
+                "users": len(self._queues),
+                "waiting": sum(len(waiters) for waiters in self._waiters.values()),
+            }
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+hub = EventHub(settings.EVENT_BACKLOG, settings.EVENT_MAX_USERS)
@@ -0,0 +1,214 @@
+import json
+import logging
+import platform
+import random
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from server.management.commands.seed_bench import seeded_username_regex
+from server.models import Friendship, Message, Peer
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure latency, throughput and SQL query count of every endpoint under "
+        "concurrent clients (Django test client, one per thread). Seed data with "
+        "seed_bench first; write endpoints add rows to the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+        parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+        parser.add_argument("--endpoints", help="comma separated subset of endpoint names")
+        parser.add_argument("--prefix", default="bench", help="username prefix of seeded peers")
+        parser.add_argument("--seed", type=int, default=7)
+        parser.add_argument("--output", help="write the JSON report to this file")
+        parser.add_argument("--baseline", help="earlier report to compare against")
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        prefix = options["prefix"]
+        peer_ids = list(Peer.objects.filter(username__regex=seeded_username_regex(prefix)).values_list("id", flat=True))
+        if len(peer_ids) < 2:
+            raise CommandError(f"No seeded peers named {prefix}NNNNNN, run seed_bench first")
+        self.usernames = dict(Peer.objects.filter(id__in=peer_ids).values_list("id", "username"))
+        self.peer_ids = peer_ids
+        self.pairs = self._sample_pairs(1000)
+        self.run_id = f"{int(time.time())}"
+
+        scenarios = self._scenarios()
+        if options["endpoints"]:
+            wanted = options["endpoints"].split(",")
+            unknown = set(wanted) - scenarios.keys()
+            if unknown:
+                raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+            scenarios = {name: scenarios[name] for name in wanted}
+
+        report = {
+            "database": {
+                "vendor": connection.vendor,
+                "peers": Peer.objects.count(),
+                "friendships": Friendship.objects.count(),
+                "messages": Message.objects.count(),
+            },
+            "config": {"clients": options["clients"], "requests": options["requests"]},
+            "environment": {"python": platform.python_version(), "platform": platform.platform()},
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "endpoints": {},
+        }
+        # Errors are counted in the report, not logged with a traceback each.
+        logging.getLogger("django.request").setLevel(logging.CRITICAL)
+        for name, make_request in scenarios.items():
+            result = self._run(make_request, options["clients"], options["requests"])
+            report["endpoints"][name] = result
+            self.stdout.write(
+                f"{name:22} {result['throughput_rps']:>8.1f} req/s  "
+                f"p50 {result['latency_ms']['p50']:>8.2f} ms  p99 {result['latency_ms']['p99']:>8.2f} ms  "
+                f"queries {result['queries']['mean']:>6.1f}  errors {result['errors']}"
+            )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                self._compare(json.load(f), report)
+
+    # -------- request mix --------
+    def _sample_pairs(self, count):
+        """Peer pairs that actually have messages, found through random message ids."""
+        bounds = Message.objects.aggregate(lo=Min("id"), hi=Max("id"))
+        self.message_ids = (bounds["lo"] or 1, bounds["hi"] or 1)
+        pairs = []
+        if bounds["lo"] is not None:
+            ids = [random.randint(*self.message_ids) for _ in range(count)]
+            rows = Message.objects.filter(id__in=ids, receiver__isnull=False).values_list("sender_id", "receiver_id")
+            pairs = [(self.usernames.get(a), self.usernames.get(b)) for a, b in rows]
+            pairs = [(a, b) for a, b in pairs if a and b]
+        if not pairs:
+            pairs = [tuple(random.sample(list(self.usernames.values()), 2)) for _ in range(count)]
+        return pairs
+
+    def _username(self):
+        return self.usernames[random.choice(self.peer_ids)]
+
+    def _scenarios(self):
+        """name -> function returning (method, path, query params or JSON body)."""
+        counter = iter(range(10 ** 9))
+        lock = threading.Lock()
+
+        def unique():
+            with lock:
+                return next(counter)
+
+        def pair():
+            return random.choice(self.pairs)
+
+        return {
+            "register": lambda: ("post", "/register", {
+                "username": f"{self.run_id}-new{unique()}", "ip": "10.9.9.9", "port": 40000
+            }),
+            "register_update": lambda: ("post", "/register", {
+                "username": self._username(), "ip": "10.9.9.9", "port": 40001
+            }),
+            "peers": lambda: ("get", "/peers", {}),
+            "directory_prefix": lambda: ("get", "/directory/", {"q": self._username()[:-2]}),
+            "directory_online": lambda: ("get", "/directory/", {"online": 1, "after": self._username()}),
+            "peerinfo": lambda: ("get", "/peerinfo", {"username": self._username()}),
+            "create_message": lambda: ("post", "/message/create/", dict(
+                zip(("sender", "receiver"), pair()), content="benchmark message"
+            )),
+            "bulk_create_messages": lambda: ("post", "/message/bulk_create/", {"messages": [
+                dict(zip(("sender", "receiver"), pair()), content="benchmark message") for _ in range(50)
+            ]}),
+            "get_messages": lambda: ("get", "/message/get/", dict(zip(("peer1", "peer2"), pair()))),
+            "get_messages_older": lambda: ("get", "/message/get/", dict(
+                zip(("peer1", "peer2"), pair()), before=random.randint(*self.message_ids)
+            )),
+            "start_friendship": lambda: ("post", "/friend/start/", dict(zip(("user1", "user2"), pair()))),
+            "get_friends": lambda: ("get", "/friend/get/", {"username": self._username()}),
+            "session_bootstrap": lambda: ("post", "/session/bootstrap", {"username": self._username()}),
+        }
+
+    # -------- runner --------
+    def _run(self, make_request, clients, total):
+        latencies, queries, errors = [], [], []
+        lock = threading.Lock()
+        remaining = iter(range(total))
+
+        def client_loop():
+            # Failures (e.g. "database is locked" under concurrent writes) are
+            # part of the result, so they come back as 500s instead of raising.
+            client = Client(raise_request_exception=False)
+            try:
+                while True:
+                    with lock:
+                        if next(remaining, None) is None:
+                            return
+                    method, path, data = make_request()
+                    start = time.perf_counter()
+                    with CaptureQueriesContext(connection) as captured:
+                        if method == "get":
+                            response = client.get(path, data)
+                        else:
+                            response = client.post(path, json.dumps(data), content_type="application/json")
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed * 1000)
+                        queries.append(len(captured))
+                        if response.status_code >= 400:
+                            errors.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client_loop) for _ in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - start
+
+        return {
+            "requests": len(latencies),
+            "errors": len(errors),
+            "error_statuses": sorted(set(errors)),
+            "throughput_rps": round(len(latencies) / wall, 1),
+            "latency_ms": {
+                "mean": round(statistics.fmean(latencies), 3),
+                "p50": round(_percentile(latencies, 50), 3),
+                "p90": round(_percentile(latencies, 90), 3),
+                "p99": round(_percentile(latencies, 99), 3),
+                "max": round(max(latencies), 3),
+            },
+            "queries": {"mean": round(statistics.fmean(queries), 2), "max": max(queries)},
+        }
+
+    def _compare(self, before, after):
+        self.stdout.write("\nChange against baseline (p50 / p99 latency, queries per request):")
+        for name, now in after["endpoints"].items():
+            then = before["endpoints"].get(name)
+            if not then:
+                continue
+            parts = []
+            for label, old, new in (
+                ("p50", then["latency_ms"]["p50"], now["latency_ms"]["p50"]),
+                ("p99", then["latency_ms"]["p99"], now["latency_ms"]["p99"]),
+            ):
+                change = (new - old) / old * 100 if old else 0
+                parts.append(f"{label} {old:.2f} -> {new:.2f} ms ({change:+.0f}%)")
+            parts.append(f"queries {then['queries']['mean']} -> {now['queries']['mean']}")
+            self.stdout.write(f"{name:22} " + "  ".join(parts))
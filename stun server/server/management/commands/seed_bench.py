@@ -0,0 +1,153 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery
+
+from server.models import Conversation, Friendship, Message, Peer
+
+BATCH_SIZE = 5000
+
+
+def seeded_username_regex(prefix):
+    """
+    Matches exactly the usernames seed_bench creates (`<prefix>` + six
+    digits), so real users that merely share the prefix are never touched.
+    """
+    return rf"^{re.escape(prefix)}\d{{6}}$"
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed the database with benchmark data: peers, a dense friend graph and "
+        "conversations with a skewed message distribution. Run it against a copy "
+        "of the database (STUN_DB_PATH=bench.sqlite3)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--peers", type=int, default=100_000)
+        parser.add_argument("--friends", type=int, default=20, help="friends per peer")
+        parser.add_argument("--conversations", type=int, default=50_000, help="active 1:1 conversations")
+        parser.add_argument("--messages", type=int, default=2_000_000)
+        parser.add_argument("--prefix", default="bench", help="username prefix of seeded peers")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--reset", action="store_true", help="delete previously seeded data first")
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        prefix = options["prefix"]
+        n_peers = options["peers"]
+        n_friends = min(options["friends"], n_peers - 1)
+        if n_peers < 2:
+            raise CommandError("--peers must be at least 2")
+
+        if connection.vendor == "sqlite":
+            # Bulk loading only, durability doesn't matter here.
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=OFF")
+
+        seeded_regex = seeded_username_regex(prefix)
+        seeded = Peer.objects.filter(username__regex=seeded_regex)
+        if seeded.exists():
+            if not options["reset"]:
+                raise CommandError(f"Peers named {prefix}NNNNNN already exist, use --reset to replace them")
+            self._step("Deleting previous benchmark data", lambda: seeded.delete())
+
+        usernames = [f"{prefix}{i:06d}" for i in range(n_peers)]
+        self._step(f"Creating {n_peers} peers", lambda: self._bulk(Peer, (
+            Peer(
+                username=username,
+                ip=f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+                port=20000 + i % 40000
+            )
+            for i, username in enumerate(usernames)
+        )))
+        ids = dict(Peer.objects.filter(username__regex=seeded_regex).values_list("username", "id"))
+        peer_ids = [ids[username] for username in usernames]
+
+        # Friends are mostly "nearby" peers, so the graph has clusters.
+        friends = {}
+        for i in range(n_peers):
+            chosen = set()
+            while len(chosen) < n_friends:
+                j = (i + int(random.gauss(0, 50 + n_friends * 5))) % n_peers if random.random() < 0.8 \
+                    else random.randrange(n_peers)
+                if j != i:
+                    chosen.add(j)
+            friends[i] = list(chosen)
+        self._step(f"Creating {n_peers * n_friends} friendships", lambda: self._bulk(Friendship, (
+            Friendship(owner_id=peer_ids[i], friend_username=usernames[j])
+            for i, js in friends.items() for j in js
+        )))
+
+        pairs = []
+        for _ in range(options["conversations"]):
+            i = random.randrange(n_peers)
+            if friends[i]:
+                pairs.append((peer_ids[i], peer_ids[random.choice(friends[i])]))
+        if not pairs:
+            raise CommandError("No conversations to put messages in")
+        # Both directions of a pair, and repeated picks, are one conversation.
+        conversation_pairs = {Conversation.pair(a, b) for a, b in pairs}
+        self._step(f"Creating {len(conversation_pairs)} conversations", lambda: self._bulk(Conversation, (
+            Conversation(peer_a_id=a, peer_b_id=b) for a, b in conversation_pairs
+        )))
+        conversation_ids = {
+            (a, b): id for id, a, b in
+            Conversation.objects.filter(peer_a__username__regex=seeded_regex).values_list("id", "peer_a_id", "peer_b_id")
+        }
+
+        # A few very busy conversations and a long tail (Pareto).
+        weights = [random.paretovariate(1.2) for _ in pairs]
+
+        def messages():
+            for batch_start in range(0, options["messages"], BATCH_SIZE):
+                count = min(BATCH_SIZE, options["messages"] - batch_start)
+                for a, b in random.choices(pairs, weights, k=count):
+                    if random.random() < 0.5:
+                        a, b = b, a
+                    yield Message(sender_id=a, receiver_id=b, content=_text(),
+                                  conversation_id=conversation_ids[Conversation.pair(a, b)])
+
+        self._step(f"Creating {options['messages']} messages in {len(conversation_pairs)} conversations",
+                   lambda: self._bulk(Message, messages()))
+        newest = Message.objects.filter(conversation=OuterRef("pk")).order_by("-id").values("id")[:1]
+        self._step("Updating conversations", lambda: Conversation.objects.filter(
+            peer_a__username__regex=seeded_regex
+        ).update(last_message_id=Subquery(newest)))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {Peer.objects.count()} peers, {Friendship.objects.count()} friendships, "
+            f"{Message.objects.count()} messages"
+        ))
+
+    def _bulk(self, model, objects):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= BATCH_SIZE:
+                with transaction.atomic():
+                    model.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            with transaction.atomic():
+                model.objects.bulk_create(batch)
+
+    def _step(self, label, fn):
+        self.stdout.write(f"⏳ {label}...")
+        start = time.perf_counter()
+        fn()
+        self.stdout.write(f"   done in {time.perf_counter() - start:.1f}s")
+
+
+WORDS = (
+    "hi hello hey how are you ok thanks sure see you later tomorrow meeting lunch "
+    "where when what why call me now send the file done great nice lol yes no maybe"
+).split()
+
+
+def _text():
+    return " ".join(random.choices(WORDS, k=random.randint(2, 30)))
@@ -0,0 +1,263 @@
+import cProfile
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger("server.requests")
+
+# Views that wait on purpose; they are timed but never counted as slow.
+LONG_POLL_VIEWS = {"events"}
+
+
+class QueryTimer:
+    """Execute wrapper counting queries and the time spent in them."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+
+
+# The current request's QueryTimer. A context variable rather than
+# connection.execute_wrapper(): under ASGI, sync views and ORM calls run in
+# worker threads with their own connections, and asgiref carries the
+# context over to them.
+_request_queries = contextvars.ContextVar("request_queries", default=None)
+
+
+def _time_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    return queries(execute, sql, params, many, context)
+
+
+def _install_query_timer(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+connection_created.connect(_install_query_timer)
+
+
+class RequestStats:
+    """
+    Rolling per-view aggregates: the last `window` requests of every URL name
+    are kept for percentiles, plus running totals since startup.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._recent = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, wall, db, queries, status):
+        with self._lock:
+            recent = self._recent.get(name)
+            if recent is None:
+                recent = self._recent[name] = deque(maxlen=self.window)
+                self._totals[name] = {"requests": 0, "errors": 0, "slow": 0}
+            recent.append((wall, db, queries))
+            totals = self._totals[name]
+            totals["requests"] += 1
+            if status >= 500:
+                totals["errors"] += 1
+            if wall * 1000 >= settings.SLOW_REQUEST_MS and name not in LONG_POLL_VIEWS:
+                totals["slow"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            recent = {name: list(samples) for name, samples in self._recent.items()}
+            totals = {name: dict(values) for name, values in self._totals.items()}
+
+        views = {}
+        for name, samples in sorted(recent.items()):
+            walls = sorted(wall for wall, _, _ in samples)
+            queries = [count for _, _, count in samples]
+            views[name] = {
+                **totals[name],
+                "window": len(samples),
+                "wall_ms": {
+                    "p50": _percentile_ms(walls, 50),
+                    "p90": _percentile_ms(walls, 90),
+                    "p99": _percentile_ms(walls, 99),
+                    "max": round(walls[-1] * 1000, 3),
+                },
+                "db_ms_mean": round(sum(db for _, db, _ in samples) / len(samples) * 1000, 3),
+                "queries_mean": round(sum(queries) / len(queries), 2),
+                "queries_max": max(queries),
+            }
+        return views
+
+
+def _percentile_ms(values, p):
+    return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 3)
+
+
+request_stats = RequestStats(settings.REQUEST_METRICS_WINDOW)
+
+# cProfile can only follow one request at a time.
+_profile_lock = threading.Lock()
+
+# The sampled request's profiler, for process_view() under ASGI.
+_request_profiler = contextvars.ContextVar("request_profiler", default=None)
+
+
+def _sample_profiler():
+    """A cProfile.Profile for a PROFILE_SAMPLE_RATE fraction of requests, holding _profile_lock."""
+    if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+        if _profile_lock.acquire(blocking=False):
+            return cProfile.Profile()
+    return None
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request and counts its SQL queries, keyed by URL name.
+
+    Requests slower than SLOW_REQUEST_MS are logged with their query count and
+    DB time. A PROFILE_SAMPLE_RATE fraction of requests runs under cProfile;
+    the profile is written to PROFILE_DIR if that request took longer than
+    PROFILE_THRESHOLD_MS (open it with `python -m pstats <file>`).
+
+    Under ASGI the middleware runs async, so a waiting long-poll
+    (/events/) doesn't hold a thread. cProfile can't follow a request
+    across threads there: ViewProfilerMiddleware turns the profiler on in
+    the thread Django runs the sync view in. Middleware and async views
+    aren't part of those profiles.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self._acall(request)
+
+        queries = QueryTimer()
+        profiler = _sample_profiler()
+
+        token = _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            if profiler:
+                response = profiler.runcall(self.get_response, request)
+            else:
+                response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+            if profiler:
+                _profile_lock.release()
+        wall = time.perf_counter() - start
+
+        name = self._record(request, response, wall, queries)
+        if profiler and wall * 1000 >= settings.PROFILE_THRESHOLD_MS:
+            self._dump_profile(profiler, name, wall)
+        return response
+
+    async def _acall(self, request):
+        queries = QueryTimer()
+        profiler = _sample_profiler()
+
+        token = _request_queries.set(queries)
+        profiler_token = _request_profiler.set(profiler)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_profiler.reset(profiler_token)
+            _request_queries.reset(token)
+            if profiler:
+                _profile_lock.release()
+        wall = time.perf_counter() - start
+
+        name = self._record(request, response, wall, queries)
+        # Empty if the view was async and never ran under the profiler.
+        if profiler and wall * 1000 >= settings.PROFILE_THRESHOLD_MS and profiler.getstats():
+            self._dump_profile(profiler, name, wall)
+        return response
+
+    def _record(self, request, response, wall, queries):
+        match = request.resolver_match
+        name = match.url_name if match and match.url_name else "unmatched"
+        request_stats.record(name, wall, queries.seconds, queries.count, response.status_code)
+        response["Server-Timing"] = f"app;dur={wall * 1000:.1f}, db;dur={queries.seconds * 1000:.1f}"
+
+        if wall * 1000 >= settings.SLOW_REQUEST_MS and name not in LONG_POLL_VIEWS:
+            logger.warning(
+                "Slow request %s %s (%s): %.1f ms, %d queries, %.1f ms in the database",
+                request.method, request.path, name, wall * 1000, queries.count, queries.seconds * 1000
+            )
+        return name
+
+    def _dump_profile(self, profiler, name, wall):
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        path = os.path.join(settings.PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{wall * 1000:.0f}ms.prof")
+        profiler.dump_stats(path)
+        logger.warning("Profile of a %.1f ms %s request written to %s", wall * 1000, name, path)
+
+
+class ViewProfilerMiddleware:
+    """
+    Profiles the sync view of a request sampled by RequestMetricsMiddleware
+    when served over ASGI.
+
+    Under ASGI Django runs the sync process_view hooks and the sync view
+    in the same thread (one per request, see ThreadSensitiveContext), so
+    process_view enables the profiler in that thread and lets Django call
+    the view as usual: ATOMIC_REQUESTS and process_exception still apply.
+    The profiler is disabled in the same thread once the response is back.
+    Keep it last in MIDDLEWARE, so the other process_view hooks (CSRF)
+    aren't profiled.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self._acall(request)
+        return self.get_response(request)
+
+    async def _acall(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            profiler = getattr(request, "_view_profiler", None)
+            if profiler is not None:
+                await sync_to_async(profiler.disable, thread_sensitive=True)()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profiler = _request_profiler.get()
+        if profiler is not None and not iscoroutinefunction(view_func):
+            profiler.enable()
+            request._view_profiler = profiler
+        return None
@@ -1,24 +1,24 @@
-# Generated by Django 6.0 on 2026-01-03 20:54
-
-from django.db import migrations, models
-
-
-class Migration(migrations.Migration):
-
-    initial = True
-
-    dependencies = [
-    ]
-
-    operations = [
-        migrations.CreateModel(
-            name='Peer',
-            fields=[
-                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
-                ('username', models.CharField(max_length=50, unique=True)),
-                ('ip', models.GenericIPAddressField()),
-                ('port', models.PositiveIntegerField()),
-                ('last_seen', models.DateTimeField(auto_now=True)),
-            ],
-        ),
-    ]
+# Generated by Django 6.0 on 2026-01-03 20:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Peer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=50, unique=True)),
+                ('ip', models.GenericIPAddressField()),
+                ('port', models.PositiveIntegerField()),
+                ('last_seen', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
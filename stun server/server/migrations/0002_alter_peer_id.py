@@ -1,18 +1,18 @@
-# Generated by Django 5.0.7 on 2026-01-05 22:36
-
-from django.db import migrations, models
-
-
-class Migration(migrations.Migration):
-
-    dependencies = [
-        ('server', '0001_initial'),
-    ]
-
-    operations = [
-        migrations.AlterField(
-            model_name='peer',
-            name='id',
-            field=models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
-        ),
-    ]
+# Generated by Django 5.0.7 on 2026-01-05 22:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='peer',
+            name='id',
+            field=models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+        ),
+    ]
@@ -1,22 +1,22 @@
-# Generated by Django 5.0.7 on 2026-01-09 13:19
-
-import django.db.models.deletion
-from django.db import migrations, models
-
-
-class Migration(migrations.Migration):
-
-    dependencies = [
-        ('server', '0003_message'),
-    ]
-
-    operations = [
-        migrations.CreateModel(
-            name='Friendship',
-            fields=[
-                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
-                ('friend_username', models.CharField(max_length=50)),
-                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friends', to='server.peer')),
-            ],
-        ),
-    ]
+# Generated by Django 5.0.7 on 2026-01-09 13:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0003_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('friend_username', models.CharField(max_length=50)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friends', to='server.peer')),
+            ],
+        ),
+    ]
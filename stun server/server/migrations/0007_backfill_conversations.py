@@ -0,0 +1,46 @@
+from django.db import migrations
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Greatest, Least
+
+BATCH_SIZE = 5000
+
+
+def backfill(apps, schema_editor):
+    """One Conversation per existing peer pair, then point every 1:1 message at it."""
+    Conversation = apps.get_model("server", "Conversation")
+    Message = apps.get_model("server", "Message")
+
+    pairs = (
+        Message.objects.filter(receiver__isnull=False)
+        .annotate(a=Least("sender_id", "receiver_id"), b=Greatest("sender_id", "receiver_id"))
+        .values("a", "b")
+        .annotate(last=Max("id"))
+        .order_by()
+    )
+    batch = []
+    for row in pairs.iterator(chunk_size=BATCH_SIZE):
+        # Unread state is unknown for old messages; logins recount from the peer's cursors.
+        batch.append(Conversation(peer_a_id=row["a"], peer_b_id=row["b"], last_message_id=row["last"]))
+        if len(batch) >= BATCH_SIZE:
+            Conversation.objects.bulk_create(batch)
+            batch = []
+    Conversation.objects.bulk_create(batch)
+
+    conversation = Conversation.objects.filter(
+        peer_a_id=Least(OuterRef("sender_id"), OuterRef("receiver_id")),
+        peer_b_id=Greatest(OuterRef("sender_id"), OuterRef("receiver_id"))
+    ).values("id")[:1]
+    Message.objects.filter(receiver__isnull=False, conversation__isnull=True).update(
+        conversation_id=Subquery(conversation)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0006_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0007_backfill_conversations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='peer',
+            index=models.Index(fields=['last_seen'], name='peer_last_seen'),
+        ),
+    ]
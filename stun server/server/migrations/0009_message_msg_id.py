@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0008_peer_last_seen_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='msg_id',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
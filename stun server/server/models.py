@@ -1,36 +1,200 @@
-from django.db import models
-
-class Peer(models.Model):
-    username = models.CharField(max_length=50, unique=True)
-    ip = models.GenericIPAddressField()
-    port = models.PositiveIntegerField()
-    last_seen = models.DateTimeField(auto_now=True)
-
-    def __str__(self):
-        return self.username
-
-class Friendship(models.Model):
-    owner = models.ForeignKey(
-        Peer,
-        on_delete=models.CASCADE,
-        related_name="friends"
-    )
-    friend_username = models.CharField(max_length=50)
-    
-    
-class Message(models.Model):
-    sender = models.ForeignKey(
-        Peer,
-        on_delete=models.CASCADE,
-        related_name="sent_messages"
-    )
-    receiver = models.ForeignKey(
-        Peer,
-        on_delete=models.CASCADE,
-        related_name="received_messages"
-    )
-    content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-
-    def __str__(self):
-        return f"{self.sender} -> {self.receiver}"
+from django.db import models
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+class Peer(models.Model):
+    username = models.CharField(max_length=50, unique=True)
+    ip = models.GenericIPAddressField()
+    port = models.PositiveIntegerField()
+    last_seen = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Online filter of the directory.
+            models.Index(fields=["last_seen"], name="peer_last_seen"),
+        ]
+
+    def __str__(self):
+        return self.username
+
+class Friendship(models.Model):
+    owner = models.ForeignKey(
+        Peer,
+        on_delete=models.CASCADE,
+        related_name="friends"
+    )
+    friend_username = models.CharField(max_length=50)
+    
+    
+class Group(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    owner = models.ForeignKey(
+        Peer,
+        on_delete=models.CASCADE,
+        related_name="owned_groups"
+    )
+    members = models.ManyToManyField(
+        Peer,
+        through="GroupMembership",
+        related_name="chat_groups"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class GroupMembership(models.Model):
+    group = models.ForeignKey(
+        Group,
+        on_delete=models.CASCADE,
+        related_name="memberships"
+    )
+    peer = models.ForeignKey(
+        Peer,
+        on_delete=models.CASCADE,
+        related_name="group_memberships"
+    )
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["group", "peer"], name="unique_group_member"),
+        ]
+
+
+class Conversation(models.Model):
+    """
+    A 1:1 chat between two peers, stored once per pair with
+    peer_a.id <= peer_b.id. Keeps the newest message id and, per side, the
+    number of messages received since that side last caught up, so logins
+    don't have to scan the messages.
+    """
+    peer_a = models.ForeignKey(
+        Peer,
+        on_delete=models.CASCADE,
+        related_name="+"
+    )
+    peer_b = models.ForeignKey(
+        Peer,
+        on_delete=models.CASCADE,
+        related_name="+"
+    )
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    unread_a = models.PositiveIntegerField(default=0)
+    unread_b = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["peer_a", "peer_b"], name="unique_conversation_pair"),
+            models.CheckConstraint(condition=Q(peer_a__lte=F("peer_b")), name="conversation_pair_ordered"),
+        ]
+
+    def __str__(self):
+        return f"{self.peer_a_id} <-> {self.peer_b_id}"
+
+    @staticmethod
+    def pair(peer1_id, peer2_id):
+        return (peer1_id, peer2_id) if peer1_id <= peer2_id else (peer2_id, peer1_id)
+
+    @classmethod
+    def between(cls, peer1_id, peer2_id):
+        a, b = cls.pair(peer1_id, peer2_id)
+        return cls.objects.filter(peer_a_id=a, peer_b_id=b).first()
+
+    @classmethod
+    def for_pairs(cls, pairs):
+        """{(peer1 id, peer2 id): Conversation} for every pair, creating missing ones."""
+        wanted = {cls.pair(a, b) for a, b in pairs}
+        if not wanted:
+            return {}
+
+        def existing():
+            query = Q()
+            for a, b in wanted:
+                query |= Q(peer_a_id=a, peer_b_id=b)
+            return {(c.peer_a_id, c.peer_b_id): c for c in cls.objects.filter(query)}
+
+        found = existing()
+        missing = wanted - found.keys()
+        if missing:
+            # A concurrent writer may create the same pair, hence the re-read.
+            cls.objects.bulk_create([cls(peer_a_id=a, peer_b_id=b) for a, b in missing], ignore_conflicts=True)
+            found = existing()
+        return {(a, b): found[cls.pair(a, b)] for a, b in pairs}
+
+    @classmethod
+    def record_messages(cls, messages):
+        """Advance last_message_id and the receivers' unread counts after saving `messages`."""
+        changes = {}
+        for message in messages:
+            if message.conversation_id is None:
+                continue
+            last, unread_a, unread_b = changes.get(message.conversation_id, (0, 0, 0))
+            to_a = message.receiver_id < message.sender_id
+            changes[message.conversation_id] = (
+                max(last, message.id), unread_a + to_a, unread_b + (not to_a)
+            )
+        if not changes:
+            return
+
+        def per_conversation(index):
+            return Case(
+                *(When(id=conversation_id, then=Value(change[index])) for conversation_id, change in changes.items()),
+                default=Value(0)
+            )
+
+        # One relative UPDATE for all of them, so concurrent writers don't
+        # overwrite each other.
+        cls.objects.filter(id__in=changes).update(
+            last_message_id=Greatest(Coalesce(F("last_message_id"), 0), per_conversation(0)),
+            unread_a=F("unread_a") + per_conversation(1),
+            unread_b=F("unread_b") + per_conversation(2)
+        )
+
+
+class Message(models.Model):
+    sender = models.ForeignKey(
+        Peer,
+        on_delete=models.CASCADE,
+        related_name="sent_messages"
+    )
+    # 1:1 messages have a receiver, group messages a group (stored once
+    # for all members).
+    receiver = models.ForeignKey(
+        Peer,
+        on_delete=models.CASCADE,
+        related_name="received_messages",
+        null=True,
+        blank=True
+    )
+    group = models.ForeignKey(
+        Group,
+        on_delete=models.CASCADE,
+        related_name="messages",
+        null=True,
+        blank=True
+    )
+    # Set for 1:1 messages; history is read through (conversation, id).
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name="messages",
+        null=True,
+        blank=True,
+        db_index=False
+    )
+    content = models.TextField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+    # Id (hex) the sending peer gave the message on the P2P connection, so
+    # the receiver can tell the server's copy from a second message.
+    msg_id = models.CharField(max_length=32, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversation", "id"], name="message_conversation_id"),
+            models.Index(fields=["group", "id"], name="message_group_id"),
+        ]
+
+    def __str__(self):
+        return f"{self.sender} -> {self.group or self.receiver}"
@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from . import stun
+
+logger = logging.getLogger("server.presence")
+
+# Datagrams start with a 4 byte tag. Its first byte has the two high bits
+# set to 01, so they never look like a STUN message (00).
+HEARTBEAT_MAGIC = b"P2HB"  # + utf-8 username
+HEARTBEAT_ACK = b"P2HA"
+PUNCH_REQUEST = b"P2PC"    # + JSON {"from", "to"}: introduce me to "to"
+INTRODUCTION = b"P2PI"     # + JSON {"username", "ip", "port"}: punch towards this address
+UNREACHABLE = b"P2PN"      # + JSON {"username"}: no UDP address known for it
+MAX_DATAGRAM = 512
+FLUSH_BATCH_SIZE = 500
+
+
+class PresenceTable:
+    """
+    username -> time and source address of the last heartbeat, kept in memory.
+
+    Heartbeats only touch this table; `flush()` writes the usernames seen
+    since the previous flush to Peer.last_seen in a few batched UPDATEs, so
+    the database sees one write per FLUSH_INTERVAL instead of one per beat.
+    """
+
+    def __init__(self):
+        self._seen = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.heartbeats = 0
+        self.flushed = 0
+
+    def seen(self, username, addr=None, when=None):
+        when = when or time.time()
+        with self._lock:
+            self._seen[username] = (when, addr)
+            self._dirty.add(username)
+            self.heartbeats += 1
+
+    def last_seen(self, username):
+        """datetime of the last heartbeat from `username`, or None."""
+        with self._lock:
+            when, _ = self._seen.get(username, (None, None))
+        return datetime.fromtimestamp(when, timezone.utc) if when else None
+
+    def address(self, username):
+        """(ip, port) the last heartbeat of `username` came from, if still online."""
+        with self._lock:
+            when, addr = self._seen.get(username, (None, None))
+        if when is None or when < time.time() - settings.PEER_ONLINE_WINDOW:
+            return None
+        return addr
+
+    def freshest(self, username, stored):
+        """The later of the stored last_seen and the last heartbeat."""
+        heard = self.last_seen(username)
+        return heard if heard and (stored is None or heard > stored) else stored
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
+
+    def flush(self):
+        """Write pending heartbeats to Peer.last_seen; returns the rows updated."""
+        from .models import Peer
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            # Nobody will ask about peers that have been quiet for a whole window.
+            expired = time.time() - settings.PEER_ONLINE_WINDOW
+            self._seen = {name: seen for name, seen in self._seen.items() if seen[0] >= expired}
+        if not dirty:
+            return 0
+
+        # Flush time is precise enough: last_seen only drives the online window.
+        # Rows saved since (a registration) already have a later last_seen.
+        now = datetime.now(timezone.utc)
+        names = sorted(dirty)
+        updated = 0
+        try:
+            for start in range(0, len(names), FLUSH_BATCH_SIZE):
+                updated += Peer.objects.filter(
+                    username__in=names[start:start + FLUSH_BATCH_SIZE], last_seen__lt=now
+                ).update(last_seen=now)
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        self.flushed += updated
+        return updated
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tracked": len(self._seen),
+                "pending": len(self._dirty),
+                "heartbeats": self.heartbeats,
+                "flushed": self.flushed,
+            }
+
+
+presence = PresenceTable()
+
+
+def parse_heartbeat(data):
+    """Username carried by a heartbeat datagram, or None if it isn't one."""
+    if not data.startswith(HEARTBEAT_MAGIC):
+        return None
+    try:
+        username = data[len(HEARTBEAT_MAGIC):].decode()
+    except UnicodeDecodeError:
+        return None
+    return username if 0 < len(username) <= 50 else None
+
+
+class HeartbeatListener:
+    """
+    UDP socket on PRESENCE_UDP_PORT feeding `presence`, plus a thread
+    flushing it every PRESENCE_FLUSH_INTERVAL seconds.
+
+    The same socket answers STUN Binding requests with the sender's
+    reflexive address, and introduces peers to each other for UDP hole
+    punching: both sides get the other's heartbeat address (the mapping
+    their NAT keeps open for this socket) and start sending to it.
+    """
+
+    def __init__(self, host, port, flush_interval, table=presence):
+        self.table = table
+        self.flush_interval = flush_interval
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._receive_loop, name="presence-udp", daemon=True).start()
+        threading.Thread(target=self._flush_loop, name="presence-flush", daemon=True).start()
+        return self
+
+    def handle(self, data, addr):
+        if stun.is_stun(data):
+            transaction_id = stun.parse_binding_request(data)
+            if transaction_id is not None:
+                self.sock.sendto(stun.binding_success(transaction_id, addr), addr)
+            return
+        if data.startswith(PUNCH_REQUEST):
+            self.introduce(data[len(PUNCH_REQUEST):], addr)
+            return
+        username = parse_heartbeat(data)
+        if username is None:
+            return
+        self.table.seen(username, addr)
+        self.sock.sendto(HEARTBEAT_ACK, addr)
+
+    def introduce(self, payload, addr):
+        try:
+            request = json.loads(payload)
+            source, target = str(request["from"]), str(request["to"])
+        except (ValueError, KeyError, TypeError):
+            return
+        # Only the socket `source` heartbeats from may ask on its behalf.
+        if self.table.address(source) != addr:
+            self.sock.sendto(UNREACHABLE + json.dumps({"username": target}).encode(), addr)
+            return
+        target_addr = self.table.address(target)
+        if target_addr is None:
+            self.sock.sendto(UNREACHABLE + json.dumps({"username": target}).encode(), addr)
+            return
+        for to, username, (ip, port) in ((target_addr, source, addr), (addr, target, target_addr)):
+            self.sock.sendto(INTRODUCTION + json.dumps({"username": username, "ip": ip, "port": port}).encode(), to)
+
+    def _receive_loop(self):
+        while not self._stop.is_set():
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+                self.handle(data, addr)
+            except OSError:
+                if self._stop.is_set():
+                    return
+                # e.g. ICMP port unreachable for an earlier ack
+            except Exception:
+                logger.exception("Heartbeat handling failed")
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        close_old_connections()
+        try:
+            self.table.flush()
+        except Exception:
+            logger.exception("Presence flush failed")
+        finally:
+            connection.close()
+
+    def close(self):
+        self._stop.set()
+        self.sock.close()
+
+
+listener = None
+
+
+def should_listen(argv=None):
+    """
+    Only the process serving requests listens: not migrate, shell, etc.,
+    and not the runserver autoreloader's parent process.
+    """
+    argv = sys.argv if argv is None else argv
+    if not settings.PRESENCE_UDP_PORT:
+        return False
+    if not argv or os.path.basename(argv[0]) != "manage.py":
+        # Imported by a WSGI / ASGI server.
+        return True
+    if len(argv) < 2 or argv[1] != "runserver":
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in argv
+
+
+def start_listener():
+    global listener
+    if listener is not None or not should_listen():
+        return listener
+    try:
+        listener = HeartbeatListener(
+            settings.PRESENCE_UDP_HOST, settings.PRESENCE_UDP_PORT, settings.PRESENCE_FLUSH_INTERVAL
+        ).start()
+    except OSError as e:
+        # Another worker already owns the port; its flushes keep last_seen current.
+        logger.warning("Heartbeat listener not started on UDP %s: %s", settings.PRESENCE_UDP_PORT, e)
+        return None
+    logger.info("Listening for heartbeats on UDP %s", listener.port)
+    return listener
@@ -0,0 +1,48 @@
+import ipaddress
+import struct
+
+# RFC 5389 message header:
+#
+#   0b00 + type (14 bits) | length (u16) | magic cookie (u32) | transaction id (12 bytes)
+#
+# followed by `length` bytes of TLV attributes, each padded to 4 bytes.
+HEADER = struct.Struct("!HHI12s")
+MAGIC_COOKIE = 0x2112A442
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+FAMILY_IPV4 = 0x01
+FAMILY_IPV6 = 0x02
+
+
+def is_stun(data):
+    """STUN messages start with two zero bits and carry the magic cookie."""
+    return len(data) >= HEADER.size and data[0] & 0xC0 == 0 and data[4:8] == MAGIC_COOKIE.to_bytes(4, "big")
+
+
+def parse_binding_request(data):
+    """Transaction id of a well-formed Binding request, or None."""
+    if not is_stun(data):
+        return None
+    msg_type, length, _, transaction_id = HEADER.unpack_from(data)
+    if msg_type != BINDING_REQUEST or length % 4 or length != len(data) - HEADER.size:
+        return None
+    # Binding requests need no attributes; any that came along are ignored.
+    return transaction_id
+
+
+def xor_mapped_address(transaction_id, ip, port):
+    address = ipaddress.ip_address(ip)
+    if address.version == 4:
+        family, mask = FAMILY_IPV4, MAGIC_COOKIE.to_bytes(4, "big")
+    else:
+        family, mask = FAMILY_IPV6, MAGIC_COOKIE.to_bytes(4, "big") + transaction_id
+    xored = bytes(a ^ b for a, b in zip(address.packed, mask))
+    value = struct.pack("!BBH", 0, family, port ^ (MAGIC_COOKIE >> 16)) + xored
+    return struct.pack("!HH", ATTR_XOR_MAPPED_ADDRESS, len(value)) + value
+
+
+def binding_success(transaction_id, addr):
+    """Binding success response telling the client `addr`, its reflexive transport address."""
+    attributes = xor_mapped_address(transaction_id, addr[0], addr[1])
+    return HEADER.pack(BINDING_SUCCESS, len(attributes), MAGIC_COOKIE, transaction_id) + attributes
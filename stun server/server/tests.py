@@ -1,3 +1,811 @@
-from django.test import TestCase
-
-# Create your tests here.
+import asyncio
+import json
+import os
+import pstats
+import socket
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
+
+from . import views
+from .models import Conversation, Friendship, Group, GroupMembership, Message, Peer
+from .presence import HEARTBEAT_ACK, HEARTBEAT_MAGIC, HeartbeatListener, PresenceTable
+
+
+def make_peer(username, port=5000):
+    return Peer.objects.create(username=username, ip="10.0.0.1", port=port)
+
+
+class ApiTestCase(TestCase):
+    def setUp(self):
+        # Cached reads outlive the rolled back rows of earlier tests.
+        cache.clear()
+
+    def post(self, path, data):
+        return self.client.post(path, json.dumps(data), content_type="application/json")
+
+
+class BulkCreateMessagesTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = make_peer("alice")
+        self.bob = make_peer("bob")
+        self.team = Group.objects.create(name="team", owner=self.alice)
+        GroupMembership.objects.create(group=self.team, peer=self.alice)
+        GroupMembership.objects.create(group=self.team, peer=self.bob)
+
+    def test_stores_direct_and_group_messages(self):
+        r = self.post("/message/bulk_create/", {"messages": [
+            {"sender": "alice", "receiver": "bob", "content": "hello"},
+            {"sender": "alice", "group": "team", "content": "hi all"},
+        ]})
+        self.assertEqual(r.status_code, 201)
+        body = r.json()
+        self.assertEqual(body["count"], 2)
+        self.assertEqual(body["errors"], [])
+        direct, group = Message.objects.order_by("id")
+        self.assertEqual(body["message_ids"], [direct.id, group.id])
+        self.assertEqual(direct.conversation, Conversation.between(self.alice.id, self.bob.id))
+        self.assertEqual(group.group, self.team)
+        self.assertIsNone(group.conversation)
+
+    def test_invalid_items_are_reported_and_the_rest_stored(self):
+        r = self.post("/message/bulk_create/", {"messages": [
+            {"sender": "alice", "receiver": "bob", "content": "hi"},
+            {"sender": "alice", "receiver": "bob", "content": ""},
+            {"sender": "alice", "receiver": "nobody", "content": "lost"},
+            {"sender": "alice", "group": "nogroup", "content": "lost"},
+            {"sender": "alice", "receiver": "bob", "group": "team", "content": "both"},
+            {"sender": "alice", "receiver": ["bob"], "content": "list"},
+            {"sender": "alice", "receiver": "bob", "content": "later"},
+        ]})
+        self.assertEqual(r.status_code, 201)
+        body = r.json()
+        self.assertEqual(body["count"], 2)
+        self.assertEqual([error["index"] for error in body["errors"]], [1, 2, 3, 4, 5])
+        self.assertEqual(body["errors"][1]["error"], "Sender or receiver not found")
+        self.assertEqual(body["errors"][2]["error"], "Group not found")
+        ids = body["message_ids"]
+        self.assertEqual([i is not None for i in ids], [True, False, False, False, False, False, True])
+        self.assertEqual(
+            list(Message.objects.filter(id__in=[ids[0], ids[6]]).values_list("content", flat=True)),
+            ["hi", "later"]
+        )
+
+    def test_batch_without_valid_items_is_rejected(self):
+        r = self.post("/message/bulk_create/", {"messages": [
+            {"sender": "alice", "receiver": "bob", "content": ""},
+            {"sender": "ghost", "receiver": "bob", "content": "boo"},
+        ]})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(len(r.json()["errors"]), 2)
+        self.assertFalse(Message.objects.exists())
+
+    def test_msg_id_is_stored_and_returned_with_history(self):
+        r = self.post("/message/bulk_create/", {"messages": [
+            {"sender": "alice", "receiver": "bob", "content": "hi", "msg_id": "ab" * 16},
+            {"sender": "alice", "receiver": "bob", "content": "no id"},
+            {"sender": "alice", "receiver": "bob", "content": "long", "msg_id": "a" * 33},
+        ]})
+        self.assertEqual(r.json()["errors"], [{"index": 2, "error": "msg_id too long"}])
+        history = self.client.get("/message/get/", {"peer1": "bob", "peer2": "alice"}).json()["messages"]
+        self.assertEqual([(m["message"], m["msg_id"]) for m in history], [("hi", "ab" * 16), ("no id", None)])
+
+    def test_malformed_request(self):
+        self.assertEqual(self.post("/message/bulk_create/", {"messages": []}).status_code, 400)
+        self.assertEqual(self.post("/message/bulk_create/", [1]).status_code, 400)
+        r = self.client.post("/message/bulk_create/", "{", content_type="application/json")
+        self.assertEqual(r.status_code, 400)
+
+
+class EventsTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        make_peer("alice")
+        make_peer("bob")
+
+    def poll(self, username, cursor=None, timeout=0):
+        params = {"username": username, "timeout": timeout}
+        if cursor:
+            params["cursor"] = cursor
+        r = self.client.get("/events/", params)
+        self.assertEqual(r.status_code, 200)
+        return r.json()
+
+    def test_events_after_bootstrap_reach_the_first_poll(self):
+        cursor = self.post("/session/bootstrap", {"username": "bob"}).json()["events_cursor"]
+        message_id = self.post("/message/bulk_create/", {"messages": [
+            {"sender": "alice", "receiver": "bob", "content": "hi"}
+        ]}).json()["message_ids"][0]
+
+        result = self.poll("bob", cursor)
+        self.assertEqual(result["events"], [{"type": "message", "from": "alice", "id": message_id}])
+        self.assertFalse(result["reset"])
+        self.assertEqual(self.poll("bob", result["cursor"])["events"], [])
+
+    def test_first_poll_without_cursor_only_returns_one(self):
+        self.post("/friend/start/", {"user1": "alice", "user2": "bob"})
+        result = self.poll("bob")
+        self.assertEqual(result["events"], [])
+        self.assertTrue(result["cursor"])
+
+    def test_cursor_from_another_boot_resets(self):
+        self.assertTrue(self.poll("bob", "deadbeef:1")["reset"])
+
+    def test_unknown_peer(self):
+        self.assertEqual(self.client.get("/events/", {"username": "nobody"}).status_code, 404)
+
+    def test_friendship_is_announced_to_both_sides(self):
+        alice, bob = self.poll("alice")["cursor"], self.poll("bob")["cursor"]
+        self.post("/friend/start/", {"user1": "alice", "user2": "bob"})
+        self.assertEqual(self.poll("alice", alice)["events"], [{"type": "friendship", "username": "bob"}])
+        self.assertEqual(self.poll("bob", bob)["events"], [{"type": "friendship", "username": "alice"}])
+
+    def test_new_address_is_announced_to_friends(self):
+        self.post("/friend/start/", {"user1": "alice", "user2": "bob"})
+        cursor = self.poll("bob")["cursor"]
+        self.post("/register", {"username": "alice", "ip": "10.0.0.1", "port": 5000})
+        self.assertEqual(self.poll("bob", cursor)["events"], [])
+
+        self.post("/register", {"username": "alice", "ip": "10.0.0.2", "port": 6000})
+        self.assertEqual(self.poll("bob", cursor)["events"], [
+            {"type": "address", "username": "alice", "ip": "10.0.0.2", "port": 6000}
+        ])
+
+    def test_group_message_reaches_the_other_members(self):
+        self.post("/group/create/", {"name": "team", "owner": "alice", "members": ["bob"]})
+        alice, bob = self.poll("alice")["cursor"], self.poll("bob")["cursor"]
+        message_id = self.post("/message/bulk_create/", {"messages": [
+            {"sender": "alice", "group": "team", "content": "hi all"}
+        ]}).json()["message_ids"][0]
+        self.assertEqual(self.poll("bob", bob)["events"], [
+            {"type": "group_message", "group": "team", "from": "alice", "id": message_id}
+        ])
+        self.assertEqual(self.poll("alice", alice)["events"], [])
+
+
+class ConversationTest(TestCase):
+    def setUp(self):
+        self.alice = make_peer("alice")
+        self.bob = make_peer("bob")
+        self.carol = make_peer("carol")
+
+    def test_for_pairs_creates_each_pair_once(self):
+        alice, bob, carol = self.alice.id, self.bob.id, self.carol.id
+        found = Conversation.for_pairs([(bob, alice), (alice, bob), (alice, carol)])
+        self.assertIs(found[bob, alice], found[alice, bob])
+        self.assertEqual((found[bob, alice].peer_a_id, found[bob, alice].peer_b_id), (alice, bob))
+        self.assertEqual(Conversation.objects.count(), 2)
+
+        again = Conversation.for_pairs([(carol, alice)])
+        self.assertEqual(again[carol, alice].id, found[alice, carol].id)
+        self.assertEqual(Conversation.objects.count(), 2)
+        self.assertEqual(Conversation.for_pairs([]), {})
+
+    def test_record_messages_counts_unread_per_receiver(self):
+        conversation = Conversation.for_pairs([(self.alice.id, self.bob.id)])[self.alice.id, self.bob.id]
+        messages = [
+            Message.objects.create(sender=sender, receiver=receiver, content="hi", conversation=conversation)
+            for sender, receiver in ((self.alice, self.bob), (self.alice, self.bob), (self.bob, self.alice))
+        ]
+        team = Group.objects.create(name="team", owner=self.alice)
+        group_message = Message.objects.create(sender=self.alice, group=team, content="hi all")
+
+        Conversation.record_messages(messages + [group_message])
+        conversation.refresh_from_db()
+        # alice has the lower id, so she is peer_a.
+        self.assertEqual((conversation.unread_a, conversation.unread_b), (1, 2))
+        self.assertEqual(conversation.last_message_id, messages[-1].id)
+
+        # A late batch adds to the counts but never moves last_message_id back.
+        Conversation.record_messages(messages[:1])
+        conversation.refresh_from_db()
+        self.assertEqual((conversation.unread_a, conversation.unread_b), (1, 3))
+        self.assertEqual(conversation.last_message_id, messages[-1].id)
+
+
+class BackfillConversationsTest(TransactionTestCase):
+    """0007_backfill_conversations, run on data written before conversations existed."""
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_one_conversation_per_pair(self):
+        apps = self.migrate([("server", "0006_conversation")])
+        OldPeer = apps.get_model("server", "Peer")
+        OldGroup = apps.get_model("server", "Group")
+        OldMessage = apps.get_model("server", "Message")
+        alice, bob, carol = (OldPeer.objects.create(username=name, ip="10.0.0.1", port=5000)
+                             for name in ("alice", "bob", "carol"))
+        messages = [
+            OldMessage.objects.create(sender=sender, receiver=receiver, content="hi")
+            for sender, receiver in ((alice, bob), (bob, alice), (carol, alice), (alice, bob))
+        ]
+        group_message = OldMessage.objects.create(
+            sender=alice, group=OldGroup.objects.create(name="team", owner=alice), content="hi all"
+        )
+
+        apps = self.migrate([("server", "0007_backfill_conversations")])
+        NewConversation = apps.get_model("server", "Conversation")
+        NewMessage = apps.get_model("server", "Message")
+        conversations = {(c.peer_a_id, c.peer_b_id): c for c in NewConversation.objects.all()}
+        self.assertEqual(
+            {pair: c.last_message_id for pair, c in conversations.items()},
+            {(alice.id, bob.id): messages[3].id, (alice.id, carol.id): messages[2].id}
+        )
+        conversation_of = dict(NewMessage.objects.values_list("id", "conversation_id"))
+        self.assertEqual([conversation_of[m.id] for m in messages], [
+            conversations[alice.id, bob.id].id, conversations[alice.id, bob.id].id,
+            conversations[alice.id, carol.id].id, conversations[alice.id, bob.id].id,
+        ])
+        self.assertIsNone(conversation_of[group_message.id])
+
+
+class DirectoryTest(ApiTestCase):
+    NAMES = ["alice", "bob", "carl", "carol", "cat", "dave", "erin"]
+
+    def setUp(self):
+        super().setUp()
+        for name in self.NAMES:
+            make_peer(name)
+        Peer.objects.filter(username__in=["bob", "cat"]).update(last_seen=timezone.now() - timedelta(hours=1))
+        # Only heartbeats sent by the tests, not by other tests in this process.
+        self.presence = PresenceTable()
+        patcher = mock.patch.object(views, "presence", self.presence)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        r = self.client.get("/directory/", params)
+        self.assertEqual(r.status_code, 200)
+        return r.json()
+
+    def names(self, **params):
+        return [p["username"] for p in self.get(**params)["peers"]]
+
+    def walk(self, **params):
+        """Every username of every page, following `next`."""
+        names, after = [], None
+        while True:
+            body = self.get(**params, **({"after": after} if after else {}))
+            names += [p["username"] for p in body["peers"]]
+            after = body["next"]
+            if after is None:
+                return names
+
+    def test_pages_follow_each_other(self):
+        body = self.get(limit=3)
+        self.assertEqual([p["username"] for p in body["peers"]], self.NAMES[:3])
+        self.assertEqual(body["next"], "carl")
+        # A peer registering before the cursor doesn't shift the next page.
+        make_peer("aaron")
+        body = self.get(limit=3, after=body["next"])
+        self.assertEqual([p["username"] for p in body["peers"]], self.NAMES[3:6])
+        body = self.get(limit=3, after=body["next"])
+        self.assertEqual(([p["username"] for p in body["peers"]], body["next"]), (["erin"], None))
+
+        for limit in (1, 2, 7, 200):
+            self.assertEqual(self.walk(limit=limit), ["aaron"] + self.NAMES)
+
+    def test_exact_last_page_has_no_next(self):
+        body = self.get(limit=len(self.NAMES))
+        self.assertEqual(len(body["peers"]), len(self.NAMES))
+        self.assertIsNone(body["next"])
+
+    def test_online_filter(self):
+        self.assertEqual(self.walk(online=1, limit=2), ["alice", "carl", "carol", "dave", "erin"])
+        self.assertEqual(self.walk(online=0, limit=1), ["bob", "cat"])
+        peers = {p["username"]: p["online"] for p in self.get()["peers"]}
+        self.assertEqual(peers, {name: name not in ("bob", "cat") for name in self.NAMES})
+
+    def test_heartbeats_not_flushed_yet(self):
+        self.presence.seen("bob")
+        # Filtered on the stored last_seen, reported with the heartbeat.
+        self.assertEqual(self.get(online=0)["peers"][0]["username"], "bob")
+        self.assertTrue(self.get(online=0)["peers"][0]["online"])
+        self.assertNotIn("bob", self.names(online=1))
+
+    def test_prefix(self):
+        self.assertEqual(self.names(q="ca"), ["carl", "carol", "cat"])
+        self.assertEqual(self.walk(q="ca", limit=1), ["carl", "carol", "cat"])
+        self.assertEqual(self.names(q="car", online=1), ["carl", "carol"])
+        self.assertEqual(self.names(q="carl"), ["carl"])
+        self.assertEqual(self.names(q="x"), [])
+        self.assertEqual(self.names(q="ca", after="carol"), ["cat"])
+
+    def test_prefix_at_the_end_of_unicode(self):
+        top = chr(0x10FFFF)
+        for name in (top, top + "a", "z" + top, "z" + top + top + "q", "{", "\ud7ffx", "\ue000"):
+            make_peer(name)
+        self.assertEqual(self.names(q=top), [top, top + "a"])
+        self.assertEqual(self.names(q=top + top), [])
+        self.assertEqual(self.names(q="z" + top), ["z" + top, "z" + top + top + "q"])
+        self.assertEqual(self.names(q="z" + top + top), ["z" + top + top + "q"])
+        self.assertEqual(self.names(q="\ud7ff"), ["\ud7ffx"])
+
+    def test_prefix_range(self):
+        top = chr(0x10FFFF)
+        self.assertEqual(views._prefix_range("ca"), ("ca", "cb"))
+        self.assertEqual(views._prefix_range("a" + top), ("a" + top, "b"))
+        self.assertEqual(views._prefix_range(top * 2), (top * 2, None))
+        self.assertEqual(views._prefix_range("\ud7ff"), ("\ud7ff", "\ue000"))
+
+    def test_invalid_parameters(self):
+        for params in ({"online": "yes"}, {"limit": "many"}):
+            self.assertEqual(self.client.get("/directory/", params).status_code, 400, params)
+
+
+class PresenceTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("alice", "bob", "carol"):
+            make_peer(name)
+        self.an_hour_ago = timezone.now() - timedelta(hours=1)
+        Peer.objects.update(last_seen=self.an_hour_ago)
+        self.table = PresenceTable()
+        patcher = mock.patch.object(views, "presence", self.table)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def last_seen(self):
+        return dict(Peer.objects.values_list("username", "last_seen"))
+
+    def test_heartbeats_are_flushed_in_one_update(self):
+        for name in ("alice", "bob", "alice", "alice", "carol", "nobody"):
+            self.table.seen(name)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.table.flush(), 3)
+        self.assertEqual(len(set(self.last_seen().values())), 1)
+        self.assertGreater(self.last_seen()["alice"], self.an_hour_ago)
+        self.assertEqual(self.table.stats(), {"tracked": 4, "pending": 0, "heartbeats": 6, "flushed": 3})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.table.flush(), 0)
+
+    def test_large_flushes_are_batched(self):
+        for name in ("alice", "bob", "carol"):
+            self.table.seen(name)
+        with mock.patch("server.presence.FLUSH_BATCH_SIZE", 2), self.assertNumQueries(2):
+            self.assertEqual(self.table.flush(), 3)
+
+    def test_online_before_the_flush(self):
+        listener = HeartbeatListener("127.0.0.1", 0, 3600, table=self.table)
+        self.addCleanup(listener.close)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.bind(("127.0.0.1", 0))
+        client.settimeout(5)
+        self.assertFalse(self.client.get("/peerinfo", {"username": "alice"}).json()["online"])
+
+        listener.handle(HEARTBEAT_MAGIC + b"alice", client.getsockname())
+        self.assertEqual(client.recv(64), HEARTBEAT_ACK)
+        self.assertEqual(self.table.address("alice"), client.getsockname())
+        # Served from the table; the row still has the old time.
+        self.assertTrue(self.client.get("/peerinfo", {"username": "alice"}).json()["online"])
+        self.assertEqual(self.last_seen()["alice"], self.an_hour_ago)
+        self.assertEqual(self.client.get("/directory/", {"q": "alice"}).json()["peers"][0]["online"], True)
+
+    def test_flush_keeps_a_newer_registration(self):
+        self.table.seen("alice")
+        self.table.seen("bob")
+        self.post("/register", {"username": "alice", "ip": "10.0.0.2", "port": 6000})
+        # bob registered after the flush read the clock.
+        later = timezone.now() + timedelta(seconds=5)
+        Peer.objects.filter(username="bob").update(last_seen=later)
+
+        self.assertEqual(self.table.flush(), 1)
+        alice = Peer.objects.get(username="alice")
+        self.assertEqual((alice.ip, alice.port), ("10.0.0.2", 6000))
+        self.assertGreater(alice.last_seen, self.an_hour_ago)
+        self.assertEqual(self.last_seen()["bob"], later)
+
+
+class GetMessagesTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        make_peer("alice")
+        make_peer("bob")
+        make_peer("carol")
+        self.ids = self.post("/message/bulk_create/", {"messages": [
+            {"sender": sender, "receiver": receiver, "content": f"m{i}"}
+            for i, (sender, receiver) in enumerate([("alice", "bob"), ("bob", "alice")] * 2 + [("alice", "bob")])
+        ] + [{"sender": "alice", "receiver": "carol", "content": "elsewhere"}]}).json()["message_ids"][:5]
+
+    def page(self, **params):
+        r = self.client.get("/message/get/", {"peer1": "bob", "peer2": "alice", **params})
+        self.assertEqual(r.status_code, 200)
+        body = r.json()
+        return [m["id"] for m in body["messages"]], body
+
+    def test_latest_page_then_backwards(self):
+        ids, body = self.page(limit=2)
+        self.assertEqual(ids, self.ids[3:])
+        self.assertTrue(body["has_more"])
+        self.assertEqual((body["oldest_id"], body["newest_id"]), (self.ids[3], self.ids[4]))
+
+        ids, body = self.page(limit=2, before=body["oldest_id"])
+        self.assertEqual(ids, self.ids[1:3])
+        self.assertTrue(body["has_more"])
+
+        ids, body = self.page(limit=2, before=body["oldest_id"])
+        self.assertEqual(ids, self.ids[:1])
+        self.assertFalse(body["has_more"])
+
+    def test_forwards_from_a_cursor(self):
+        ids, body = self.page(limit=2, after=self.ids[1])
+        self.assertEqual(ids, self.ids[2:4])
+        self.assertTrue(body["has_more"])
+
+        ids, body = self.page(limit=2, after=body["newest_id"])
+        self.assertEqual(ids, self.ids[4:])
+        self.assertFalse(body["has_more"])
+
+        ids, body = self.page(after=self.ids[4])
+        self.assertEqual(ids, [])
+        self.assertEqual((body["has_more"], body["oldest_id"], body["newest_id"]), (False, None, None))
+
+    def test_message_fields(self):
+        _, body = self.page(limit=1, before=self.ids[1])
+        self.assertEqual(body["messages"], [{"id": self.ids[0], "message": "m0", "from": "alice", "msg_id": None}])
+
+    def test_peers_without_messages(self):
+        r = self.client.get("/message/get/", {"peer1": "bob", "peer2": "carol"})
+        self.assertEqual(r.json(), {"messages": [], "has_more": False, "oldest_id": None, "newest_id": None})
+
+    def test_invalid_requests(self):
+        for params, status in (
+            ({"before": self.ids[2], "after": self.ids[0]}, 400),
+            ({"before": "latest"}, 400),
+            ({"peer2": "nobody"}, 404),
+        ):
+            r = self.client.get("/message/get/", {"peer1": "bob", "peer2": "alice", **params})
+            self.assertEqual(r.status_code, status, params)
+        self.assertEqual(self.client.get("/message/get/", {"group": "nothing"}).status_code, 404)
+
+
+class ExportMessagesTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("alice", "bob", "carol", "dave"):
+            make_peer(name)
+        self.post("/group/create/", {"name": "team", "owner": "alice", "members": ["bob"]})
+        self.post("/message/bulk_create/", {"messages": [
+            {"sender": "carol", "receiver": "alice", "content": "c1"},
+            {"sender": "alice", "receiver": "bob", "content": "b1"},
+            {"sender": "bob", "group": "team", "content": "t1"},
+            {"sender": "bob", "receiver": "alice", "content": "b2"},
+            {"sender": "carol", "receiver": "dave", "content": "not alice's"},
+            {"sender": "alice", "receiver": "carol", "content": "c2"},
+            {"sender": "alice", "group": "team", "content": "t2"},
+        ]})
+
+    def export(self, **params):
+        r = self.client.get("/message/export/", {"username": "alice", **params})
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        self.assertEqual(r["Content-Type"], "application/x-ndjson")
+        body = b"".join(r.streaming_content).decode()
+        self.assertEqual(body, "".join(line + "\n" for line in body.splitlines()))
+        return r, [json.loads(line) for line in body.splitlines()]
+
+    def test_all_conversations_one_object_per_line(self):
+        r, lines = self.export()
+        self.assertEqual(r["Content-Disposition"], 'attachment; filename="alice-all.ndjson"')
+        # Conversations by name, then groups; oldest first within each.
+        self.assertEqual([(m["conversation"], m["from"], m["message"]) for m in lines], [
+            ("bob", "alice", "b1"), ("bob", "bob", "b2"),
+            ("carol", "carol", "c1"), ("carol", "alice", "c2"),
+            ("#team", "bob", "t1"), ("#team", "alice", "t2"),
+        ])
+        self.assertEqual(set(lines[0]), {"id", "conversation", "from", "message", "timestamp"})
+
+    def test_one_conversation_or_group(self):
+        _, lines = self.export(peer="carol")
+        self.assertEqual([m["message"] for m in lines], ["c1", "c2"])
+        _, lines = self.export(group="team")
+        self.assertEqual([m["message"] for m in lines], ["t1", "t2"])
+        _, lines = self.export(peer="dave")
+        self.assertEqual(lines, [])
+
+    def test_lines_are_not_split_between_writes(self):
+        with mock.patch.object(views, "EXPORT_WRITE_SIZE", 1):
+            r = self.client.get("/message/export/", {"username": "alice"})
+            chunks = list(r.streaming_content)
+        self.assertEqual(len(chunks), 6)
+        for chunk in chunks:
+            self.assertEqual(chunk.count(b"\n"), 1)
+            json.loads(chunk)
+
+    async def test_asgi_request_streams_asynchronously(self):
+        r = await self.async_client.get("/message/export/", {"username": "alice"})
+        self.assertTrue(r.is_async)
+        body = b"".join([chunk async for chunk in r.streaming_content]).decode()
+        self.assertEqual([json.loads(line)["message"] for line in body.splitlines()],
+                         ["b1", "b2", "c1", "c2", "t1", "t2"])
+
+    def test_only_the_requesting_peer_s_history(self):
+        # No sessions here: a group is only exported to its members.
+        r = self.client.get("/message/export/", {"username": "carol", "group": "team"})
+        self.assertEqual(r.status_code, 404)
+        _, lines = self.export(username="dave")
+        self.assertEqual([m["message"] for m in lines], ["not alice's"])
+
+    def test_invalid_requests(self):
+        for params, status in (
+            ({}, 400),
+            ({"username": "alice", "peer": "bob", "group": "team"}, 400),
+            ({"username": "nobody"}, 404),
+            ({"username": "alice", "peer": "nobody"}, 404),
+            ({"username": "alice", "group": "nothing"}, 404),
+        ):
+            r = self.client.get("/message/export/", params)
+            self.assertEqual(r.status_code, status, params)
+        self.assertEqual(self.client.post("/message/export/?username=alice").status_code, 405)
+
+
+class SessionBootstrapTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        bob = make_peer("bob")
+        make_peer("alice")
+        make_peer("carol")
+        Friendship.objects.create(owner=bob, friend_username="alice")
+        Friendship.objects.create(owner=bob, friend_username="carol")
+        self.ids = self.post("/message/bulk_create/", {"messages": [
+            {"sender": sender, "receiver": receiver, "content": "hi"}
+            for sender, receiver in [("alice", "bob")] * 3 + [("bob", "alice")]
+        ]}).json()["message_ids"]
+        self.post("/group/create/", {"name": "team", "owner": "alice", "members": ["bob"]})
+        self.group_ids = self.post("/message/bulk_create/", {"messages": [
+            {"sender": sender, "group": "team", "content": "hi all"} for sender in ("alice", "alice", "bob")
+        ]}).json()["message_ids"]
+
+    def bootstrap(self, **data):
+        r = self.post("/session/bootstrap", {"username": "bob", **data})
+        self.assertEqual(r.status_code, 200)
+        return r.json()
+
+    def test_without_cursors(self):
+        body = self.bootstrap()
+        self.assertEqual(body["peer"], {"username": "bob", "ip": "10.0.0.1", "port": 5000})
+        self.assertEqual(body["friends"], [
+            {"username": "alice", "last_message_id": self.ids[-1], "unread": 3},
+            {"username": "carol", "last_message_id": None, "unread": 0},
+        ])
+        self.assertEqual(body["groups"], [{"name": "team", "last_message_id": self.group_ids[-1], "unread": 2}])
+
+    def test_cursors_count_newer_messages_from_others(self):
+        body = self.bootstrap(cursors={"alice": self.ids[0]}, group_cursors={"team": self.group_ids[0]})
+        self.assertEqual(body["friends"][0]["unread"], 2)
+        self.assertEqual(body["groups"][0]["unread"], 1)
+
+    def test_cursor_at_the_newest_message_clears_the_stored_count(self):
+        body = self.bootstrap(cursors={"alice": self.ids[-1]})
+        self.assertEqual(body["friends"][0]["unread"], 0)
+        self.assertEqual(self.bootstrap()["friends"][0]["unread"], 0)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post("/session/bootstrap", {"username": "nobody"}).status_code, 404)
+        self.assertEqual(self.post("/session/bootstrap", {"username": "bob", "cursors": [1]}).status_code, 400)
+        self.assertEqual(self.post("/session/bootstrap", {}).status_code, 400)
+
+
+class GroupsTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        make_peer("alice")
+        make_peer("bob")
+        make_peer("carol")
+
+    def members(self, response):
+        return [member["username"] for member in response.json()["members"]]
+
+    def test_create_group_includes_the_owner(self):
+        r = self.post("/group/create/", {"name": "team", "owner": "alice", "members": ["bob"]})
+        self.assertEqual(r.status_code, 201)
+        self.assertEqual(self.members(r), ["alice", "bob"])
+
+        self.assertEqual(self.post("/group/create/", {"name": "team", "owner": "bob"}).status_code, 409)
+        r = self.post("/group/create/", {"name": "other", "owner": "alice", "members": ["zed"]})
+        self.assertEqual((r.status_code, r.json()["usernames"]), (404, ["zed"]))
+        self.assertFalse(Group.objects.filter(name="other").exists())
+
+    def test_adding_members_twice_is_a_no_op(self):
+        self.post("/group/create/", {"name": "team", "owner": "alice"})
+        for _ in range(2):
+            r = self.post("/group/add/", {"group": "team", "usernames": ["carol", "bob"]})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(self.members(r), ["alice", "bob", "carol"])
+        self.assertEqual(GroupMembership.objects.count(), 3)
+        self.assertEqual(self.post("/group/add/", {"group": "nothing", "usernames": ["bob"]}).status_code, 404)
+        self.assertEqual(self.post("/group/add/", {"group": "team", "usernames": []}).status_code, 400)
+
+    def test_members_with_addresses(self):
+        self.post("/group/create/", {"name": "team", "owner": "alice", "members": ["bob"]})
+        r = self.client.get("/group/members/", {"group": "team"})
+        self.assertEqual(r.json()["members"][1], {"username": "bob", "ip": "10.0.0.1", "port": 5000})
+        self.assertEqual(self.client.get("/group/members/", {"group": "nothing"}).status_code, 404)
+        self.assertEqual(self.client.get("/group/members/").status_code, 400)
+
+    def test_group_messages_are_stored_once_and_paginated(self):
+        self.post("/group/create/", {"name": "team", "owner": "alice", "members": ["bob", "carol"]})
+        ids = self.post("/message/bulk_create/", {"messages": [
+            {"sender": "alice", "group": "team", "content": f"m{i}"} for i in range(3)
+        ]}).json()["message_ids"]
+        self.assertEqual(Message.objects.filter(group__name="team").count(), 3)
+
+        body = self.client.get("/message/get/", {"group": "team", "limit": 2}).json()
+        self.assertEqual([m["id"] for m in body["messages"]], ids[1:])
+        self.assertTrue(body["has_more"])
+        body = self.client.get("/message/get/", {"group": "team", "before": ids[1]}).json()
+        self.assertEqual(([m["message"] for m in body["messages"]], body["has_more"]), (["m0"], False))
+
+
+class CacheInvalidationTest(ApiTestCase):
+    def register(self, username, ip="10.0.0.1", port=5000):
+        return self.post("/register", {"username": username, "ip": ip, "port": port})
+
+    def peerinfo(self, username):
+        return self.client.get("/peerinfo", {"username": username})
+
+    def test_peerinfo_follows_re_registration(self):
+        self.assertEqual(self.register("alice").status_code, 201)
+        self.assertEqual(self.peerinfo("alice").json()["port"], 5000)
+        self.assertEqual(self.register("alice", "10.0.0.2", 6000).status_code, 200)
+        self.assertEqual((self.peerinfo("alice").json()["ip"], self.peerinfo("alice").json()["port"]), ("10.0.0.2", 6000))
+
+    def test_unknown_peer_until_it_registers(self):
+        self.assertEqual(self.peerinfo("alice").status_code, 404)
+        self.register("alice")
+        self.assertEqual(self.peerinfo("alice").status_code, 200)
+
+    def test_repeated_reads_skip_the_database(self):
+        self.register("alice")
+        self.peerinfo("alice")
+        self.client.get("/friend/get/", {"username": "alice"})
+        self.client.get("/peers")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.peerinfo("alice").status_code, 200)
+            self.client.get("/friend/get/", {"username": "alice"})
+            self.client.get("/peers")
+
+    def test_friend_and_peer_lists(self):
+        self.register("alice")
+        self.register("bob")
+        self.assertEqual(self.client.get("/friend/get/", {"username": "alice"}).json()["friends"], [])
+        self.assertEqual(self.client.get("/peers").json()["peers"], [{"username": "alice"}, {"username": "bob"}])
+
+        self.post("/friend/start/", {"user1": "alice", "user2": "bob"})
+        self.register("carol")
+        self.assertEqual(self.client.get("/friend/get/", {"username": "alice"}).json()["friends"], [{"username": "bob"}])
+        self.assertEqual([p["username"] for p in self.client.get("/peers").json()["peers"]], ["alice", "bob", "carol"])
+
+
+async def asgi_request(handler, path, method="GET"):
+    """Status of one request served by `handler` as an ASGI server would."""
+    sent = []
+    received = asyncio.Event()
+
+    async def receive():
+        if received.is_set():
+            await asyncio.Event().wait()  # the client never disconnects
+        received.set()
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "method": method, "path": path, "query_string": b"",
+        "headers": [], "client": ("127.0.0.1", 40000), "server": ("testserver", 80),
+    }
+    await handler(scope, receive, send)
+    return sent[0]["status"]
+
+
+_both_in_view = threading.Barrier(2, timeout=5)
+
+
+def _meet(request):
+    # Only returns once a second request is inside the view too.
+    _both_in_view.wait()
+    return HttpResponse("ok")
+
+
+def _hello(request):
+    return HttpResponse("hello")
+
+
+async def _hello_async(request):
+    return HttpResponse("hello")
+
+
+def _boom(request):
+    raise RuntimeError("boom")
+
+
+class _TeapotOnErrorMiddleware(MiddlewareMixin):
+    def process_exception(self, request, exception):
+        return HttpResponse(status=418)
+
+
+urlpatterns = [
+    path("meet/", _meet),
+    path("hello/", _hello, name="hello"),
+    path("hello_async/", _hello_async, name="hello_async"),
+    path("boom/", _boom, name="boom"),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsgiSyncViewsTest(SimpleTestCase):
+    """
+    The Dockerfile runs one uvicorn worker. Sync views must still serve
+    requests side by side there, not one after another on a shared thread.
+    """
+
+    def test_two_sync_requests_run_at_once(self):
+        async def both():
+            handler = ASGIHandler()
+            return await asyncio.gather(asgi_request(handler, "/meet/"), asgi_request(handler, "/meet/"))
+
+        _both_in_view.reset()
+        self.assertEqual(asyncio.run(both()), [200, 200])
+
+
+@override_settings(ROOT_URLCONF=__name__, PROFILE_SAMPLE_RATE=1, PROFILE_THRESHOLD_MS=0)
+class AsgiProfilingTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(PROFILE_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def request(self, path, method="GET"):
+        return asyncio.run(asgi_request(ASGIHandler(), path, method))
+
+    def test_sampled_sync_view_is_profiled(self):
+        self.assertEqual(self.request("/hello/"), 200)
+        profiles = os.listdir(self.directory)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith("hello-"))
+        functions = {name for _, _, name in pstats.Stats(os.path.join(self.directory, profiles[0])).stats}
+        self.assertIn("_hello", functions)
+
+    def test_async_views_are_not_profiled(self):
+        self.assertEqual(self.request("/hello_async/"), 200)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_csrf_is_still_checked_before_the_view(self):
+        self.assertEqual(self.request("/hello/", "POST"), 403)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_process_exception_still_handles_sampled_views(self):
+        middleware = list(settings.MIDDLEWARE)
+        middleware.insert(middleware.index("server.middleware.ViewProfilerMiddleware"),
+                          f"{__name__}._TeapotOnErrorMiddleware")
+        with override_settings(MIDDLEWARE=middleware):
+            self.assertEqual(self.request("/boom/"), 418)
+        profiles = os.listdir(self.directory)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith("boom-"))
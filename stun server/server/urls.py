@@ -1,12 +1,21 @@
-from django.urls import path
-from .views import register, peers, peerinfo, create_message, start_friendship, get_friends, get_messages
-
-urlpatterns = [
-    path("register", register),
-    path("peers", peers),
-    path("peerinfo", peerinfo),
-    path("message/create/", create_message),
-    path("message/get/", get_messages),
-    path("friend/start/", start_friendship),
-    path("friend/get/", get_friends),
-]
+from django.urls import path
+from .views import register, peers, directory, peerinfo, create_message, bulk_create_messages, start_friendship, get_friends, get_messages, export_messages, session_bootstrap, create_group, add_group_members, group_members, metrics, events
+
+urlpatterns = [
+    path("register", register, name="register"),
+    path("peers", peers, name="peers"),
+    path("directory/", directory, name="directory"),
+    path("peerinfo", peerinfo, name="peerinfo"),
+    path("message/create/", create_message, name="create_message"),
+    path("message/bulk_create/", bulk_create_messages, name="bulk_create_messages"),
+    path("message/get/", get_messages, name="get_messages"),
+    path("message/export/", export_messages, name="export_messages"),
+    path("friend/start/", start_friendship, name="start_friendship"),
+    path("friend/get/", get_friends, name="get_friends"),
+    path("session/bootstrap", session_bootstrap, name="session_bootstrap"),
+    path("group/create/", create_group, name="create_group"),
+    path("group/add/", add_group_members, name="add_group_members"),
+    path("group/members/", group_members, name="group_members"),
+    path("events/", events, name="events"),
+    path("metrics", metrics, name="metrics"),
+]
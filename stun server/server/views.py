@@ -1,220 +1,1062 @@
-import json
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
-from .models import Peer, Message, Friendship
-
-
-@csrf_exempt
-def create_message(request):
-    """
-    POST:
-    {
-        "sender": "alice",
-        "receiver": "bob",
-        "content": "hello"
-    }
-    """
-
-    if request.method != "POST":
-        return JsonResponse(
-            {"error": "Only POST allowed"},
-            status=405
-        )
-
-    try:
-        data = json.loads(request.body.decode())
-        sender_username = data.get("sender")
-        receiver_username = data.get("receiver")
-        content = data.get("content")
-
-        if not sender_username or not receiver_username or not content:
-            return JsonResponse(
-                {"error": "Missing fields"},
-                status=400
-            )
-
-        sender = Peer.objects.get(username=sender_username)
-        receiver = Peer.objects.get(username=receiver_username)
-
-        msg = Message.objects.create(
-            sender=sender,
-            receiver=receiver,
-            content=content
-        )
-
-        return JsonResponse(
-            {
-                "status": "ok",
-                "message_id": msg.id
-            },
-            status=201
-        )
-
-    except Peer.DoesNotExist:
-        return JsonResponse(
-            {"error": "Sender or receiver not found"},
-            status=404
-        )
-
-    except json.JSONDecodeError:
-        return JsonResponse(
-            {"error": "Invalid JSON"},
-            status=400
-        )
-
-    except Exception as e:
-        return JsonResponse(
-            {"error": str(e)},
-            status=500
-        )
-
-@csrf_exempt
-@require_http_methods(["POST"])
-def register(request):
-    try:
-        data = json.loads(request.body)
-
-        username = data.get("username")
-        ip = data.get("ip")
-        port = data.get("port")
-
-        if not all([username, ip, port]):
-            return JsonResponse(
-                {"error": "username, ip and port are required"},
-                status=400
-            )
-
-        peer, created = Peer.objects.update_or_create(
-            username=username,
-            defaults={
-                "ip": ip,
-                "port": port
-            }
-        )
-
-        return JsonResponse(
-            {
-                "message": "Peer registered successfully",
-                "created": created
-            },
-            status=201 if created else 200
-        )
-
-    except json.JSONDecodeError:
-        return JsonResponse(
-            {"error": "Invalid JSON"},
-            status=400
-        )
-
-@require_http_methods(["GET"])
-def peers(request):
-    peers = Peer.objects.all()
-
-    data = [
-        {
-            "username": p.username,
-        }
-        for p in peers
-    ]
-
-    return JsonResponse(
-        {"peers": data},
-        status=200
-    )
-
-@require_http_methods(["GET"])
-def peerinfo(request):
-    username = request.GET.get("username")
-
-    if not username:
-        return JsonResponse(
-            {"error": "username parameter is required"},
-            status=400
-        )
-
-    try:
-        peer = Peer.objects.get(username=username)
-    except Peer.DoesNotExist:
-        return JsonResponse(
-            {"error": "Peer not found"},
-            status=404
-        )
-
-    return JsonResponse(
-        {
-            "username": peer.username,
-            "ip": peer.ip,
-            "port": peer.port
-        },
-        status=200
-    )
-
-@csrf_exempt
-@require_http_methods(["POST"])
-def start_friendship(request):
-    data = json.loads(request.body)
-
-    username1 = data.get("user1")
-    username2 = data.get("user2")
-
-    peer1 = Peer.objects.get(username=username1)
-    peer2 = Peer.objects.get(username=username2)
-
-    friendship1 = Friendship.objects.create(owner=peer1, friend_username=peer2.username)
-
-    return JsonResponse(
-        {
-            "message": "friendship started successfully",
-        },
-        status=200
-    )
-
-@csrf_exempt
-@require_http_methods(["GET"])
-def get_friends(request):
-    username = request.GET.get("username")
-    peer = Peer.objects.get(username=username)
-    user_friends = Friendship.objects.filter(owner=peer)
-
-    data = [
-        {
-            "username": friend.friend_username,
-        }
-        for friend in user_friends
-    ]
-
-    return JsonResponse(
-        {
-            "friends": data,
-        },
-        status=200
-    )
-
-@csrf_exempt
-@require_http_methods(["GET"])
-def get_messages(request):
-    username1 = request.GET.get("peer1")
-    username2 = request.GET.get("peer2")
-
-    peer1 = Peer.objects.get(username=username1)
-    peer2 = Peer.objects.get(username=username2)
-
-    messages1 = Message.objects.filter(sender=peer1, receiver=peer2)
-    messages2 = Message.objects.filter(sender=peer2, receiver=peer1)
-    all_messages = messages1.union(messages2).order_by("timestamp")
-
-    data = [
-        {
-            "message": message.content,
-            "from": message.sender.username
-        }
-        for message in all_messages
-    ]
-    
-    return JsonResponse(
-        {
-            "messages": data,
-        },
-        status=200
-    )
+import json
+import sys
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from .models import Peer, Message, Friendship, Group, GroupMembership, Conversation
+from .caching import PEERS_KEY, cache_stats, cached, friends_key, invalidate, peerinfo_key
+from .events import hub
+from .middleware import request_stats
+from .presence import presence
+
+
+@csrf_exempt
+def create_message(request):
+    """
+    POST:
+    {
+        "sender": "alice",
+        "receiver": "bob",
+        "content": "hello"
+    }
+    """
+
+    if request.method != "POST":
+        return JsonResponse(
+            {"error": "Only POST allowed"},
+            status=405
+        )
+
+    try:
+        data = json.loads(request.body.decode())
+        sender_username = data.get("sender")
+        receiver_username = data.get("receiver")
+        content = data.get("content")
+
+        if not sender_username or not receiver_username or not content:
+            return JsonResponse(
+                {"error": "Missing fields"},
+                status=400
+            )
+
+        sender = Peer.objects.get(username=sender_username)
+        receiver = Peer.objects.get(username=receiver_username)
+
+        with transaction.atomic():
+            conversation = Conversation.for_pairs([(sender.id, receiver.id)])[(sender.id, receiver.id)]
+            msg = Message.objects.create(
+                sender=sender,
+                receiver=receiver,
+                conversation=conversation,
+                content=content
+            )
+            Conversation.record_messages([msg])
+        _publish_messages([msg])
+
+        return JsonResponse(
+            {
+                "status": "ok",
+                "message_id": msg.id
+            },
+            status=201
+        )
+
+    except Peer.DoesNotExist:
+        return JsonResponse(
+            {"error": "Sender or receiver not found"},
+            status=404
+        )
+
+    except json.JSONDecodeError:
+        return JsonResponse(
+            {"error": "Invalid JSON"},
+            status=400
+        )
+
+    except Exception as e:
+        return JsonResponse(
+            {"error": str(e)},
+            status=500
+        )
+
+MAX_BULK_MESSAGES = 500
+MAX_MSG_ID_LENGTH = 32
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+DEFAULT_EVENTS_TIMEOUT = 25
+MAX_EVENTS_TIMEOUT = 60
+
+
+def _publish_messages(messages):
+    """
+    Tell the recipients of stored messages (see /events/): one event per
+    recipient and conversation, carrying the latest message id.
+    """
+    group_ids = {msg.group_id for msg in messages if msg.group_id}
+    members = {}
+    if group_ids:
+        for group_id, member in GroupMembership.objects.filter(group_id__in=group_ids).values_list(
+            "group_id", "peer__username"
+        ):
+            members.setdefault(group_id, []).append(member)
+
+    events = {}
+    for msg in messages:
+        sender = msg.sender.username
+        if msg.group_id:
+            for member in members.get(msg.group_id, []):
+                if member != sender:
+                    events[member, "#" + msg.group.name] = {
+                        "type": "group_message", "group": msg.group.name, "from": sender, "id": msg.id
+                    }
+        else:
+            events[msg.receiver.username, sender] = {"type": "message", "from": sender, "id": msg.id}
+    for (recipient, _), event in events.items():
+        hub.publish([recipient], event)
+
+
+def _int_param(request, name):
+    value = request.GET.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def bulk_create_messages(request):
+    """
+    POST:
+    {
+        "messages": [
+            {"sender": "alice", "receiver": "bob", "content": "hello", "msg_id": "9f1c..."},
+            {"sender": "alice", "group": "team", "content": "hi all"},
+            ...
+        ]
+    }
+
+    A group message is stored once for all of the group's members.
+    "msg_id" (optional, at most 32 characters) is the id the message had
+    on the peer connection; history returns it so peers can match both.
+
+    Invalid items (missing fields, unknown sender, receiver or group) are
+    skipped and reported in "errors" by index; the others are stored.
+    "message_ids" follows the order of "messages", null for a skipped
+    item. Only a batch with nothing valid in it is answered with 400.
+    """
+
+    try:
+        data = json.loads(request.body.decode())
+    except json.JSONDecodeError:
+        return JsonResponse(
+            {"error": "Invalid JSON"},
+            status=400
+        )
+
+    items = data.get("messages") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return JsonResponse(
+            {"error": "messages must be a non-empty list"},
+            status=400
+        )
+    if len(items) > MAX_BULK_MESSAGES:
+        return JsonResponse(
+            {"error": f"At most {MAX_BULK_MESSAGES} messages per request"},
+            status=400
+        )
+
+    errors = {}
+    for index, item in enumerate(items):
+        if (not isinstance(item, dict) or not item.get("sender") or not item.get("content")
+                or bool(item.get("receiver")) == bool(item.get("group"))):
+            errors[index] = "Missing fields"
+        elif not all(isinstance(item.get(f) or "", str) for f in ("sender", "receiver", "group", "content", "msg_id")):
+            errors[index] = "Fields must be strings"
+        elif len(item.get("msg_id") or "") > MAX_MSG_ID_LENGTH:
+            errors[index] = "msg_id too long"
+    valid = [index for index in range(len(items)) if index not in errors]
+
+    usernames = {items[i]["sender"] for i in valid} | {items[i]["receiver"] for i in valid if items[i].get("receiver")}
+    peers = {p.username: p for p in Peer.objects.filter(username__in=usernames)}
+    group_names = {items[i]["group"] for i in valid if items[i].get("group")}
+    groups = {g.name: g for g in Group.objects.filter(name__in=group_names)}
+    for index in valid:
+        item = items[index]
+        if item["sender"] not in peers or (item.get("receiver") and item["receiver"] not in peers):
+            errors[index] = "Sender or receiver not found"
+        elif item.get("group") and item["group"] not in groups:
+            errors[index] = "Group not found"
+    valid = [index for index in valid if index not in errors]
+    error_list = [{"index": index, "error": error} for index, error in sorted(errors.items())]
+
+    if not valid:
+        return JsonResponse(
+            {"error": "No valid messages", "errors": error_list},
+            status=400
+        )
+
+    def pair(item):
+        return peers[item["sender"]].id, peers[item["receiver"]].id
+
+    stored = [items[i] for i in valid]
+    with transaction.atomic():
+        conversations = Conversation.for_pairs([pair(item) for item in stored if item.get("receiver")])
+        created = Message.objects.bulk_create([
+            Message(
+                sender=peers[item["sender"]],
+                receiver=peers.get(item.get("receiver")),
+                group=groups.get(item.get("group")),
+                conversation=conversations[pair(item)] if item.get("receiver") else None,
+                content=item["content"],
+                msg_id=item.get("msg_id") or None
+            )
+            for item in stored
+        ])
+        Conversation.record_messages(created)
+    _publish_messages(created)
+
+    message_ids = [None] * len(items)
+    for index, msg in zip(valid, created):
+        message_ids[index] = msg.id
+
+    return JsonResponse(
+        {
+            "status": "ok",
+            "count": len(created),
+            "message_ids": message_ids,
+            "errors": error_list
+        },
+        status=201
+    )
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def register(request):
+    try:
+        data = json.loads(request.body)
+
+        username = data.get("username")
+        ip = data.get("ip")
+        port = data.get("port")
+
+        if not all([username, ip, port]):
+            return JsonResponse(
+                {"error": "username, ip and port are required"},
+                status=400
+            )
+
+        previous = Peer.objects.filter(username=username).values_list("ip", "port").first()
+        peer, created = Peer.objects.update_or_create(
+            username=username,
+            defaults={
+                "ip": ip,
+                "port": port
+            }
+        )
+        invalidate(peerinfo_key(username), PEERS_KEY)
+        if previous and previous != (peer.ip, int(peer.port)):
+            # Whoever may have this peer's old address cached.
+            friends = set(Friendship.objects.filter(friend_username=username).values_list("owner__username", flat=True))
+            friends |= set(Friendship.objects.filter(owner=peer).values_list("friend_username", flat=True))
+            friends.discard(username)
+            hub.publish(friends, {"type": "address", "username": username, "ip": peer.ip, "port": int(peer.port)})
+
+        return JsonResponse(
+            {
+                "message": "Peer registered successfully",
+                "created": created
+            },
+            status=201 if created else 200
+        )
+
+    except json.JSONDecodeError:
+        return JsonResponse(
+            {"error": "Invalid JSON"},
+            status=400
+        )
+
+@require_http_methods(["GET"])
+def peers(request):
+    data = cached(PEERS_KEY, lambda: [
+        {
+            "username": username,
+        }
+        for username in Peer.objects.values_list("username", flat=True)
+    ])
+
+    return JsonResponse(
+        {"peers": data},
+        status=200
+    )
+
+DEFAULT_DIRECTORY_PAGE = 50
+MAX_DIRECTORY_PAGE = 200
+
+
+def _prefix_range(prefix):
+    """
+    [prefix, upper) bounds of all usernames starting with `prefix`. A range
+    can use the username index; startswith (LIKE ... ESCAPE) can't on SQLite.
+    `upper` is None (no upper bound) if the prefix is all U+10FFFF.
+    """
+    # Trailing U+10FFFF can't be incremented: bump the character before it.
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return prefix, None
+    last = ord(stem[-1]) + 1
+    if 0xD800 <= last <= 0xDFFF:
+        last = 0xE000  # surrogates can't be stored
+    return prefix, stem[:-1] + chr(last)
+
+
+@require_http_methods(["GET"])
+def directory(request):
+    """
+    GET /directory/?q=ali&online=1&after=alice&limit=50
+
+    Peer directory ordered by username, keyset paginated: pass the
+    returned `next` as `after` for the following page (null at the end).
+    `q` keeps usernames starting with it, `online=1` / `online=0` keeps
+    peers seen / not seen in the last PEER_ONLINE_WINDOW seconds. The
+    filter reads last_seen as last flushed from the heartbeat table; the
+    returned `online` / `last_seen` include heartbeats not flushed yet.
+    """
+    prefix = request.GET.get("q", "")
+    after = request.GET.get("after")
+    online = request.GET.get("online")
+
+    try:
+        limit = _int_param(request, "limit") or DEFAULT_DIRECTORY_PAGE
+    except ValueError as e:
+        return JsonResponse(
+            {"error": str(e)},
+            status=400
+        )
+    if online not in (None, "", "0", "1"):
+        return JsonResponse(
+            {"error": "online must be 0 or 1"},
+            status=400
+        )
+    limit = max(1, min(limit, MAX_DIRECTORY_PAGE))
+
+    online_since = timezone.now() - timedelta(seconds=settings.PEER_ONLINE_WINDOW)
+    peers = Peer.objects.all()
+    if prefix:
+        lower, upper = _prefix_range(prefix)
+        peers = peers.filter(username__gte=lower)
+        if upper is not None:
+            peers = peers.filter(username__lt=upper)
+    if after:
+        peers = peers.filter(username__gt=after)
+    if online == "1":
+        peers = peers.filter(last_seen__gte=online_since)
+    elif online == "0":
+        peers = peers.filter(last_seen__lt=online_since)
+
+    # One extra row tells whether there is a next page.
+    page = list(peers.order_by("username").values_list("username", "last_seen")[:limit + 1])
+    has_more = len(page) > limit
+    page = [(username, presence.freshest(username, last_seen)) for username, last_seen in page[:limit]]
+
+    return JsonResponse(
+        {
+            "peers": [
+                {
+                    "username": username,
+                    "online": last_seen >= online_since,
+                    "last_seen": last_seen.isoformat()
+                }
+                for username, last_seen in page
+            ],
+            "next": page[-1][0] if has_more else None
+        },
+        status=200
+    )
+
+@require_http_methods(["GET"])
+def peerinfo(request):
+    username = request.GET.get("username")
+
+    if not username:
+        return JsonResponse(
+            {"error": "username parameter is required"},
+            status=400
+        )
+
+    # Unknown usernames are cached too (as None); registering invalidates them.
+    peer = cached(
+        peerinfo_key(username),
+        lambda: Peer.objects.filter(username=username).values("username", "ip", "port", "last_seen").first()
+    )
+    if peer is None:
+        return JsonResponse(
+            {"error": "Peer not found"},
+            status=404
+        )
+
+    # The cached last_seen may predate recent heartbeats; the presence table has them.
+    last_seen = presence.freshest(peer["username"], peer["last_seen"])
+    online_since = timezone.now() - timedelta(seconds=settings.PEER_ONLINE_WINDOW)
+
+    return JsonResponse(
+        {
+            "username": peer["username"],
+            "ip": peer["ip"],
+            "port": peer["port"],
+            "online": last_seen >= online_since,
+            "last_seen": last_seen.isoformat()
+        },
+        status=200
+    )
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def start_friendship(request):
+    data = json.loads(request.body)
+
+    username1 = data.get("user1")
+    username2 = data.get("user2")
+
+    peer1 = Peer.objects.get(username=username1)
+    peer2 = Peer.objects.get(username=username2)
+
+    friendship1 = Friendship.objects.create(owner=peer1, friend_username=peer2.username)
+    invalidate(friends_key(peer1.username))
+    hub.publish([peer1.username], {"type": "friendship", "username": peer2.username})
+    hub.publish([peer2.username], {"type": "friendship", "username": peer1.username})
+
+    return JsonResponse(
+        {
+            "message": "friendship started successfully",
+        },
+        status=200
+    )
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def get_friends(request):
+    username = request.GET.get("username")
+
+    def load():
+        peer = Peer.objects.get(username=username)
+        return [
+            {
+                "username": friend_username,
+            }
+            for friend_username in Friendship.objects.filter(owner=peer).values_list("friend_username", flat=True)
+        ]
+
+    data = cached(friends_key(username), load)
+
+    return JsonResponse(
+        {
+            "friends": data,
+        },
+        status=200
+    )
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def get_messages(request):
+    """
+    GET /message/get/?peer1=alice&peer2=bob[&before=<id>|&after=<id>][&limit=50]
+    GET /message/get/?group=team[&before=<id>|&after=<id>][&limit=50]
+
+    Cursor paginated conversation history, oldest first inside a page.
+    Without a cursor the most recent page is returned, `before` pages
+    backwards and `after` pages forwards. `has_more` tells whether another
+    page exists in the same direction.
+    """
+    username1 = request.GET.get("peer1")
+    username2 = request.GET.get("peer2")
+    group_name = request.GET.get("group")
+
+    try:
+        before = _int_param(request, "before")
+        after = _int_param(request, "after")
+        limit = _int_param(request, "limit") or DEFAULT_PAGE_SIZE
+    except ValueError as e:
+        return JsonResponse(
+            {"error": str(e)},
+            status=400
+        )
+
+    if before is not None and after is not None:
+        return JsonResponse(
+            {"error": "Use either before or after, not both"},
+            status=400
+        )
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    if group_name:
+        group_id = Group.objects.filter(name=group_name).values_list("id", flat=True).first()
+        if group_id is None:
+            return JsonResponse(
+                {"error": "Group not found"},
+                status=404
+            )
+        messages = Message.objects.filter(group_id=group_id)
+    else:
+        peer_ids = dict(Peer.objects.filter(username__in=[username1, username2]).values_list("username", "id"))
+        if username1 not in peer_ids or username2 not in peer_ids:
+            return JsonResponse(
+                {"error": "Peer not found"},
+                status=404
+            )
+        conversation = Conversation.between(peer_ids[username1], peer_ids[username2])
+        # Both directions in one range scan of the (conversation, id) index.
+        messages = Message.objects.filter(conversation=conversation) if conversation else Message.objects.none()
+
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    if after is not None:
+        messages = messages.filter(id__gt=after)
+    messages = messages.values_list("id", "content", "sender__username", "msg_id")
+
+    # Fetch one extra row to know whether there is another page.
+    if after is not None:
+        page = list(messages.order_by("id")[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+    else:
+        page = list(messages.order_by("-id")[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit][::-1]
+
+    data = [
+        {
+            "id": message_id,
+            "message": content,
+            "from": sender,
+            "msg_id": msg_id
+        }
+        for message_id, content, sender, msg_id in page
+    ]
+
+    return JsonResponse(
+        {
+            "messages": data,
+            "has_more": has_more,
+            "oldest_id": data[0]["id"] if data else None,
+            "newest_id": data[-1]["id"] if data else None,
+        },
+        status=200
+    )
+
+
+def _cursor(cursors, key):
+    try:
+        return int(cursors.get(key) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def session_bootstrap(request):
+    """
+    POST:
+    {
+        "username": "bob",
+        "cursors": {"alice": 120},
+        "group_cursors": {"team": 300}
+    }
+
+    Everything a peer needs at login in one round trip: its own peer info,
+    its friends, and per friend the latest message id of the conversation
+    plus the number of messages from that friend newer than the cursor
+    (without a cursor: received since the peer last caught up). Groups are
+    listed the same way, counting messages from other members.
+
+    "events_cursor" is where the peer's first /events/ poll should start:
+    taken before anything is read, so an event published while (or after)
+    this answer is built is delivered by the poll rather than lost.
+    """
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except json.JSONDecodeError:
+        return JsonResponse(
+            {"error": "Invalid JSON"},
+            status=400
+        )
+
+    username = data.get("username")
+    cursors = data.get("cursors") or {}
+    group_cursors = data.get("group_cursors") or {}
+    if not username or not isinstance(cursors, dict) or not isinstance(group_cursors, dict):
+        return JsonResponse(
+            {"error": "username is required and cursors must be an object"},
+            status=400
+        )
+
+    events_cursor = hub.cursor()
+    try:
+        peer = Peer.objects.get(username=username)
+    except Peer.DoesNotExist:
+        return JsonResponse(
+            {"error": "Peer not found"},
+            status=404
+        )
+    # Logging in counts as being seen (see /directory/).
+    Peer.objects.filter(id=peer.id).update(last_seen=timezone.now())
+    invalidate(peerinfo_key(username))
+
+    friend_usernames = list(dict.fromkeys(
+        Friendship.objects.filter(owner=peer).values_list("friend_username", flat=True)
+    ))
+    friend_ids = dict(
+        Peer.objects.filter(username__in=friend_usernames).values_list("username", "id")
+    )
+
+    latest = {}
+    unread = {}
+    if friend_ids:
+        conversations = Conversation.objects.filter(
+            Q(peer_a=peer, peer_b_id__in=friend_ids.values()) | Q(peer_b=peer, peer_a_id__in=friend_ids.values())
+        )
+        by_friend = {c.peer_a_id if c.peer_b_id == peer.id else c.peer_b_id: c for c in conversations}
+
+        # The stored unread count is used when the peer sends no cursor.
+        # Otherwise the cursor decides: nothing is unread if it is at the
+        # newest message, else the newer messages are counted through the
+        # (conversation, id) index.
+        recount = Q()
+        caught_up = {"unread_a": Q(), "unread_b": Q()}
+        for friend, friend_id in friend_ids.items():
+            conversation = by_friend.get(friend_id)
+            if conversation is None or conversation.last_message_id is None:
+                continue
+            side = "unread_b" if conversation.peer_b_id == peer.id else "unread_a"
+            latest[friend_id] = conversation.last_message_id
+            if friend not in cursors:
+                unread[friend_id] = getattr(conversation, side)
+                continue
+            cursor = _cursor(cursors, friend)
+            if cursor < conversation.last_message_id:
+                recount |= Q(conversation_id=conversation.id, id__gt=cursor)
+            elif getattr(conversation, side):
+                # Only if no message arrived since it was read.
+                caught_up[side] |= Q(id=conversation.id, last_message_id=conversation.last_message_id)
+
+        if recount:
+            friend_of = {c.id: friend_id for friend_id, c in by_friend.items()}
+            rows = Message.objects.filter(recount).exclude(sender=peer).values("conversation_id").annotate(
+                unread=Count("id")
+            )
+            for row in rows:
+                unread[friend_of[row["conversation_id"]]] = row["unread"]
+        for side, condition in caught_up.items():
+            if condition:
+                Conversation.objects.filter(condition).update(**{side: 0})
+
+    friends = []
+    for friend in friend_usernames:
+        friend_id = friend_ids.get(friend)
+        friends.append({
+            "username": friend,
+            "last_message_id": latest.get(friend_id),
+            "unread": unread.get(friend_id, 0),
+        })
+
+    group_ids = dict(Group.objects.filter(memberships__peer=peer).values_list("name", "id"))
+    group_latest = {}
+    group_unread = {}
+    if group_ids:
+        unread_filter = Q()
+        for name, group_id in group_ids.items():
+            unread_filter |= Q(group_id=group_id, id__gt=_cursor(group_cursors, name))
+        unread_filter &= ~Q(sender=peer)
+
+        rows = Message.objects.filter(group_id__in=group_ids.values()).values("group_id").annotate(
+            last=Max("id"), unread=Count("id", filter=unread_filter)
+        )
+        for row in rows:
+            group_latest[row["group_id"]] = row["last"]
+            group_unread[row["group_id"]] = row["unread"]
+
+    groups = [
+        {
+            "name": name,
+            "last_message_id": group_latest.get(group_id),
+            "unread": group_unread.get(group_id, 0),
+        }
+        for name, group_id in group_ids.items()
+    ]
+
+    return JsonResponse(
+        {
+            "peer": {
+                "username": peer.username,
+                "ip": peer.ip,
+                "port": peer.port
+            },
+            "friends": friends,
+            "groups": groups,
+            "events_cursor": events_cursor,
+        },
+        status=200
+    )
+
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_WRITE_SIZE = 64 * 1024
+
+
+def _export_lines(conversations):
+    """
+    NDJSON for every (label, messages) pair, in writes of about 64 KiB.
+    Rows come through iterator(), so memory stays constant whatever the
+    history size.
+    """
+    buffer, size = [], 0
+    for label, messages in conversations:
+        rows = messages.order_by("id").values_list("id", "sender__username", "content", "timestamp")
+        for message_id, sender, content, timestamp in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            line = json.dumps({
+                "id": message_id,
+                "conversation": label,
+                "from": sender,
+                "message": content,
+                "timestamp": timestamp.isoformat(),
+            }) + "\n"
+            buffer.append(line)
+            size += len(line)
+            if size >= EXPORT_WRITE_SIZE:
+                yield "".join(buffer)
+                buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+async def _async_chunks(iterator):
+    # One thread_sensitive hop per ~64 KiB chunk, so the queryset
+    # iterators always run on the same thread and DB connection.
+    next_chunk = sync_to_async(next)
+    while True:
+        chunk = await next_chunk(iterator, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+@require_http_methods(["GET"])
+def export_messages(request):
+    """
+    GET /message/export/?username=alice                 all of alice's conversations
+    GET /message/export/?username=alice&peer=bob        one conversation
+    GET /message/export/?username=alice&group=team      one group
+
+    Streams the history as NDJSON, one message per line, oldest first in
+    each conversation. Group conversations are labelled "#<name>".
+    """
+    username = request.GET.get("username")
+    peer_name = request.GET.get("peer")
+    group_name = request.GET.get("group")
+
+    if not username or (peer_name and group_name):
+        return JsonResponse(
+            {"error": "username is required, with at most one of peer or group"},
+            status=400
+        )
+
+    try:
+        peer = Peer.objects.get(username=username)
+    except Peer.DoesNotExist:
+        return JsonResponse(
+            {"error": "Peer not found"},
+            status=404
+        )
+
+    if group_name:
+        group_ids = list(Group.objects.filter(name=group_name, memberships__peer=peer).values_list("id", flat=True))
+        if not group_ids:
+            return JsonResponse(
+                {"error": "Group not found"},
+                status=404
+            )
+        groups = [(group_name, group_ids[0])]
+        partners = []
+    elif peer_name:
+        try:
+            other = Peer.objects.get(username=peer_name)
+        except Peer.DoesNotExist:
+            return JsonResponse(
+                {"error": "Peer not found"},
+                status=404
+            )
+        conversation = Conversation.between(peer.id, other.id)
+        partners = [(peer_name, conversation.id)] if conversation else []
+        groups = []
+    else:
+        conversations = Conversation.objects.filter(Q(peer_a=peer) | Q(peer_b=peer)).values_list(
+            "id", "peer_a__username", "peer_b__username"
+        )
+        partners = [(b if a == username else a, conversation_id) for conversation_id, a, b in conversations]
+        groups = list(Group.objects.filter(memberships__peer=peer).values_list("name", "id"))
+
+    # One index range scan per conversation, (conversation, id) / (group, id).
+    sources = [(name, Message.objects.filter(conversation_id=cid)) for name, cid in sorted(partners)]
+    sources += [("#" + name, Message.objects.filter(group_id=gid)) for name, gid in sorted(groups)]
+
+    filename = f"{username}-{peer_name or ('#' + group_name if group_name else 'all')}.ndjson"
+    lines = _export_lines(sources)
+    if isinstance(request, ASGIRequest):
+        # Under ASGI a sync iterator would be read into memory in one go.
+        lines = _async_chunks(lines)
+    response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+# ===============================
+# GROUPS
+# ===============================
+def _group_members(group):
+    members = Peer.objects.filter(group_memberships__group=group).order_by("username")
+    return [
+        {
+            "username": p.username,
+            "ip": p.ip,
+            "port": p.port
+        }
+        for p in members
+    ]
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def create_group(request):
+    """
+    POST:
+    {
+        "name": "team",
+        "owner": "alice",
+        "members": ["bob", "carol"]
+    }
+
+    The owner is always a member.
+    """
+
+    try:
+        data = json.loads(request.body.decode())
+    except json.JSONDecodeError:
+        return JsonResponse(
+            {"error": "Invalid JSON"},
+            status=400
+        )
+
+    name = data.get("name")
+    owner_username = data.get("owner")
+    usernames = data.get("members") or []
+    if not name or not owner_username or not isinstance(usernames, list):
+        return JsonResponse(
+            {"error": "name and owner are required, members must be a list"},
+            status=400
+        )
+
+    usernames = set(usernames) | {owner_username}
+    peers = {p.username: p for p in Peer.objects.filter(username__in=usernames)}
+    missing = sorted(usernames - peers.keys())
+    if missing:
+        return JsonResponse(
+            {"error": "Peer not found", "usernames": missing},
+            status=404
+        )
+
+    with transaction.atomic():
+        group, created = Group.objects.get_or_create(name=name, defaults={"owner": peers[owner_username]})
+        if not created:
+            return JsonResponse(
+                {"error": "Group already exists"},
+                status=409
+            )
+        GroupMembership.objects.bulk_create([
+            GroupMembership(group=group, peer=p) for p in peers.values()
+        ])
+
+    return JsonResponse(
+        {
+            "name": group.name,
+            "owner": owner_username,
+            "members": _group_members(group)
+        },
+        status=201
+    )
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def add_group_members(request):
+    """
+    POST:
+    {
+        "group": "team",
+        "usernames": ["dave"]
+    }
+
+    Adding someone who is already a member is a no-op, so joining is
+    `{"group": "team", "usernames": [<self>]}`.
+    """
+
+    try:
+        data = json.loads(request.body.decode())
+    except json.JSONDecodeError:
+        return JsonResponse(
+            {"error": "Invalid JSON"},
+            status=400
+        )
+
+    usernames = data.get("usernames")
+    if not data.get("group") or not isinstance(usernames, list) or not usernames:
+        return JsonResponse(
+            {"error": "group and a non-empty usernames list are required"},
+            status=400
+        )
+
+    try:
+        group = Group.objects.get(name=data["group"])
+    except Group.DoesNotExist:
+        return JsonResponse(
+            {"error": "Group not found"},
+            status=404
+        )
+
+    peers = list(Peer.objects.filter(username__in=usernames))
+    missing = sorted(set(usernames) - {p.username for p in peers})
+    if missing:
+        return JsonResponse(
+            {"error": "Peer not found", "usernames": missing},
+            status=404
+        )
+
+    GroupMembership.objects.bulk_create(
+        [GroupMembership(group=group, peer=p) for p in peers],
+        ignore_conflicts=True
+    )
+
+    return JsonResponse(
+        {
+            "name": group.name,
+            "members": _group_members(group)
+        },
+        status=200
+    )
+
+
+@require_http_methods(["GET"])
+def group_members(request):
+    """
+    GET /group/members/?group=team
+
+    Members with their addresses, so a sender can fan a message out
+    without one peerinfo lookup per member.
+    """
+    name = request.GET.get("group")
+
+    if not name:
+        return JsonResponse(
+            {"error": "group parameter is required"},
+            status=400
+        )
+
+    try:
+        group = Group.objects.get(name=name)
+    except Group.DoesNotExist:
+        return JsonResponse(
+            {"error": "Group not found"},
+            status=404
+        )
+
+    return JsonResponse(
+        {
+            "name": group.name,
+            "members": _group_members(group)
+        },
+        status=200
+    )
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """
+    GET /metrics
+
+    Per-view request timing, DB time and query counts (see
+    middleware.RequestMetricsMiddleware). Internal: only answered for
+    METRICS_ALLOWED_IPS.
+    """
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        return JsonResponse(
+            {"error": "Forbidden"},
+            status=403
+        )
+
+    return JsonResponse(
+        {
+            "slow_request_ms": settings.SLOW_REQUEST_MS,
+            "views": request_stats.snapshot(),
+            "presence": presence.stats(),
+            "events": hub.stats(),
+            "cache": cache_stats.snapshot()
+        },
+        status=200
+    )
+
+
+# ===============================
+# PUSH
+# ===============================
+@require_http_methods(["GET"])
+async def events(request):
+    """
+    GET /events/?username=bob&cursor=<cursor>&timeout=25
+
+    Long-poll for bob's notifications: answers as soon as there are events
+    past `cursor`, or with none after `timeout` seconds (at most 60).
+    Start without a cursor, then always pass the returned one:
+
+    {"events": [...], "cursor": "...", "reset": false}
+
+    Events: {"type": "message", "from", "id"}, {"type": "group_message",
+    "group", "from", "id"}, {"type": "friendship", "username"} and
+    {"type": "address", "username", "ip", "port"}. `reset` means events
+    may have been missed (server restart, full backlog): resync.
+
+    Async, so a waiting client costs no thread when served over ASGI.
+    """
+    username = request.GET.get("username")
+    if not username:
+        return JsonResponse(
+            {"error": "username parameter is required"},
+            status=400
+        )
+    try:
+        timeout = _int_param(request, "timeout")
+    except ValueError as e:
+        return JsonResponse(
+            {"error": str(e)},
+            status=400
+        )
+    timeout = DEFAULT_EVENTS_TIMEOUT if timeout is None else max(0, min(timeout, MAX_EVENTS_TIMEOUT))
+
+    if not await Peer.objects.filter(username=username).aexists():
+        return JsonResponse(
+            {"error": "Peer not found"},
+            status=404
+        )
+
+    return JsonResponse(
+        await hub.wait(username, request.GET.get("cursor"), timeout),
+        status=200
+    )